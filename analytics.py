@@ -0,0 +1,146 @@
+'''
+Aggregate queries over users and statuses, computed in SQL
+'''
+# pylint: disable=R0903, E0401
+from loguru import logger
+import peewee as pw
+import socialnetwork_model as sm
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class UserStatusCount(sm.BaseModel):
+    '''
+    Materialised per-user status counts, kept current by triggers on
+    the status table once install_summary has run
+    '''
+    user = pw.ForeignKeyField(sm.Users, primary_key=True,
+                              column_name='user_id', on_delete='CASCADE')
+    status_count = pw.IntegerField(default=0)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'user_status_count'
+
+
+SUMMARY_TRIGGERS = {
+    'status_count_insert': '''
+        AFTER INSERT ON status BEGIN
+        INSERT INTO user_status_count (user_id, status_count)
+        VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET status_count = status_count + 1;
+        END''',
+    'status_count_delete': '''
+        AFTER DELETE ON status BEGIN
+        UPDATE user_status_count SET status_count = status_count - 1
+        WHERE user_id = OLD.user_id;
+        END''',
+    'status_count_move': '''
+        AFTER UPDATE OF user_id ON status
+        WHEN OLD.user_id IS NOT NEW.user_id BEGIN
+        UPDATE user_status_count SET status_count = status_count - 1
+        WHERE user_id = OLD.user_id;
+        INSERT INTO user_status_count (user_id, status_count)
+        VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET status_count = status_count + 1;
+        END'''}
+
+
+def install_summary(database=sm.db):
+    '''
+    Creates the user_status_count table and its triggers, then fills it
+    from the status table. Safe to call repeatedly.
+    '''
+    database.create_tables([UserStatusCount])
+    for name, body in SUMMARY_TRIGGERS.items():
+        database.execute_sql(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+    return refresh_summary()
+
+
+def uninstall_summary(database=sm.db):
+    '''
+    Drops the summary triggers and table
+    '''
+    for name in SUMMARY_TRIGGERS:
+        database.execute_sql(f'DROP TRIGGER IF EXISTS {name}')
+    database.drop_tables([UserStatusCount])
+    return True
+
+
+def refresh_summary():
+    '''
+    Rebuilds user_status_count from scratch. Only needed after the
+    triggers were missing; returns the number of users counted.
+    '''
+    with sm.db.atomic():
+        UserStatusCount.delete().execute()
+        counts = (sm.Status.select(sm.Status.user_id,
+                                   pw.fn.COUNT(sm.Status.status_id))
+                  .group_by(sm.Status.user_id))
+        rows = UserStatusCount.insert_from(
+            counts, [UserStatusCount.user, UserStatusCount.status_count]
+        ).execute()
+    logger.info('Refreshed user status summary')
+    return rows
+
+
+def top_posters(limit=10, use_summary=False):
+    '''
+    Returns (user_id, status_count) tuples for the users with the most
+    statuses, largest first
+    '''
+    if use_summary:
+        count = UserStatusCount.status_count
+        query = (UserStatusCount.select(UserStatusCount.user, count)
+                 .where(count > 0))
+    else:
+        count = pw.fn.COUNT(sm.Status.status_id)
+        query = (sm.Status.select(sm.Status.user_id, count.alias('count'))
+                 .group_by(sm.Status.user_id))
+    return query.order_by(count.desc()).limit(limit).tuples()
+
+
+def statuses_per_email_domain():
+    '''
+    Returns (domain, users, statuses) tuples, one per email domain
+    '''
+    email = sm.Users.user_email
+    domain = pw.fn.SUBSTR(email, pw.fn.INSTR(email, '@') + 1)
+    return (sm.Users
+            .select(domain.alias('domain'),
+                    pw.fn.COUNT(sm.Users.user_id.distinct()),
+                    pw.fn.COUNT(sm.Status.status_id))
+            .join(sm.Status, pw.JOIN.LEFT_OUTER,
+                  on=(sm.Status.user_id == sm.Users.user_id))
+            .group_by(domain)
+            .order_by(domain)
+            .tuples())
+
+
+def users_without_statuses():
+    '''
+    Streams the user_ids of users who never posted
+    '''
+    return (sm.Users.select(sm.Users.user_id)
+            .join(sm.Status, pw.JOIN.LEFT_OUTER,
+                  on=(sm.Status.user_id == sm.Users.user_id))
+            .where(sm.Status.status_id.is_null())
+            .order_by(sm.Users.user_id)
+            .tuples()
+            .iterator())
+
+
+def as_arrays(rows, names):
+    '''
+    Turns result tuples into a dict of columns, NumPy arrays when NumPy
+    is installed and lists otherwise
+    '''
+    columns = list(zip(*rows)) or [()] * len(names)
+    if np is None:
+        return {name: list(column) for name, column in zip(names, columns)}
+    return {name: np.asarray(column) for name, column in zip(names, columns)}
@@ -0,0 +1,140 @@
+'''
+Online backup and restore of the social network database.
+
+    python backup.py backup socialnetwork-backup.db.gz
+    python backup.py restore socialnetwork-backup.db.gz
+
+Backups are copied with SQLite's backup API a few pages at a time,
+sleeping between steps, so writers on other connections are only held
+up for one step. A name ending in .gz is gzip-compressed.
+'''
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from loguru import logger
+
+if __name__ == '__main__':
+    # keep the model module from emptying the database being backed up;
+    # only the command line sets this, importers keep their own setting
+    os.environ.setdefault('SOCIALNETWORK_KEEP_DB', '1')
+import socialnetwork_model as sm  # pylint: disable=C0413
+
+#pylint: disable=C0103
+
+
+def _copy(source, target, pages, sleep):
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        # the backup API itself only sleeps when the source is busy
+        if sleep and remaining:
+            time.sleep(sleep)
+
+    source.backup(target, pages=pages, progress=progress)
+    return steps
+
+
+def backup(path, database=sm.db, pages=1024, sleep=0.005, compress=None):
+    '''
+    Copies the live database to path, pages pages per step with sleep
+    seconds between steps. compress (default: path ends in .gz) gzips
+    the copy. Returns the file size, step count and timing.
+    '''
+    if compress is None:
+        compress = path.endswith('.gz')
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or '.') as tmp:
+        # copy (and compress) next to path first, so a failed backup
+        # never leaves a truncated file under its name
+        copy_path = os.path.join(tmp, 'backup.db')
+        target = sqlite3.connect(copy_path)
+        try:
+            steps = _copy(database.connection(), target, pages, sleep)
+        finally:
+            target.close()
+        database_bytes = os.path.getsize(copy_path)
+        if compress:
+            packed_path = copy_path + '.gz'
+            with open(copy_path, 'rb') as plain, \
+                    gzip.open(packed_path, 'wb', compresslevel=6) as packed:
+                shutil.copyfileobj(plain, packed, 1 << 20)
+            os.replace(packed_path, path)
+        else:
+            os.replace(copy_path, path)
+    elapsed = time.perf_counter() - start
+    report = {'path': path, 'database_bytes': database_bytes,
+              'file_bytes': os.path.getsize(path), 'steps': steps,
+              'seconds': elapsed,
+              'mb_per_s': database_bytes / elapsed / 1e6 if elapsed else 0.0}
+    logger.info('Backup written: {}', report)
+    return report
+
+
+def restore(path, database=sm.db, pages=-1, verify=True):
+    '''
+    Replaces the contents of the database with the backup at path
+    (gzip-compressed if it ends in .gz), through the database's own
+    connection so open collections see the restored data. The database
+    epoch is redrawn afterwards, so id filters and text indexes in any
+    process rebuild on their next use. verify runs quick_check on
+    the backup first and raises sqlite3.DatabaseError if it is damaged.
+    '''
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        if path.endswith('.gz'):
+            plain_path = os.path.join(tmp, 'restore.db')
+            with gzip.open(path, 'rb') as packed, \
+                    open(plain_path, 'wb') as plain:
+                shutil.copyfileobj(packed, plain, 1 << 20)
+        else:
+            plain_path = path
+        source = sqlite3.connect(f'file:{plain_path}?mode=ro', uri=True)
+        try:
+            if verify:
+                result = source.execute('PRAGMA quick_check').fetchone()[0]
+                if result != 'ok':
+                    raise sqlite3.DatabaseError(
+                        f'{path} failed quick_check: {result}')
+            steps = _copy(source, database.connection(), pages, 0)
+        finally:
+            source.close()
+    sm.new_database_epoch(database)
+    report = {'path': path, 'steps': steps,
+              'seconds': time.perf_counter() - start}
+    logger.info('Backup restored: {}', report)
+    return report
+
+
+def cli(argv=None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('command', choices=('backup', 'restore'))
+    parser.add_argument('path', help='backup file; .gz means compressed')
+    parser.add_argument('--db', help='database file (default: SOCIALNETWORK_DB'
+                        ' or socialnetwork.db)')
+    parser.add_argument('--pages', type=int, default=1024,
+                        help='pages copied per backup step')
+    parser.add_argument('--sleep', type=float, default=0.005,
+                        help='seconds to pause between backup steps')
+    args = parser.parse_args(argv)
+    if args.db:
+        sm.use_database(args.db)
+    if args.command == 'backup':
+        report = backup(args.path, pages=args.pages, sleep=args.sleep)
+    else:
+        report = restore(args.path)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    cli()
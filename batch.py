@@ -0,0 +1,191 @@
+'''
+Non-interactive batch runner over the main.py facade.
+
+Reads operations from a JSONL file (one object per line) or a CSV file
+(header row naming the fields) and runs them in grouped transactions:
+
+    python batch.py ops.jsonl --batch-size 500 --results results.jsonl
+
+The operations run against socialnetwork.db (or SOCIALNETWORK_DB, or
+--db), which is kept as it is rather than emptied first.
+
+Each operation has an "op" field plus the arguments of the matching
+main.py function, e.g.
+    {"op": "add_user", "user_id": "bob123", "email": "bob@gmail.com",
+     "user_name": "Bob", "user_last_name": "Belcher"}
+'''
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from loguru import logger
+import peewee as pw
+
+if __name__ == '__main__':
+    # keep the model module from emptying the database the operations
+    # run against; only the command line sets this, importers keep
+    # their own setting
+    os.environ.setdefault('SOCIALNETWORK_KEEP_DB', '1')
+import main  # pylint: disable=C0413
+import socialnetwork_model as sm  # pylint: disable=C0413
+
+#pylint: disable=C0103
+
+# op name -> (main.py function, argument names, collection it needs)
+OPERATIONS = {
+    'add_user': (main.add_user,
+                 ('user_id', 'email', 'user_name', 'user_last_name'), 'user'),
+    'update_user': (main.update_user,
+                    ('user_id', 'email', 'user_name', 'user_last_name'),
+                    'user'),
+    'delete_user': (main.delete_user, ('user_id',), 'user'),
+    'search_user': (main.search_user, ('user_id',), 'user'),
+    'add_status': (main.add_status,
+                   ('status_id', 'user_id', 'status_text'), 'status'),
+    'update_status': (main.update_status,
+                      ('status_id', 'user_id', 'status_text'), 'status'),
+    'delete_status': (main.delete_status, ('status_id',), 'status'),
+    'search_status': (main.search_status, ('status_id',), 'status'),
+    'search_all_status_updates': (main.search_all_status_updates,
+                                  ('user_id',), 'status'),
+    'filter_status_by_string': (main.filter_status_by_string,
+                                ('search_string',), 'status'),
+}
+
+
+def read_operations(filename):
+    '''
+    Yields operation dicts from a .jsonl or .csv file
+    '''
+    with open(filename, 'r', newline='') as file:
+        if filename.endswith('.csv'):
+            for row in csv.DictReader(file):
+                yield {key: value for key, value in row.items() if value}
+        else:
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    # reported as a failed op instead of ending the run
+                    yield {'op': None,
+                           'error': f'line {number}: invalid JSON: {e}'}
+
+
+def to_result(value):
+    '''
+    Turns a facade return value into something JSON serialisable
+    '''
+    if isinstance(value, pw.Model):
+        return dict(value.__data__)
+    if isinstance(value, (pw.BaseQuery, list)) or hasattr(value, '__next__'):
+        return [row.status_id for row in value]
+    return value
+
+
+def run_operation(operation, collections):
+    '''
+    Runs one operation through main.py and returns its result record
+    '''
+    name = operation.get('op')
+    if name not in OPERATIONS:
+        return {'op': name, 'ok': False,
+                'error': operation.get('error', 'unknown op')}
+    func, arg_names, collection = OPERATIONS[name]
+    try:
+        args = [operation[arg] for arg in arg_names]
+    except KeyError as e:
+        return {'op': name, 'ok': False, 'error': f'missing field {e}'}
+    try:
+        # a savepoint, so a failed op leaves nothing half done
+        with sm.db.atomic():
+            result = to_result(func(*args, collections[collection]))
+    except Exception as e:  # pylint: disable=W0703
+        return {'op': name, 'ok': False, 'error': str(e)}
+    return {'op': name, 'ok': result not in (False, None), 'result': result}
+
+
+def run_batch(operations, user_collection, status_collection,
+              batch_size=500, on_result=None):
+    '''
+    Runs operations in transactions of batch_size operations each.
+    on_result, if given, is called with each result record. Returns
+    a summary with counts and ops/sec.
+    '''
+    collections = {'user': user_collection, 'status': status_collection}
+    total = failed = 0
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        nonlocal total, failed
+        records = []
+        try:
+            with sm.db.atomic():
+                for operation in batch:
+                    records.append(run_operation(operation, collections))
+        except Exception as e:  # pylint: disable=W0703
+            # the commit failed, so no op of the batch took effect
+            records = [{'op': operation.get('op'), 'ok': False,
+                        'error': f'batch rolled back: {e}'}
+                       for operation in batch]
+        for record in records:
+            total += 1
+            failed += not record['ok']
+            if on_result is not None:
+                on_result(record)
+        batch.clear()
+
+    try:
+        for operation in operations:
+            batch.append(operation)
+            if len(batch) >= batch_size:
+                flush()
+    finally:
+        # run what was read even if reading the rest failed
+        if batch:
+            flush()
+    elapsed = time.perf_counter() - start
+    summary = {'ops': total, 'failed': failed, 'seconds': elapsed,
+               'ops_per_sec': total / elapsed if elapsed else 0.0}
+    logger.info('Batch run finished: {}', summary)
+    return summary
+
+
+def cli(argv=None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('operations', help='.jsonl or .csv file of operations')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='operations per transaction')
+    parser.add_argument('--results', help='write per-op results (JSONL) here')
+    parser.add_argument('--db', help='database file (default: SOCIALNETWORK_DB'
+                        ' or socialnetwork.db)')
+    args = parser.parse_args(argv)
+
+    if args.db:
+        sm.use_database(args.db)
+    sm.main()
+    user_collection = main.init_user_collection()
+    status_collection = main.init_status_collection()
+    output = open(args.results, 'w') if args.results else None
+    try:
+        summary = run_batch(
+            read_operations(args.operations), user_collection,
+            status_collection, args.batch_size,
+            (lambda record: output.write(json.dumps(record) + '\n'))
+            if output else None)
+    finally:
+        if output:
+            output.close()
+    print(json.dumps(summary))
+    return summary
+
+
+if __name__ == '__main__':
+    sys.exit(0 if cli()['failed'] == 0 else 1)
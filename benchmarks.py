@@ -0,0 +1,724 @@
+'''
+Benchmarks for the social network database layer.
+
+Run one with: python benchmarks.py <name> [rows]
+'''
+import contextlib
+import csv
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import peewee as pw
+import backup
+import changelog
+import main
+import maintenance
+import socialnetwork_model as sm
+import text_index
+import user_status
+
+#pylint: disable=R0903, C0103
+
+ADJECTIVES = ['thinkable', 'stormy', 'troubled', 'rich', 'crowded', 'wee',
+              'rustic', 'naughty', 'afraid', 'beautiful', 'icky', 'foolish',
+              'obtainable', 'parsimonious', 'entertaining', 'sunny']
+NOUNS = ['existence', 'sky', 'cough', 'blade', 'wilderness', 'spade',
+         'step', 'rest', 'basketball', 'eye', 'game', 'coffee', 'team']
+VERBS = ['hug', 'remind', 'deal', 'leave', 'carry', 'conceptualize',
+         'cough', 'carve', 'hurt', 'weep', 'love', 'compile']
+
+
+def make_users(count, seed=0):
+    '''
+    Returns (user_id, name, last_name, email) tuples shaped like accounts.csv
+    '''
+    rng = random.Random(seed)
+    domains = ['goodmail.com', 'funmail.com']
+    rows = []
+    for i in range(count):
+        name = f'Name{i}'
+        user_id = f'{name}.Last{i}'
+        rows.append((user_id, name, f'Last{i}',
+                     f'{user_id}@{rng.choice(domains)}'))
+    return rows
+
+
+def make_statuses(count, user_ids, seed=0):
+    '''
+    Returns (status_id, user_id, status_text) tuples shaped like the
+    100k-status evaluation set
+    '''
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        user_id = user_ids[i % len(user_ids)]
+        text = ' '.join([rng.choice(ADJECTIVES), rng.choice(NOUNS),
+                         rng.choice(VERBS), rng.choice(ADJECTIVES),
+                         rng.choice(NOUNS)])
+        rows.append((f'{user_id}_{i:05d}', user_id, text))
+    return rows
+
+
+def timed(func, *args, **kwargs):
+    '''
+    Returns (result, elapsed seconds) for a single call
+    '''
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def write_csv(path, header, rows):
+    '''
+    Writes rows to a CSV file with a header line
+    '''
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+@contextlib.contextmanager
+def fresh_database(tmp):
+    '''
+    Points the shared model database at a new file in tmp
+    '''
+    original = sm.db.database
+    sm.use_database(os.path.join(tmp, f'bench_{time.perf_counter_ns()}.db'))
+    sm.main()
+    try:
+        yield sm.db
+    finally:
+        sm.use_database(original)
+
+
+def parse_with_models(filename):
+    '''
+    The loaders' original parse step: csv.reader plus a model per row
+    '''
+    with open(filename, newline='') as file:
+        file.readline()
+        return [sm.Status(status_id=row[0], user_id=row[1],
+                          status_text=row[2]) for row in csv.reader(file)]
+
+
+def bench_ingest(rows=100000):
+    '''
+    Times parsing alone and load_users + load_status_updates for the
+    model-per-row loop and each fast ingest parser, each load into a
+    fresh database
+    '''
+    users = make_users(1000)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        users_csv = os.path.join(tmp, 'accounts.csv')
+        status_csv = os.path.join(tmp, 'status.csv')
+        write_csv(users_csv, ['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'], users)
+        write_csv(status_csv, ['STATUS_ID', 'USER_ID', 'STATUS_TEXT'],
+                  statuses)
+        parsers = [None, 'csv', 'block']
+        if main.ingest.pa_csv is not None:
+            parsers.append('arrow')
+        for parser in parsers:
+            if parser is None:
+                _, parse = timed(parse_with_models, status_csv)
+            else:
+                _, parse = timed(lambda: sum(len(batch) for batch in
+                                             main.ingest.read_csv_batches(
+                                                 status_csv, 1000, parser)))
+            with fresh_database(tmp), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                user_collection = main.init_user_collection()
+                status_collection = main.init_status_collection()
+                start = time.perf_counter()
+                main.load_users(users_csv, user_collection, parser=parser)
+                main.load_status_updates(status_csv, status_collection,
+                                         parser=parser)
+                elapsed = time.perf_counter() - start
+                loaded = sm.Status.select().count()
+            results[parser or 'model_loop'] = {
+                'parse_only_s': parse, 'load_s': elapsed, 'rows_per_s': (rows + len(users)) / elapsed,
+                'statuses_loaded': loaded}
+    return results
+
+
+def load_with_insert_many(filename):
+    '''
+    Block parser plus peewee insert_many, for comparison with the raw
+    executemany path
+    '''
+    fields = [sm.Status.status_id, sm.Status.user_id, sm.Status.status_text]
+    with sm.db.atomic():
+        for rows in main.ingest.read_csv_batches(filename, 100, 'block'):
+            sm.Status.insert_many(rows, fields=fields).execute()
+
+
+def bench_loader_cpu(rows=100000):
+    '''
+    CPU time and tracemalloc peak memory per status row for the
+    model-per-row loader, block parsing + insert_many, and the fast
+    loader (block parsing + executemany). tracemalloc tracks live
+    memory rather than allocation counts, so peak bytes per row is
+    reported; CPU is measured in a separate run without tracing.
+    '''
+    users = make_users(1000)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    modes = {
+        'model_loop': lambda name, coll: main.load_status_updates(name, coll),
+        'insert_many': lambda name, coll: load_with_insert_many(name),
+        'fast_executemany': lambda name, coll: main.load_status_updates(
+            name, coll, parser='block')}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        users_csv = os.path.join(tmp, 'accounts.csv')
+        status_csv = os.path.join(tmp, 'status.csv')
+        write_csv(users_csv, ['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'], users)
+        write_csv(status_csv, ['STATUS_ID', 'USER_ID', 'STATUS_TEXT'],
+                  statuses)
+        for label, load in modes.items():
+            figures = {}
+            for traced in (False, True):
+                with fresh_database(tmp), \
+                        contextlib.redirect_stdout(io.StringIO()):
+                    main.load_users(users_csv, main.init_user_collection(),
+                                    parser='block')
+                    status_collection = main.init_status_collection()
+                    if traced:
+                        tracemalloc.start()
+                    start = time.process_time()
+                    load(status_csv, status_collection)
+                    cpu = time.process_time() - start
+                    if traced:
+                        figures['peak_bytes_per_row'] = (
+                            tracemalloc.get_traced_memory()[1] / rows)
+                        tracemalloc.stop()
+                    else:
+                        figures['cpu_us_per_row'] = cpu / rows * 1e6
+                    figures['loaded'] = sm.Status.select().count()
+            results[label] = figures
+    return results
+
+
+def bench_batch_sweep(rows=100000):
+    '''
+    Sweeps rows per INSERT and commit interval for both loader paths
+    and reports load time for each setting plus the fastest one
+    '''
+    users = make_users(1000)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    auto = sm.max_rows_per_insert(3, cap=sm.max_variable_number())
+    settings = [(size, None) for size in (50, 100, 500, 1000, 5000, auto)]
+    settings += [(auto, every) for every in (1000, 10000, 50000)]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        users_csv = os.path.join(tmp, 'accounts.csv')
+        status_csv = os.path.join(tmp, 'status.csv')
+        write_csv(users_csv, ['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'], users)
+        write_csv(status_csv, ['STATUS_ID', 'USER_ID', 'STATUS_TEXT'],
+                  statuses)
+        for parser in (None, 'block'):
+            for batch_size, commit_every in settings:
+                with fresh_database(tmp), \
+                        contextlib.redirect_stdout(io.StringIO()):
+                    main.load_users(users_csv, main.init_user_collection(),
+                                    parser='block')
+                    collection = main.init_status_collection()
+                    _, elapsed = timed(main.load_status_updates, status_csv,
+                                       collection, parser, batch_size,
+                                       commit_every)
+                label = (f'{parser or "model_loop"} batch={batch_size} '
+                         f'commit_every={commit_every}')
+                results[label] = elapsed
+    best = min(results, key=results.get)
+    results['max_variable_number'] = sm.max_variable_number()
+    results['fastest'] = best
+    return results
+
+
+def bench_write_behind(rows=2000):
+    '''
+    Compares one autocommit per add_status with the write-behind
+    buffer flushing every 500 calls or 50 ms
+    '''
+    users = make_users(10)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label in ('per_call_commit', 'write_behind'):
+            with fresh_database(tmp):
+                user_collection = main.init_user_collection()
+                for user in users:
+                    user_collection.add_user(*user)
+                status_collection = main.init_status_collection()
+                start = time.perf_counter()
+                if label == 'write_behind':
+                    writer = main.init_status_writer(status_collection)
+                    futures = [main.add_status(*row, writer)
+                               for row in statuses]
+                    writer.flush()
+                    added = sum(bool(f.result()) for f in futures)
+                    writer.close()
+                else:
+                    added = sum(bool(main.add_status(*row, status_collection))
+                                for row in statuses)
+                elapsed = time.perf_counter() - start
+            results[label] = {'seconds': elapsed, 'added': added,
+                              'ops_per_s': rows / elapsed}
+    return results
+
+
+def bench_compression(rows=100000):
+    '''
+    Compares DB size, estimated cache hit rate and read latency for a
+    plain status_text column against the compressed one.
+
+    The stdlib sqlite3 module does not expose page cache counters, so
+    the hit rate is estimated as cache pages / table pages for uniformly
+    random reads.
+    '''
+    statuses = make_statuses(rows, [u[0] for u in make_users(1000)])
+    trained = sm.train_status_dictionary(s[2] for s in statuses[:1000])
+    results = {}
+    for label, field in (('plain', pw.CharField),
+                         ('compressed', sm.CompressedTextField)):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f'{label}.db')
+            bench_db = pw.SqliteDatabase(path, pragmas={'cache_size': -2000})
+            sm.register_functions(bench_db)
+
+            class BenchStatus(pw.Model):
+                '''
+                Status table under test
+                '''
+                status_id = pw.CharField(primary_key=True, max_length=50)
+                user_id = pw.CharField(max_length=30)
+                status_text = field()
+
+                class Meta:
+                    '''
+                    Meta class statement
+                    '''
+                    database = bench_db
+                    table_name = 'status'
+
+            bench_db.create_tables([BenchStatus])
+            with bench_db.atomic():
+                BenchStatus.insert_many(statuses, fields=[
+                    BenchStatus.status_id, BenchStatus.user_id,
+                    BenchStatus.status_text]).execute()
+            bench_db.execute_sql('VACUUM')
+            page_count = bench_db.execute_sql('PRAGMA page_count').fetchone()[0]
+            cache_pages = 2000 * 1024 // bench_db.execute_sql(
+                'PRAGMA page_size').fetchone()[0]
+
+            sample = random.Random(1).sample(statuses, 1000)
+            _, lookup = timed(lambda: [BenchStatus.get_by_id(s[0]).status_text
+                                       for s in sample])
+            _, scan = timed(lambda: len(list(
+                BenchStatus.select().tuples())))
+            text = pw.fn.status_text_decompress(BenchStatus.status_text)
+            _, search = timed(lambda: BenchStatus.select().where(
+                text.contains('existence')).count())
+            bench_db.close()
+            results[label] = {
+                'db_bytes': os.path.getsize(path),
+                'est_cache_hit_rate': min(1.0, cache_pages / page_count),
+                'lookup_us': lookup / len(sample) * 1e6,
+                'full_scan_s': scan,
+                'like_search_s': search}
+    raw = sum(len(s[2].encode('utf-8')) for s in statuses)
+    results['text_ratio_default_dict'] = sum(
+        len(sm.compress_text(s[2])) for s in statuses) / raw
+    results['text_ratio_trained_dict'] = sum(
+        len(sm.compress_text(s[2], trained)) for s in statuses) / raw
+    return results
+
+
+def bench_startup(runs=5):
+    '''
+    Measures "import menu" in a fresh interpreter, eager versus
+    fast-start. Reports the best wall time and the cumulative
+    -X importtime figure for menu and everything it imports.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, fast in (('eager', '0'), ('fast_start', '1')):
+            env = dict(os.environ, PYTHONPATH=here,
+                       SOCIALNETWORK_FAST_START=fast)
+            walls = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, '-c', 'import menu'],
+                               cwd=tmp, env=env, check=True)
+                walls.append(time.perf_counter() - start)
+            trace = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', 'import menu'],
+                cwd=tmp, env=env, check=True, capture_output=True,
+                text=True).stderr
+            menu_line = [line for line in trace.splitlines()
+                         if line.rstrip().endswith('| menu')][0]
+            results[label] = {'best_wall_ms': min(walls) * 1000,
+                              'menu_import_ms': int(
+                                  menu_line.split('|')[1]) / 1000}
+    return results
+
+
+def run_workload(user_collection, status_collection, users, statuses):
+    '''
+    Adds users and statuses one call at a time, then searches and
+    deletes, the way the unit tests exercise a collection
+    '''
+    for user_id, name, last_name, email in users:
+        main.add_user(user_id, email, name, last_name, user_collection)
+    for row in statuses:
+        main.add_status(*row, status_collection)
+    for status_id, _, _ in statuses[::10]:
+        main.search_status(status_id, status_collection)
+    found = sum(1 for _ in main.filter_status_by_string('stormy sky',
+                                                        status_collection))
+    main.delete_users([u[0] for u in users[::2]], user_collection)
+    return found
+
+
+def bench_storage(rows=5000):
+    '''
+    Runs the same single-call workload against the SQLite and the
+    in-memory storage backends
+    '''
+    users = make_users(50)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        with fresh_database(tmp):
+            collections = (main.init_user_collection(),
+                           main.init_status_collection())
+            found, elapsed = timed(run_workload, *collections, users,
+                                   statuses)
+        results['sqlite'] = {'seconds': elapsed, 'found': found}
+    found, elapsed = timed(run_workload, *main.init_memory_collections(),
+                           users, statuses)
+    results['memory'] = {'seconds': elapsed, 'found': found}
+    results['speedup'] = results['sqlite']['seconds'] / elapsed
+    return results
+
+
+def bench_text_index(rows=100000):
+    '''
+    Compares filter_status_by_string as a LIKE scan and through the
+    inverted index, plus the cost of building, saving and reopening it
+    '''
+    users = make_users(100)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    queries = ['stormy', 'rich coffee', 'wee sky hug', 'basket']
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        with fresh_database(tmp):
+            with sm.db.atomic():
+                sm.Users.insert_many(users, fields=[
+                    sm.Users.user_id, sm.Users.user_name,
+                    sm.Users.user_last_name, sm.Users.user_email]).execute()
+                for batch in pw.chunked(statuses, 1000):
+                    sm.Status.insert_many(batch).execute()
+            scan = main.init_status_collection()
+            index, results['build_s'] = timed(text_index.TextIndex.build)
+            indexed = user_status.UserStatusCollection(text_index=index)
+            for query in queries:
+                expected, like_s = timed(
+                    lambda: list(main.filter_status_by_string(query, scan)))
+                found, index_s = timed(
+                    lambda: list(main.filter_status_by_string(query,
+                                                              indexed)))
+                assert len(found) == len(expected)
+                results[query] = {'rows': len(found), 'like_s': like_s,
+                                  'index_s': index_s}
+            path = os.path.join(tmp, 'status.idx')
+            _, results['save_s'] = timed(index.save, path)
+            reopened, results['open_s'] = timed(text_index.TextIndex.open,
+                                                path)
+            results['stats'] = reopened.stats()
+            reopened.close()
+    return results
+
+
+def bench_changelog(rows=100000):
+    '''
+    Fast-loader time for a status file with and without the change log
+    triggers, and how long a consumer takes to read the log back
+    '''
+    users = make_users(1000)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        users_csv = os.path.join(tmp, 'accounts.csv')
+        status_csv = os.path.join(tmp, 'status.csv')
+        write_csv(users_csv, ['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'], users)
+        write_csv(status_csv, ['STATUS_ID', 'USER_ID', 'STATUS_TEXT'],
+                  statuses)
+        for logged in (False, True):
+            with fresh_database(tmp), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                if logged:
+                    changelog.install()
+                main.load_users(users_csv, main.init_user_collection(),
+                                parser='block')
+                _, seconds = timed(main.load_status_updates, status_csv,
+                                   main.init_status_collection(),
+                                   parser='block')
+                figures = {'load_s': seconds}
+                if logged:
+                    changes, figures['consume_s'] = timed(
+                        lambda: sum(len(batch) for batch in
+                                    main.consume_changes('bench')))
+                    figures['changes'] = changes
+            results['logged' if logged else 'plain'] = figures
+    return results
+
+
+def bench_backup(rows=100000):
+    '''
+    Backup throughput (plain and gzip) and restore time, next to
+    rebuilding the same database by reloading the CSV files
+    '''
+    users = make_users(1000)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        users_csv = os.path.join(tmp, 'accounts.csv')
+        status_csv = os.path.join(tmp, 'status.csv')
+        write_csv(users_csv, ['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'], users)
+        write_csv(status_csv, ['STATUS_ID', 'USER_ID', 'STATUS_TEXT'],
+                  statuses)
+        for parser in (None, 'block'):
+            with fresh_database(tmp), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                main.load_users(users_csv, main.init_user_collection(),
+                                parser=parser)
+                main.load_status_updates(status_csv,
+                                         main.init_status_collection(),
+                                         parser=parser)
+                results[f'reload_{parser or "model_loop"}_s'] = (
+                    time.perf_counter() - start)
+        with fresh_database(tmp), contextlib.redirect_stdout(io.StringIO()):
+            main.load_users(users_csv, main.init_user_collection(), 'block')
+            main.load_status_updates(status_csv,
+                                     main.init_status_collection(), 'block')
+            for name in ('copy.db', 'copy.db.gz'):
+                path = os.path.join(tmp, name)
+                report = backup.backup(path)
+                results[name] = {key: report[key] for key in
+                                 ('file_bytes', 'seconds', 'mb_per_s')}
+        for name in ('copy.db', 'copy.db.gz'):
+            with fresh_database(tmp):
+                report = backup.restore(os.path.join(tmp, name))
+                results[name]['restore_s'] = report['seconds']
+                results[name]['restored_rows'] = sm.Status.select().count()
+    return results
+
+
+def keyed_workload(user_collection, status_collection, user_ids,
+                   status_ids, joined):
+    '''
+    Times point lookups, per-user status fetches reading each status's
+    user, and a statuses-per-user report over a join
+    '''
+    results = {}
+    _, results['search_status_s'] = timed(
+        lambda: [main.search_status(status_id, status_collection)
+                 for status_id in status_ids])
+    _, results['search_user_s'] = timed(
+        lambda: [main.search_user(user_id, user_collection)
+                 for user_id in user_ids])
+    _, results['user_statuses_s'] = timed(
+        lambda: [status.user_id.user_email for user_id in user_ids
+                 for status in main.search_all_status_updates(
+                     user_id, status_collection)])
+    _, results['join_report_s'] = timed(lambda: list(joined.tuples()))
+    return results
+
+
+def bench_keys(rows=100000):
+    '''
+    String primary keys against integer surrogate keys: database size,
+    load time and lookup/join speed on the same data
+    '''
+    users = make_users(1000)
+    statuses = make_statuses(rows, [u[0] for u in users])
+    rng = random.Random(1)
+    status_ids = [row[0] for row in rng.sample(statuses, 5000)]
+    user_ids = [row[0] for row in rng.sample(users, 200)]
+    variants = {'string': (lambda: (main.init_user_collection(),
+                                    main.init_status_collection()),
+                           sm.Users, sm.Status),
+                'integer': (main.init_keyed_collections, sm.KeyedUsers,
+                            sm.KeyedStatus)}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        users_csv = os.path.join(tmp, 'accounts.csv')
+        status_csv = os.path.join(tmp, 'status.csv')
+        write_csv(users_csv, ['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'], users)
+        write_csv(status_csv, ['STATUS_ID', 'USER_ID', 'STATUS_TEXT'],
+                  statuses)
+        for name, (collections, user_model, status_model) in variants.items():
+            with fresh_database(tmp), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                user_collection, status_collection = collections()
+                start = time.perf_counter()
+                main.load_users(users_csv, user_collection, 'block')
+                main.load_status_updates(status_csv, status_collection,
+                                         'block')
+                result = {'load_s': time.perf_counter() - start}
+                sm.db.execute_sql('VACUUM')
+                result['db_bytes'] = maintenance.database_size()['bytes']
+                joined = (user_model
+                          .select(user_model.user_email,
+                                  pw.fn.COUNT(status_model.status_id))
+                          .join(status_model).group_by(user_model.user_id))
+                result.update(keyed_workload(user_collection,
+                                             status_collection, user_ids,
+                                             status_ids, joined))
+                results[name] = result
+    results['size_ratio'] = (results['integer']['db_bytes'] /
+                             results['string']['db_bytes'])
+    return results
+
+
+def bench_multi_get(rows=100000, lookups=1000):
+    '''
+    lookups single-id searches against one search_users/search_statuses
+    call, a tenth of the ids missing
+    '''
+    users = make_users(max(lookups, 1000))
+    statuses = make_statuses(rows, [u[0] for u in users])
+    rng = random.Random(2)
+    user_ids = [u[0] for u in rng.sample(users, lookups - lookups // 10)]
+    status_ids = [s[0] for s in rng.sample(statuses, lookups - lookups // 10)]
+    user_ids += [f'missing{n}' for n in range(lookups // 10)]
+    status_ids += [f'missing{n}' for n in range(lookups // 10)]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        with fresh_database(tmp):
+            with sm.db.atomic():
+                for batch in pw.chunked(users, 1000):
+                    sm.Users.insert_many(batch, fields=[
+                        sm.Users.user_id, sm.Users.user_name,
+                        sm.Users.user_last_name,
+                        sm.Users.user_email]).execute()
+                for batch in pw.chunked(statuses, 1000):
+                    sm.Status.insert_many(batch).execute()
+            user_collection = main.init_user_collection()
+            status_collection = main.init_status_collection()
+            for kind, ids, single, many, collection in (
+                    ('users', user_ids, main.search_user, main.search_users,
+                     user_collection),
+                    ('statuses', status_ids, main.search_status,
+                     main.search_statuses, status_collection)):
+                _, one_by_one = timed(
+                    lambda: [single(item, collection) for item in ids])
+                found, batched = timed(many, ids, collection)
+                results[kind] = {
+                    'single_s': one_by_one, 'batched_s': batched,
+                    'speedup': one_by_one / batched,
+                    'found': sum(value is not None
+                                 for value in found.values())}
+    return results
+
+
+def traced_peak(func):
+    '''
+    Returns (tracemalloc peak MB, seconds) of one call
+    '''
+    tracemalloc.start()
+    try:
+        _, elapsed = timed(func)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6, elapsed
+
+
+def bench_result_memory(rows=1000000):
+    '''
+    Peak Python memory of each search path over rows statuses, reading
+    results whole (len(query), building a list) against counting,
+    streaming and ResultGuard's default caps. One user holds a tenth of
+    the statuses.
+    '''
+    users = make_users(1000)
+    heavy = users[0][0]
+    statuses = make_statuses(rows, [heavy] * 111 + [u[0] for u in users])
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        with fresh_database(tmp):
+            with sm.db.atomic():
+                sm.Users.insert_many(users, fields=[
+                    sm.Users.user_id, sm.Users.user_name,
+                    sm.Users.user_last_name, sm.Users.user_email]).execute()
+                for batch in pw.chunked(statuses, 1000):
+                    sm.Status.insert_many(batch).execute()
+            collection = main.init_status_collection()
+
+            def drain(statuses):
+                return sum(1 for _ in statuses)
+
+            def read_whole(query):
+                len(query)
+                return drain(query)
+
+            def as_list(statuses):
+                return len([(status.status_id, status.status_text)
+                            for status in statuses])
+
+            def guarded(statuses):
+                found, _ = main.collect_statuses(statuses)
+                return len([(status.status_id, status.status_text)
+                            for status in found])
+
+            paths = {
+                'user_len_query': lambda: read_whole(
+                    main.search_all_status_updates(heavy, collection)),
+                'user_count_stream': lambda: (
+                    main.count_status_updates(heavy, collection),
+                    drain(main.stream_status_updates(heavy, collection))),
+                'string_list': lambda: as_list(
+                    main.filter_status_by_string('stormy', collection)),
+                'string_guarded': lambda: guarded(
+                    main.filter_status_by_string('stormy', collection)),
+                'string_stream': lambda: drain(
+                    main.stream_status_by_string('stormy', collection)),
+                'terms_list': lambda: as_list(main.search_status_terms(
+                    (), ['stormy', 'rich'], (), collection)),
+                'terms_guarded': lambda: guarded(main.search_status_terms(
+                    (), ['stormy', 'rich'], (), collection))}
+            for name, path in paths.items():
+                peak_mb, seconds = traced_peak(path)
+                results[name] = {'peak_mb': peak_mb, 'seconds': seconds}
+    return results
+
+
+BENCHMARKS = {'backup': bench_backup,
+              'changelog': bench_changelog,
+              'compression': bench_compression,
+              'ingest': bench_ingest,
+              'keys': bench_keys,
+              'loader_cpu': bench_loader_cpu,
+              'multi_get': bench_multi_get,
+              'batch_sweep': bench_batch_sweep,
+              'result_memory': bench_result_memory,
+              'startup': bench_startup,
+              'storage': bench_storage,
+              'text_index': bench_text_index,
+              'write_behind': bench_write_behind}
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'compression'
+    args = [int(arg) for arg in sys.argv[2:]]
+    for key, value in BENCHMARKS[name](*args).items():
+        print(f'{key}: {value}')
@@ -0,0 +1,269 @@
+'''
+Bloom filter used by the collections to skip database round trips
+for ids that definitely don't exist
+'''
+import math
+import threading
+import time
+from loguru import logger
+import peewee as pw
+
+
+class BloomFilter:
+    '''
+    Fixed-size Bloom filter over string keys.
+    "key in filter" is False only when the key was never added; True
+    means "maybe", so callers still confirm against the database and
+    report misses with record_false_positive.
+    '''
+
+    def __init__(self, capacity=10000, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) /
+                                     math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity *
+                                       math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.maybe_hits = 0
+        self.false_positives = 0
+        # setting bits is a read-modify-write of a whole byte
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_keys(cls, keys, count, error_rate=0.01):
+        '''
+        Builds a filter sized for twice count and adds keys to it
+        '''
+        new_filter = cls(capacity=max(2 * count, 1000), error_rate=error_rate)
+        new_filter.add_many(keys)
+        return new_filter
+
+    def _positions(self, key):
+        # The filter lives only in this process, so the built-in string
+        # hash (randomised per process) is stable enough and much cheaper
+        # than hashlib. Its two 32-bit halves seed double hashing.
+        value = hash(key) & 0xFFFFFFFFFFFFFFFF
+        first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+        size = self.size
+        return [(first + i * second) % size for i in range(self.hash_count)]
+
+    def add(self, key):
+        '''
+        Adds a key to the filter
+        '''
+        bits = self.bits
+        with self._lock:
+            for position in self._positions(key):
+                bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def add_many(self, keys):
+        '''
+        Adds many keys; same as add() in a loop without the per-call
+        overhead
+        '''
+        bits, size, hash_count = self.bits, self.size, self.hash_count
+        added = 0
+        with self._lock:
+            for key in keys:
+                value = hash(key) & 0xFFFFFFFFFFFFFFFF
+                first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+                for i in range(hash_count):
+                    position = (first + i * second) % size
+                    bits[position >> 3] |= 1 << (position & 7)
+                added += 1
+            self.count += added
+
+    def add_missing(self, keys):
+        '''
+        Adds the keys the filter doesn't hold yet, so keys seen again
+        don't count twice towards its capacity. Returns how many were
+        added.
+        '''
+        bits, size, hash_count = self.bits, self.size, self.hash_count
+        added = 0
+        with self._lock:
+            for key in keys:
+                value = hash(key) & 0xFFFFFFFFFFFFFFFF
+                first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+                positions = [(first + i * second) % size
+                             for i in range(hash_count)]
+                if all(bits[position >> 3] & (1 << (position & 7))
+                       for position in positions):
+                    continue
+                for position in positions:
+                    bits[position >> 3] |= 1 << (position & 7)
+                added += 1
+            self.count += added
+        return added
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        self.maybe_hits += 1
+        return True
+
+    def is_full(self):
+        '''
+        True once more keys were added than the filter was sized for
+        '''
+        return self.count > self.capacity
+
+    def record_false_positive(self):
+        '''
+        Records that a "maybe" answer turned out to be a miss
+        '''
+        self.false_positives += 1
+
+    def expected_false_positive_rate(self):
+        '''
+        Theoretical false-positive rate for the current fill
+        '''
+        return (1 - math.exp(-self.hash_count * self.count /
+                             self.size)) ** self.hash_count
+
+    def stats(self):
+        '''
+        Returns size and false-positive figures for reporting
+        '''
+        observed = (self.false_positives / self.maybe_hits
+                    if self.maybe_hits else 0.0)
+        return {'keys': self.count,
+                'capacity': self.capacity,
+                'bits': self.size,
+                'hash_count': self.hash_count,
+                'expected_fp_rate': self.expected_false_positive_rate(),
+                'maybe_hits': self.maybe_hits,
+                'false_positives': self.false_positives,
+                'observed_fp_share': observed}
+
+
+class IdFilterMixin:
+    '''
+    Bloom filter of the ids in self.store, for UserCollection and
+    UserStatusCollection. Ids stored through the collection are added
+    as they are stored; ids inserted elsewhere (another collection,
+    connection or process, raw SQL) are read from the store's insert
+    log at most every check_interval seconds, and the filter is only
+    rebuilt when it can't catch up that way. Between checks a definite
+    miss costs no database access, so a search may not see an id
+    inserted elsewhere for that long; existing_ids always checks.
+    '''
+    # seconds between looks at the insert log on searches
+    check_interval = 0.1
+    # what the ids identify, for log messages
+    noun, nouns = 'Row', 'rows'
+
+    def init_id_filter(self):
+        '''
+        Builds the filter; call once self.store is set
+        '''
+        self.id_filter = None
+        # insert log position the filter holds every id up to
+        self.filter_mark = None
+        self.checked_at = None
+        self._filter_lock = threading.Lock()
+        self.rebuild_id_filter()
+
+    def rebuild_id_filter(self, expected=0):
+        '''
+        Rebuilds the id filter from the database. expected makes room
+        for that many more ids, e.g. before a bulk load.
+        '''
+        store = self.store
+        try:
+            # the position is taken first: ids inserted while the table
+            # is read are added again on the next check
+            mark, _ = store.inserted_since(None)
+            if mark is None:
+                store.track_inserts()
+                mark, _ = store.inserted_since(None)
+            id_filter = BloomFilter.from_keys(store.ids(),
+                                              store.count() + expected)
+        except pw.OperationalError:
+            # table not created yet
+            mark, id_filter = None, BloomFilter.from_keys([], 0)
+        with self._filter_lock:
+            self.id_filter, self.filter_mark = id_filter, mark
+            self.checked_at = time.monotonic()
+        logger.info("{} id filter rebuilt: {}", self.noun,
+                    self.id_filter.stats())
+
+    def remember_ids(self, ids):
+        '''
+        Adds newly stored ids to the filter
+        '''
+        self.id_filter.add_many(ids)
+        if self.id_filter.is_full():
+            self.rebuild_id_filter()
+
+    def refresh_id_filter(self, force=False):
+        '''
+        Adds the ids inserted elsewhere since the last look, unless
+        that was under check_interval seconds ago and force is False
+        '''
+        now = time.monotonic()
+        with self._filter_lock:
+            if not force and now - self.checked_at < self.check_interval:
+                return
+            self.checked_at, mark = now, self.filter_mark
+        mark, ids = self.store.inserted_since(mark)
+        if ids is None:
+            self.rebuild_id_filter()
+            return
+        with self._filter_lock:
+            self.id_filter.add_missing(ids)
+            self.filter_mark = mark
+        if self.id_filter.is_full():
+            self.rebuild_id_filter()
+
+    def existing_ids(self, ids):
+        '''
+        Returns the subset of ids already in the database. Ids the
+        filter rules out are never queried.
+        '''
+        self.refresh_id_filter(force=True)
+        candidates = [row_id for row_id in ids if row_id in self.id_filter]
+        found = self.store.existing(candidates)
+        for _ in range(len(candidates) - len(found)):
+            self.id_filter.record_false_positive()
+        return found
+
+    def search_id(self, row_id):
+        '''
+        Returns the stored row of row_id or None. Logs as its caller;
+        a definite miss is only logged at debug level, as it costs
+        nothing.
+        '''
+        self.refresh_id_filter()
+        if row_id not in self.id_filter:
+            logger.opt(depth=1).debug("{} not found", self.noun)
+            return None
+        found = self.store.get(row_id)
+        if found is None:
+            self.id_filter.record_false_positive()
+            logger.opt(depth=1).warning("{} not found", self.noun)
+            return None
+        logger.opt(depth=1).info("{}_id {} found.", self.noun, row_id)
+        return found
+
+    def search_ids(self, row_ids):
+        '''
+        Returns {id: row} with None for ids not found, logging as its
+        caller. Ids the filter rules out are never queried; the rest
+        are fetched in a few IN queries.
+        '''
+        row_ids = list(dict.fromkeys(row_ids))
+        self.refresh_id_filter()
+        candidates = [row_id for row_id in row_ids
+                      if row_id in self.id_filter]
+        found = self.store.get_many(candidates)
+        for _ in range(len(candidates) - len(found)):
+            self.id_filter.record_false_positive()
+        logger.opt(depth=1).info("{} of {} {} found", len(found),
+                                 len(row_ids), self.nouns)
+        return {row_id: found.get(row_id) for row_id in row_ids}
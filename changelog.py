@@ -0,0 +1,192 @@
+'''
+Change-data-capture feed of user and status mutations
+'''
+# pylint: disable=R0903, E0401
+import json
+from loguru import logger
+import peewee as pw
+from playhouse.sqlite_ext import AutoIncrementField
+import socialnetwork_model as sm
+
+
+class ChangeLog(sm.BaseModel):
+    '''
+    One insert, update or delete on the users or status table, written
+    by triggers, so every write path (collections, bulk loaders, FK
+    cascades) is captured. AUTOINCREMENT keeps seq from being reused
+    after the log is pruned.
+    '''
+    seq = AutoIncrementField()
+    table_name = pw.CharField(max_length=10)
+    operation = pw.CharField(max_length=6)
+    row_id = pw.CharField(max_length=50)
+    data = pw.TextField(null=True)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'change_log'
+
+
+class ChangeConsumer(sm.BaseModel):
+    '''
+    Last seq a named downstream consumer has processed
+    '''
+    name = pw.CharField(primary_key=True, max_length=50)
+    seq = pw.IntegerField(default=0)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'change_consumer'
+
+
+def _row_json(prefix):
+    return {
+        'users': (f"json_object('user_id', {prefix}.user_id, "
+                  f"'user_name', {prefix}.user_name, "
+                  f"'user_last_name', {prefix}.user_last_name, "
+                  f"'user_email', {prefix}.user_email)", 'user_id'),
+        # the log holds plain text even when status_text is compressed
+        'status': (f"json_object('status_id', {prefix}.status_id, "
+                   f"'user_id', {prefix}.user_id, 'status_text', "
+                   + (f'status_text_decompress({prefix}.status_text))'
+                      if sm.COMPRESS_STATUS else f'{prefix}.status_text)'),
+                   'status_id')}
+
+
+def change_triggers():
+    '''
+    Returns {trigger name: CREATE TRIGGER statement} for the change log
+    '''
+    triggers = {}
+    for table in ('users', 'status'):
+        new_data, key = _row_json('NEW')[table]
+        for operation, event, row, data in (
+                ('insert', 'INSERT', 'NEW', new_data),
+                ('update', 'UPDATE', 'NEW', new_data),
+                ('delete', 'DELETE', 'OLD', 'NULL')):
+            name = f'{table}_change_{operation}'
+            triggers[name] = (
+                f'CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} '
+                f'BEGIN INSERT INTO change_log '
+                f'(table_name, operation, row_id, data) VALUES '
+                f"('{table}', '{operation}', {row}.{key}, {data}); END")
+    return triggers
+
+
+def install(database=sm.db):
+    '''
+    Creates the change log tables and the triggers feeding them. Safe
+    to call repeatedly; changes before the first install aren't logged.
+    '''
+    database.create_tables([ChangeLog, ChangeConsumer])
+    for trigger in change_triggers().values():
+        database.execute_sql(trigger)
+    return True
+
+
+def uninstall(database=sm.db):
+    '''
+    Drops the triggers and the change log tables
+    '''
+    for name in change_triggers():
+        database.execute_sql(f'DROP TRIGGER IF EXISTS {name}')
+    database.drop_tables([ChangeConsumer, ChangeLog])
+    return True
+
+
+def latest_seq():
+    '''
+    Returns the newest seq in the log, 0 when it is empty
+    '''
+    return ChangeLog.select(pw.fn.COALESCE(pw.fn.MAX(ChangeLog.seq), 0)
+                            ).scalar()
+
+
+def to_change(row):
+    '''
+    Turns a change_log row tuple into a dict with the row data decoded
+    '''
+    seq, table, operation, row_id, data = row
+    return {'seq': seq, 'table': table, 'operation': operation,
+            'row_id': row_id, 'data': None if data is None else json.loads(data)}
+
+
+def changes_since(seq=0, batch_size=1000):
+    '''
+    Returns up to batch_size changes with a seq above seq, oldest first
+    '''
+    return [to_change(row) for row in
+            ChangeLog.select(ChangeLog.seq, ChangeLog.table_name,
+                             ChangeLog.operation, ChangeLog.row_id,
+                             ChangeLog.data)
+            .where(ChangeLog.seq > seq).order_by(ChangeLog.seq)
+            .limit(batch_size).tuples()]
+
+
+def stream_changes(seq=0, batch_size=1000):
+    '''
+    Yields lists of at most batch_size changes after seq until caught
+    up, one query per batch
+    '''
+    while True:
+        batch = changes_since(seq, batch_size)
+        if batch:
+            yield batch
+            seq = batch[-1]['seq']
+        if len(batch) < batch_size:
+            return
+
+
+class Consumer:
+    '''
+    A named reader of the change log whose position is stored in the
+    database. batches() resumes after the last acknowledged change, so
+    each change is delivered at least once across restarts.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        install()
+        ChangeConsumer.insert(name=name).on_conflict_ignore().execute()
+
+    @property
+    def seq(self):
+        '''
+        Last acknowledged seq
+        '''
+        return ChangeConsumer.get_by_id(self.name).seq
+
+    def acknowledge(self, seq):
+        '''
+        Records that every change up to seq has been processed
+        '''
+        ChangeConsumer.update(seq=seq).where(
+            (ChangeConsumer.name == self.name) &
+            (ChangeConsumer.seq < seq)).execute()
+
+    def batches(self, batch_size=1000):
+        '''
+        Yields batches of new changes until caught up. A batch is
+        acknowledged when the next one is requested, so stopping
+        mid-batch redelivers it next time.
+        '''
+        for batch in stream_changes(self.seq, batch_size):
+            yield batch
+            self.acknowledge(batch[-1]['seq'])
+        logger.info('Change consumer {} caught up at {}', self.name,
+                    self.seq)
+
+
+def prune():
+    '''
+    Deletes changes every consumer has acknowledged. Without consumers
+    nothing is pruned.
+    '''
+    oldest = ChangeConsumer.select(pw.fn.MIN(ChangeConsumer.seq)).scalar()
+    if oldest is None:
+        return 0
+    return ChangeLog.delete().where(ChangeLog.seq <= oldest).execute()
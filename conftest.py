@@ -0,0 +1,38 @@
+'''
+pytest setup for test_main.py.
+
+Every test starts from the same empty schema: the tables are created
+once per test process into an in-memory template, which is copied over
+the process's database before each test with the SQLite backup API.
+The database is chosen per process by socialnetwork_model.database_path,
+so under pytest-xdist (pytest -n 4) each worker has its own, and
+
+    SOCIALNETWORK_DB='file:socialnetwork?mode=memory&cache=shared' pytest
+
+runs the suite without touching the disk.
+'''
+import sqlite3
+import pytest
+import socialnetwork_model as sm
+
+
+@pytest.fixture(scope='session')
+def template_database():
+    '''
+    An in-memory copy of a database holding just the empty tables
+    '''
+    sm.main()
+    template = sqlite3.connect(':memory:')
+    sm.db.connection().backup(template)
+    yield template
+    template.close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_database(template_database):
+    '''
+    Resets this process's database to the template before each test
+    '''
+    sm.db.close()
+    template_database.backup(sm.db.connection())
+    yield sm.db
@@ -0,0 +1,120 @@
+'''
+Fast CSV parsing for the bulk loaders
+'''
+import csv
+import io
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
+
+BLOCK_SIZE = 1 << 20
+
+
+def parse_block(chunk):
+    '''
+    Splits a block of complete CSV lines into row tuples. Blocks
+    without quotes are split directly; quoted ones go through csv.
+    Lines end at LF or CRLF only, as for csv: str.splitlines would
+    also break them at form feeds and other Unicode line breaks in the
+    text.
+    '''
+    text = chunk.decode('utf-8')
+    if '"' in text:
+        return [tuple(row) for row in csv.reader(io.StringIO(text)) if row]
+    return [tuple(line.split(','))
+            for line in text.replace('\r\n', '\n').split('\n') if line]
+
+
+def iter_csv_blocks(filename, start=None, block_size=BLOCK_SIZE):
+    '''
+    Reads a CSV file in large binary blocks and yields
+    (rows, end_offset) pairs, where end_offset is the byte offset just
+    past the last row in rows. The header is skipped when start is
+    None; otherwise reading resumes at byte offset start.
+    '''
+    with open(filename, 'rb') as file:
+        if start is None:
+            file.readline()
+        else:
+            file.seek(start)
+        offset = file.tell()
+        pending = b''
+        while True:
+            block = file.read(block_size)
+            data = pending + block
+            if not data:
+                break
+            if block:
+                cut = data.rfind(b'\n') + 1
+                # never split a quoted field that contains a newline
+                while cut and data.count(b'"', 0, cut) % 2:
+                    cut = data.rfind(b'\n', 0, cut - 1) + 1
+                if not cut:
+                    pending = data
+                    continue
+                chunk, pending = data[:cut], data[cut:]
+            else:
+                chunk, pending = data, b''
+            offset += len(chunk)
+            yield parse_block(chunk), offset
+
+
+def iter_arrow_rows(filename, block_size=BLOCK_SIZE):
+    '''
+    Yields row tuples per record batch using pyarrow's CSV reader.
+    Every column is read as a string, so ids like 007 keep their zeros,
+    and quoted values may span lines.
+    '''
+    with open(filename, 'r', newline='', encoding='utf-8') as file:
+        header = next(csv.reader(file), [])
+    reader = pa_csv.open_csv(
+        filename, read_options=pa_csv.ReadOptions(block_size=block_size),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in header},
+            strings_can_be_null=False))
+    for batch in reader:
+        columns = [column.to_pylist() for column in batch.columns]
+        yield list(zip(*columns))
+
+
+def read_csv_batches(filename, batch_size=1000, parser='auto'):
+    '''
+    Yields lists of at most batch_size row tuples, ready for
+    insert_many(rows, fields=...). parser is 'arrow' (needs pyarrow),
+    'block' (binary block splitting), 'csv' (the csv module) or 'auto'
+    (block; arrow is opt-in).
+    '''
+    if parser == 'auto':
+        parser = 'block'
+    if parser == 'arrow':
+        batches = iter_arrow_rows(filename)
+    elif parser == 'block':
+        batches = (rows for rows, _ in iter_csv_blocks(filename))
+    elif parser == 'csv':
+        batches = iter_csv_module(filename, batch_size)
+    else:
+        raise ValueError(f'Unknown CSV parser {parser}')
+    for rows in batches:
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+
+def iter_csv_module(filename, batch_size):
+    '''
+    Reference path using csv.reader
+    '''
+    with open(filename, 'r', newline='') as file:
+        file.readline()
+        rows = []
+        for row in csv.reader(file):
+            if row:
+                rows.append(tuple(row))
+            if len(rows) == batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
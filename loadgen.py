@@ -0,0 +1,362 @@
+'''
+Replays production traffic recorded in the loguru logs against main.py.
+
+    python loadgen.py log_2021-02-06.log --workers 4 --speed 60
+
+Each users/user_status log line becomes one operation of a trace,
+keeping its time offset and whether it succeeded (INFO) or failed
+(WARNING, or a "not found" line at any level): a "User not found" line
+is a search_user miss, a "Status not added" line an add_status of a
+duplicate id. The logs don't record the arguments, so the replay
+makes up ids that reproduce each outcome: a miss searches an id never
+stored, a duplicate reuses a stored one.
+
+Operations are handed to --workers threads at the original pace sped
+up --speed times (0: as fast as possible), with idle gaps capped at
+--max-gap seconds. The report gives latency percentiles, error and
+mismatch rates per operation and overall, where an error is an
+exception (e.g. database is locked) and a mismatch an outcome other
+than the logged one.
+'''
+import argparse
+import datetime
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from loguru import logger
+
+if __name__ == '__main__' and any(arg == '--db' or arg.startswith('--db=')
+                                  for arg in sys.argv[1:]):
+    # the model module would empty the default database on import,
+    # before cli() points it at --db; only the command line sets this
+    os.environ.setdefault('SOCIALNETWORK_KEEP_DB', '1')
+import batch  # pylint: disable=C0413
+import main  # pylint: disable=C0413
+import socialnetwork_model as sm  # pylint: disable=C0413
+
+#pylint: disable=C0103
+
+# 2021-02-06 16:09:01.586 | WARNING  | users:search_user:72 - User not found
+LINE = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d+) \| (\w+)\s*\| '
+                  r'(\w+):(\w+):\d+ - ')
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# searches the id filter answers log their misses at DEBUG
+MISSES = ('User not found', 'Status not found')
+
+# (logging module, function) -> operation replayed
+TRACED = {('users', 'add_user'): 'add_user',
+          ('users', 'modify_user'): 'update_user',
+          ('users', 'delete_user'): 'delete_user',
+          ('users', 'search_user'): 'search_user',
+          ('user_status', 'add_status'): 'add_status',
+          ('user_status', 'modify_status'): 'update_status',
+          ('user_status', 'delete_status'): 'delete_status',
+          ('user_status', 'search_status'): 'search_status',
+          ('user_status', 'search_all_status_updates'):
+              'search_all_status_updates'}
+
+
+def parse_log(lines):
+    '''
+    Returns the trace of a log: a list of {'at': seconds since the
+    first operation, 'op': operation name, 'ok': logged outcome}.
+    Lines of other functions (e.g. main:load_users) are skipped.
+    '''
+    trace = []
+    first = None
+    for line in lines:
+        match = LINE.match(line)
+        if match is None:
+            continue
+        stamp, level, module, function = match.groups()
+        op = TRACED.get((module, function))
+        if op is None:
+            continue
+        moment = datetime.datetime.strptime(stamp, TIME_FORMAT)
+        first = first or moment
+        ok = (level not in ('WARNING', 'ERROR') and
+              not line[match.end():].startswith(MISSES))
+        trace.append({'at': (moment - first).total_seconds(), 'op': op,
+                      'ok': ok})
+    return trace
+
+
+def read_trace(filename):
+    '''
+    Parses a log file into a trace
+    '''
+    with open(filename, 'r', encoding='utf-8', errors='replace') as file:
+        return parse_log(file)
+
+
+def schedule(trace, speed=1.0, max_gap=None):
+    '''
+    Returns the replay start time of each operation in seconds: the
+    logged offsets divided by speed, gaps first capped at max_gap
+    seconds. A speed of 0 starts everything at once.
+    '''
+    starts = []
+    due = previous = 0.0
+    for operation in trace:
+        gap = max(0.0, operation['at'] - previous)
+        previous = operation['at']
+        if max_gap is not None:
+            gap = min(gap, max_gap)
+        if speed:
+            due += gap / speed
+        starts.append(due)
+    return starts
+
+
+class IdPool:
+    '''
+    Thread-safe set of ids known to be stored, with random picks
+    '''
+
+    def __init__(self, ids=()):
+        self._lock = threading.Lock()
+        self._ids = []
+        self._positions = {}
+        for item in ids:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, item):
+        '''
+        Adds a stored id
+        '''
+        with self._lock:
+            if item not in self._positions:
+                self._positions[item] = len(self._ids)
+                self._ids.append(item)
+
+    def take(self, remove=False):
+        '''
+        Returns a random stored id (None if there are none), optionally
+        removing it so no other worker picks it again
+        '''
+        with self._lock:
+            if not self._ids:
+                return None
+            item = random.choice(self._ids)
+            if remove:
+                last = self._ids.pop()
+                if last != item:
+                    self._ids[self._positions[item]] = last
+                    self._positions[last] = self._positions[item]
+                del self._positions[item]
+            return item
+
+
+class Replayer:
+    '''
+    Turns trace entries into batch.py operation dicts with made-up
+    arguments that reproduce the logged outcome, tracking which ids
+    are stored as it goes
+    '''
+
+    def __init__(self, user_ids=(), status_ids=(), prefix='lg'):
+        self.users = IdPool(user_ids)
+        self.statuses = IdPool(status_ids)
+        self.prefix = prefix
+        self._counter = itertools.count()
+
+    def new_id(self, kind):
+        '''
+        Returns an id that has never been stored
+        '''
+        return f'{self.prefix}_{kind}{next(self._counter):07d}'
+
+    def seed(self, user_collection, status_collection, users=100,
+             statuses_per_user=3):
+        '''
+        Stores users and statuses for hits and duplicates to refer to
+        '''
+        with sm.db.atomic():
+            for _ in range(users):
+                user_id = self.new_id('u')
+                main.add_user(user_id, f'{user_id}@example.com', 'Load',
+                              'Generator', user_collection)
+                self.users.add(user_id)
+                for _ in range(statuses_per_user):
+                    status_id = self.new_id('s')
+                    main.add_status(status_id, user_id, 'replayed status',
+                                    status_collection)
+                    self.statuses.add(status_id)
+
+    def _user(self, existing, remove=False):
+        user_id = self.users.take(remove) if existing else None
+        return user_id or self.new_id('u')
+
+    def _status(self, existing, remove=False):
+        status_id = self.statuses.take(remove) if existing else None
+        return status_id or self.new_id('s')
+
+    def operation(self, entry):
+        '''
+        Returns the operation dict for a trace entry
+        '''
+        op, ok = entry['op'], entry['ok']
+        if op in ('add_user', 'update_user'):
+            user_id = self._user(existing=(op == 'update_user') == ok)
+            return {'op': op, 'user_id': user_id,
+                    'email': f'{user_id}@example.com',
+                    'user_name': 'Load', 'user_last_name': 'Generator'}
+        if op in ('search_user', 'search_all_status_updates'):
+            return {'op': op, 'user_id': self._user(existing=ok)}
+        if op == 'delete_user':
+            return {'op': op, 'user_id': self._user(ok, remove=True)}
+        if op in ('add_status', 'update_status'):
+            return {'op': op,
+                    'status_id': self._status(
+                        existing=(op == 'update_status') == ok),
+                    'user_id': self._user(existing=True),
+                    'status_text': 'replayed status'}
+        if op == 'delete_status':
+            return {'op': op, 'status_id': self._status(ok, remove=True)}
+        return {'op': op, 'status_id': self._status(existing=ok)}
+
+    def stored(self, operation, record):
+        '''
+        Adds the ids a successful add created to the pools
+        '''
+        if record['ok'] and operation['op'] == 'add_user':
+            self.users.add(operation['user_id'])
+        elif record['ok'] and operation['op'] == 'add_status':
+            self.statuses.add(operation['status_id'])
+
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(samples):
+    '''
+    Returns counts, rates and latency percentiles (ms) of samples
+    '''
+    latencies = sorted(sample['latency'] * 1000 for sample in samples)
+    count = len(samples)
+    errors = sum('error' in sample for sample in samples)
+    mismatches = sum(sample['mismatch'] for sample in samples)
+    return {'count': count, 'errors': errors,
+            'error_rate': errors / count if count else 0.0,
+            'mismatches': mismatches,
+            'mismatch_rate': mismatches / count if count else 0.0,
+            'p50_ms': percentile(latencies, 0.50),
+            'p90_ms': percentile(latencies, 0.90),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': latencies[-1] if latencies else None}
+
+
+def replay(trace, user_collection, status_collection, workers=4, speed=1.0,
+           max_gap=None, replayer=None):
+    '''
+    Replays trace through main.py with workers threads and returns the
+    report. Each thread uses its own SQLite connection, so an in-memory
+    database must be a shared-cache URI for the workers to see it.
+    '''
+    replayer = replayer or Replayer()
+    collections = {'user': user_collection, 'status': status_collection}
+    tasks = queue.Queue()
+    for entry, due in zip(trace, schedule(trace, speed, max_gap)):
+        tasks.put((entry, due))
+    samples = []
+    start = time.perf_counter()
+
+    def work():
+        try:
+            while True:
+                try:
+                    entry, due = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                wait = start + due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                operation = replayer.operation(entry)
+                began = time.perf_counter()
+                record = batch.run_operation(operation, collections)
+                sample = {'op': entry['op'],
+                          'latency': time.perf_counter() - began,
+                          'lag': began - start - due,
+                          'mismatch': ('error' not in record and
+                                       record['ok'] != entry['ok'])}
+                if 'error' in record:
+                    sample['error'] = record['error']
+                replayer.stored(operation, record)
+                samples.append(sample)
+        finally:
+            if not sm.db.is_closed():
+                sm.db.close()
+
+    threads = [threading.Thread(target=work, name=f'loadgen-{number}')
+               for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    report = {'workers': workers, 'speed': speed, 'seconds': elapsed,
+              'ops_per_sec': len(samples) / elapsed if elapsed else 0.0,
+              'max_lag_ms': max((sample['lag'] * 1000 for sample in samples),
+                                default=0.0),
+              'overall': summarize(samples), 'by_op': {}}
+    for op in sorted({sample['op'] for sample in samples}):
+        report['by_op'][op] = summarize([sample for sample in samples
+                                         if sample['op'] == op])
+    errors = sorted({sample['error'] for sample in samples
+                     if 'error' in sample})
+    if errors:
+        report['error_messages'] = errors[:10]
+    logger.info('Load replay finished: {}', report['overall'])
+    return report
+
+
+def cli(argv=None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('logs', nargs='+', help='loguru log files to replay')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='concurrent worker threads')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay rate relative to the log, 0 = flat out')
+    parser.add_argument('--max-gap', type=float,
+                        help='cap idle gaps in the log at this many seconds')
+    parser.add_argument('--seed-users', type=int, default=100,
+                        help='users (with 3 statuses each) stored first')
+    parser.add_argument('--db', help='database file (default: SOCIALNETWORK_DB'
+                        ' or socialnetwork.db)')
+    args = parser.parse_args(argv)
+
+    if args.db:
+        sm.use_database(args.db)
+    trace = [entry for filename in args.logs for entry in read_trace(filename)]
+    sm.main()
+    user_collection = main.init_user_collection()
+    status_collection = main.init_status_collection()
+    replayer = Replayer()
+    replayer.seed(user_collection, status_collection, args.seed_users)
+    report = replay(trace, user_collection, status_collection, args.workers,
+                    args.speed, args.max_gap, replayer)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    cli()
@@ -2,8 +2,16 @@
 This file stitches together functions from users and user_status objects.
 '''
 import csv
+import os
+from operator import attrgetter, itemgetter
 from os import path
 from loguru import logger
+import changelog
+import ingest
+import moderation
+import status_buffer
+import storage
+import text_index as search_index
 import users
 import user_status
 import socialnetwork_model as snm
@@ -11,22 +19,69 @@ import socialnetwork_model as snm
 # user.none needs to be changed to none
 
 #pylint: disable=C0103
-def init_user_collection():
+def init_user_collection(store=None):
     '''
     Creates and returns a new instance
-    of UserCollection
+    of UserCollection, kept in store (see storage.py; SQLite by default)
     '''
-    new_collection = users.UserCollection()
+    new_collection = users.UserCollection(store)
     return new_collection
 
-def init_status_collection():
+def init_status_collection(read_replica=False, store=None, text_index=None):
     '''
     Creates and returns a new instance
-    of UserStatusCollection
+    of UserStatusCollection. With read_replica=True its searches are
+    served from a read-only snapshot of the database. store works as
+    for init_user_collection.
+
+    text_index=True builds an inverted index of the status text for
+    filter_status_by_string; a file path loads the index saved there
+    by save_text_index (rebuilding it if the file is missing or stale).
     '''
-    new_collection = user_status.UserStatusCollection()
+    replica = snm.ReadReplica() if read_replica else None
+    if text_index is True:
+        text_index = search_index.TextIndex.build()
+    elif text_index:
+        text_index = search_index.TextIndex.open(text_index)
+    new_collection = user_status.UserStatusCollection(replica, store,
+                                                      text_index or None)
     return new_collection
 
+def save_text_index(status_collection, filename):
+    '''
+    Saves the collection's text index so the next start can map it
+    instead of reading the whole status table
+    '''
+    return status_collection.text_index.save(filename)
+
+def init_memory_collections():
+    '''
+    Returns a (UserCollection, UserStatusCollection) pair kept in
+    memory instead of SQLite, for tests and throwaway workloads
+    '''
+    user_store, status_store = storage.memory_stores()
+    return (init_user_collection(user_store),
+            init_status_collection(store=status_store))
+
+def init_keyed_collections():
+    '''
+    Returns a (UserCollection, UserStatusCollection) pair kept in the
+    SQLite tables with integer surrogate keys (see storage.py); ids are
+    still passed and returned as strings
+    '''
+    user_store, status_store = storage.keyed_stores()
+    return (init_user_collection(user_store),
+            init_status_collection(store=status_store))
+
+def init_status_writer(status_collection, max_ops=500, max_delay_ms=50):
+    '''
+    Creates a write-behind buffer for status_collection. It can be
+    passed to add_status/update_status in place of the collection;
+    those then return Futures.
+    '''
+    return status_buffer.BufferedStatusWriter(status_collection, max_ops,
+                                              max_delay_ms)
+
 def add_user(user_id, email, user_name, user_last_name, user_collection):
     '''
     Creates a new instance of User and stores it in user_collection
@@ -35,7 +90,136 @@ def add_user(user_id, email, user_name, user_last_name, user_collection):
     return user_collection.add_user(user_id, email,
                                     user_name, user_last_name)
 
-def load_users(filename, user_collection):
+def skip_existing(records, record_key, collection):
+    '''
+    Drops records whose id is already stored or repeated earlier in the
+    file. The collection's Bloom filter keeps definitely-new ids from
+    costing a database lookup.
+    '''
+    seen = collection.existing_ids([record_key(record) for record in records])
+    new_records = []
+    for record in records:
+        record_id = record_key(record)
+        if record_id in seen:
+            logger.info('Skipping existing id {}', record_id)
+            continue
+        seen.add(record_id)
+        new_records.append(record)
+    logger.opt(lazy=True).info('Id filter: {}', collection.id_filter.stats)
+    return new_records
+
+def create_records(collection, records, batch_size, commit_every):
+    '''
+    bulk_creates model records batch_size rows per INSERT, committing
+    every commit_every rows (one transaction when None)
+    '''
+    step = commit_every or len(records) or 1
+    for start in range(0, len(records), step):
+        with collection.store.atomic():
+            collection.store.bulk_create(records[start:start + step],
+                                         batch_size)
+
+def insert_rows(filename, collection, fields, parser, batch_size,
+                commit_every):
+    '''
+    Fast loader path: parses the file in blocks with the chosen
+    ingest parser and inserts the row tuples directly, with no model
+    objects or per-row logging. Commits every commit_every rows, or
+    once at the end when None. Returns False if any row has the wrong
+    number of columns; rows committed before that stay loaded.
+    '''
+    width = len(fields)
+    # size the id filter for the file up front (rows are rarely under 40
+    # bytes) so it isn't rebuilt from the table over and over mid-load
+    estimated_rows = path.getsize(filename) // 40
+    id_filter = collection.id_filter
+    if id_filter.count + estimated_rows > id_filter.capacity:
+        collection.rebuild_id_filter(expected=estimated_rows)
+    batches = ingest.read_csv_batches(filename, batch_size, parser)
+    finished = False
+    try:
+        while not finished:
+            with collection.store.atomic():
+                loaded = 0
+                for rows in batches:
+                    if any(len(row) != width for row in rows):
+                        raise ValueError(f'Malformed row in {filename}')
+                    rows = skip_existing(rows, itemgetter(0), collection)
+                    collection.store.insert_tuples(fields, rows)
+                    collection.remember_ids(row[0] for row in rows)
+                    loaded += len(rows)
+                    if commit_every and loaded >= commit_every:
+                        break
+                else:
+                    finished = True
+    except ValueError as e:
+        logger.info(e)
+        return False
+    return True
+
+def insert_rows_resumable(filename, collection, fields, batch_size,
+                          commit_every):
+    '''
+    Like insert_rows, but records the byte offset of each commit in
+    ingest_checkpoint together with the file's size/mtime. Run again
+    on the same unchanged file, it seeks straight to that offset;
+    a finished file is not read again, and a changed one is loaded
+    from the start. Commits at the first block boundary after every
+    commit_every rows, or after every block when None. The checkpoint
+    lives in SQLite, so this is only useful for SQLite stores.
+    '''
+    snm.db.create_tables([snm.IngestCheckpoint])
+    file_stat = os.stat(filename)
+    fingerprint = (file_stat.st_size, file_stat.st_mtime_ns)
+    checkpoint, _ = snm.IngestCheckpoint.get_or_create(
+        file_path=path.abspath(filename),
+        defaults={'file_size': fingerprint[0], 'file_mtime': fingerprint[1]})
+    if (checkpoint.file_size, checkpoint.file_mtime) != fingerprint:
+        logger.info('{} changed since its last load, starting over', filename)
+        checkpoint.file_size, checkpoint.file_mtime = fingerprint
+        checkpoint.byte_offset = 0
+        checkpoint.done = False
+        checkpoint.save()
+    if checkpoint.done:
+        logger.info('{} was already loaded', filename)
+        return True
+    start = checkpoint.byte_offset or None
+    if start:
+        logger.info('Resuming {} at byte {}', filename, start)
+    estimated_rows = (fingerprint[0] - checkpoint.byte_offset) // 40
+    id_filter = collection.id_filter
+    if id_filter.count + estimated_rows > id_filter.capacity:
+        collection.rebuild_id_filter(expected=estimated_rows)
+    width = len(fields)
+    blocks = ingest.iter_csv_blocks(filename, start, ingest.BLOCK_SIZE)
+    finished = False
+    try:
+        while not finished:
+            with snm.db.atomic():
+                loaded = 0
+                for rows, offset in blocks:
+                    if any(len(row) != width for row in rows):
+                        raise ValueError(f'Malformed row in {filename}')
+                    rows = skip_existing(rows, itemgetter(0), collection)
+                    for first in range(0, len(rows), batch_size):
+                        collection.store.insert_tuples(
+                            fields, rows[first:first + batch_size])
+                    collection.remember_ids(row[0] for row in rows)
+                    checkpoint.byte_offset = offset
+                    loaded += len(rows)
+                    if not commit_every or loaded >= commit_every:
+                        break
+                else:
+                    finished = True
+                    checkpoint.done = True
+                checkpoint.save()
+    except ValueError as e:
+        logger.info(e)
+        return False
+    return True
+
+def load_users(filename, user_collection, parser=None, batch_size=None,
+               commit_every=None, resumable=False):
     '''
     Opens a CSV file with user data and
     adds it to an existing instance of
@@ -48,7 +232,21 @@ def load_users(filename, user_collection):
     - Returns False if there are any errors
     (such as empty fields in the source CSV file)
     - Otherwise, it returns True.
+
+    parser selects the fast ingest path ('auto', 'arrow', 'block' or
+    'csv', see ingest.read_csv_batches); None keeps the model-per-row
+    loop.
+
+    batch_size is rows per INSERT (default: as many as SQLite's
+    variable limit allows for the table); commit_every commits after
+    that many rows instead of once for the whole file.
+
+    resumable=True uses the block parser and records a checkpoint with
+    each commit, so a load that failed part way through continues from
+    its last commit when called again (see insert_rows_resumable).
     '''
+    if batch_size is None:
+        batch_size = snm.max_rows_per_insert(4)
 
     if path.isfile(filename):
         print('File exists')
@@ -58,6 +256,16 @@ def load_users(filename, user_collection):
         logger.info(f'{filename} does not exist.')
         return False
 
+    database = user_collection.database
+    fields = [database.user_id, database.user_name,
+              database.user_last_name, database.user_email]
+    if resumable:
+        return insert_rows_resumable(filename, user_collection, fields,
+                                     batch_size, commit_every)
+    if parser is not None:
+        return insert_rows(filename, user_collection, fields, parser,
+                           batch_size, commit_every)
+
     with open(filename, 'r') as file:
         #reads the header
         file.readline()
@@ -78,10 +286,11 @@ def load_users(filename, user_collection):
         #logger.info(type(user_collection.database))
         logger.info('Created user list from file')
         #logger.info(user_lst[0])
+    user_lst = skip_existing(user_lst, attrgetter('user_id'), user_collection)
     try:
-        with snm.db.atomic():
-            user_collection.database.bulk_create(user_lst, batch_size=100)
-            logger.info('User table created.')
+        create_records(user_collection, user_lst, batch_size, commit_every)
+        logger.info('User table created.')
+        user_collection.remember_ids(user.user_id for user in user_lst)
     except TypeError as e:
         logger.info('Error creating user table')
         logger.info(e)
@@ -106,12 +315,18 @@ def add_status(status_id, user_id, status_text, status_collection):
     '''
     return status_collection.add_status(status_id, user_id, status_text)
 
-def load_status_updates(filename, status_collection):
+def load_status_updates(filename, status_collection, parser=None,
+                        batch_size=None, commit_every=None, resumable=False):
     '''
     Opens a CSV file with status data and
     adds it to an existing instance of
     UserStatusCollection
+
+    parser, batch_size, commit_every and resumable work as for
+    load_users.
     '''
+    if batch_size is None:
+        batch_size = snm.max_rows_per_insert(3)
 
     if path.isfile(filename):
         print('File exists')
@@ -121,6 +336,15 @@ def load_status_updates(filename, status_collection):
         logger.info(f'{filename} does not exist.')
         return False
 
+    database = status_collection.database
+    fields = [database.status_id, database.user_id, database.status_text]
+    if resumable:
+        return insert_rows_resumable(filename, status_collection, fields,
+                                     batch_size, commit_every)
+    if parser is not None:
+        return insert_rows(filename, status_collection, fields, parser,
+                           batch_size, commit_every)
+
     with open(filename, 'r') as file:
         #reads the header
         file.readline()
@@ -136,10 +360,14 @@ def load_status_updates(filename, status_collection):
         #logger.info(type(status_collection.database))
         logger.info('Created status list from file')
         #logger.info(status_lst[0])
+    status_lst = skip_existing(status_lst, attrgetter('status_id'),
+                               status_collection)
     try:
-        with snm.db.atomic():
-            status_collection.database.bulk_create(status_lst, batch_size=100)
-            logger.info('Status table created.')
+        create_records(status_collection, status_lst, batch_size,
+                       commit_every)
+        logger.info('Status table created.')
+        status_collection.remember_ids(status.status_id
+                                       for status in status_lst)
     except TypeError as e:
         logger.info('Error creating status table')
         logger.info(e)
@@ -162,6 +390,14 @@ def delete_user(user_id, user_collection):
     '''
     return user_collection.delete_user(user_id)
 
+def delete_users(user_ids, user_collection, batch_size=500):
+    '''
+    Deletes several users and their statuses from user_collection in
+    bounded batches. Returns a dict of user_id -> statuses deleted
+    (None when the user didn't exist).
+    '''
+    return user_collection.delete_users(user_ids, batch_size)
+
 def search_user(user_id, user_collection):
     '''
     Searches for a user in user_collection
@@ -172,6 +408,20 @@ def search_user(user_id, user_collection):
         return search_result
     raise AttributeError('Not a valid user collection')
 
+def search_users(user_ids, user_collection):
+    '''
+    Searches for many users in user_collection with a few queries
+    instead of one per id. Returns {user_id: user or None}.
+    '''
+    return user_collection.search_users(user_ids)
+
+def search_statuses(status_ids, status_collection):
+    '''
+    Searches for many statuses in status_collection with a few queries
+    instead of one per id. Returns {status_id: status or None}.
+    '''
+    return status_collection.search_statuses(status_ids)
+
 def update_status(status_id, user_id, status_text, status_collection):
     '''
     Updates the values of an existing status_id
@@ -191,8 +441,84 @@ def search_all_status_updates(user_id, status_collection):
     '''
     return status_collection.search_all_status_updates(user_id)
 
+def count_status_updates(user_id, status_collection):
+    '''
+    Counts a user's status updates without reading them into memory
+    '''
+    return status_collection.count_status_updates(user_id)
+
+def limit_results(statuses, max_rows=None, max_bytes=None):
+    '''
+    Wraps search results so iterating over them stops, with a warning,
+    at max_rows statuses or max_bytes of id and text (defaults:
+    user_status.MAX_RESULT_ROWS / MAX_RESULT_BYTES, 0 for no cap).
+    Its truncated attribute tells whether it stopped early.
+    '''
+    return user_status.ResultGuard(statuses, max_rows, max_bytes)
+
+def collect_statuses(statuses, max_rows=None, max_bytes=None):
+    '''
+    Reads search results into a list, capped like limit_results.
+    Returns (statuses, truncated).
+    '''
+    guard = limit_results(statuses, max_rows, max_bytes)
+    return list(guard), guard.truncated
+
 def filter_status_by_string(search_string, status_collection):
     '''
     searches database for all status updates that contain a word or phrase inputted by the user
     '''
     return status_collection.filter_status_by_string(search_string)
+
+def stream_status_updates(user_id, status_collection, chunk_size=100):
+    '''
+    Streams all statuses for user_id in bounded chunks without holding
+    a cursor open between chunks
+    '''
+    return status_collection.stream_statuses(user_id=user_id,
+                                             chunk_size=chunk_size)
+
+def stream_status_by_string(search_string, status_collection, chunk_size=100):
+    '''
+    Streams statuses containing search_string in bounded chunks without
+    holding a cursor open between chunks
+    '''
+    return status_collection.stream_statuses(search_string=search_string,
+                                             chunk_size=chunk_size)
+
+def search_status_terms(all_terms, any_terms, none_terms, status_collection):
+    '''
+    Searches all status updates for several words at once: all of
+    all_terms, any of any_terms and none of none_terms
+    '''
+    return status_collection.search_status_terms(all_terms, any_terms,
+                                                 none_terms)
+
+def moderate_statuses(blocklist, max_chunks=None):
+    '''
+    Runs the incremental moderation scan for a blocklist, only looking
+    at statuses added or changed since its last run. Returns the scan
+    counts.
+    '''
+    return moderation.ModerationScanner(blocklist).run(max_chunks)
+
+def flagged_statuses(blocklist):
+    '''
+    Returns a query of the statuses flagged for a blocklist
+    '''
+    return moderation.ModerationScanner(blocklist).flagged()
+
+def stream_changes(since_seq=0, batch_size=1000):
+    '''
+    Yields batches of user and status changes logged after since_seq,
+    for downstream caches and indexes. Logging starts once
+    changelog.install() has run.
+    '''
+    return changelog.stream_changes(since_seq, batch_size)
+
+def consume_changes(consumer_name, batch_size=1000):
+    '''
+    Like stream_changes, but resumes after the last batch consumer_name
+    finished, as recorded in the database
+    '''
+    return changelog.Consumer(consumer_name).batches(batch_size)
@@ -0,0 +1,203 @@
+'''
+Database maintenance: reclaim free pages, refresh planner statistics,
+checkpoint the WAL and check integrity.
+
+    python maintenance.py --budget 2 --tasks vacuum,analyze,checkpoint
+
+With --budget (seconds) the incremental vacuum works in small slices,
+pausing between them so other connections get the write lock, and
+tasks still pending when the budget runs out are skipped and reported,
+which keeps a run short enough for business hours. Run it again later
+to continue.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from loguru import logger
+
+if __name__ == '__main__':
+    # keep the model module from emptying the database being maintained;
+    # only the command line sets this, importers keep their own setting
+    os.environ.setdefault('SOCIALNETWORK_KEEP_DB', '1')
+import socialnetwork_model as sm  # pylint: disable=C0413
+
+#pylint: disable=C0103
+
+TASKS = ('vacuum', 'analyze', 'checkpoint', 'integrity')
+
+
+def pragma(name, database=sm.db):
+    '''
+    Returns the first value of PRAGMA name
+    '''
+    row = database.execute_sql(f'PRAGMA {name}').fetchone()
+    return None if row is None else row[0]
+
+
+def database_size(database=sm.db):
+    '''
+    Returns the file size in bytes and how much of it is free pages
+    '''
+    page_size = pragma('page_size', database)
+    return {'bytes': pragma('page_count', database) * page_size,
+            'free_bytes': pragma('freelist_count', database) * page_size}
+
+
+def enable_incremental_vacuum(database=sm.db):
+    '''
+    Switches a database created without auto_vacuum to incremental mode.
+    That takes one full VACUUM, which rewrites the whole file and
+    blocks writers while it runs, so do it outside busy hours. New
+    databases start in incremental mode (see sm.PRAGMAS).
+    '''
+    if pragma('auto_vacuum', database) == 2:
+        return False
+    database.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    database.execute_sql('VACUUM')
+    logger.info('Database switched to incremental auto_vacuum')
+    return True
+
+
+def incremental_vacuum(database=sm.db, pages_per_slice=256, deadline=None,
+                       pause=0.01):
+    '''
+    Returns free pages to the file system pages_per_slice at a time,
+    each slice its own short write transaction, until none are left or
+    time.monotonic() passes deadline. Returns the pages freed and
+    whether any are left; in auto_vacuum NONE mode nothing can be
+    freed (see enable_incremental_vacuum). Raises RuntimeError inside
+    a transaction, which the slices would commit.
+    '''
+    if database.in_transaction():
+        raise RuntimeError('incremental_vacuum cannot run in a transaction')
+    if pragma('auto_vacuum', database) != 2:
+        logger.warning('incremental_vacuum needs auto_vacuum=INCREMENTAL')
+        return {'pages_freed': 0,
+                'pages_left': pragma('freelist_count', database),
+                'incremental': False}
+    freed = 0
+    while True:
+        free = pragma('freelist_count', database)
+        if not free or (deadline is not None and
+                        time.monotonic() >= deadline):
+            break
+        # the pragma frees one page per step and a plain execute() only
+        # steps once; executescript runs it to completion
+        database.connection().executescript(
+            f'PRAGMA incremental_vacuum({pages_per_slice})')
+        left = pragma('freelist_count', database)
+        if left >= free:
+            break  # nothing could be freed, e.g. another writer holds it
+        freed += free - left
+        time.sleep(pause)
+    return {'pages_freed': freed, 'pages_left': free, 'incremental': True}
+
+
+def analyze(database=sm.db, full=False):
+    '''
+    Refreshes the query planner statistics: PRAGMA optimize, which only
+    analyzes tables whose statistics look stale, or a full ANALYZE
+    '''
+    database.execute_sql('ANALYZE' if full else 'PRAGMA optimize')
+    return {'full': full}
+
+
+def checkpoint(database=sm.db, mode='PASSIVE'):
+    '''
+    Copies the WAL back into the database file. PASSIVE never waits for
+    readers or writers; TRUNCATE also empties the WAL file. Skipped when
+    the database isn't in WAL mode.
+    '''
+    if pragma('journal_mode', database) != 'wal':
+        return {'skipped': 'not in WAL mode'}
+    busy, log_pages, done = database.execute_sql(
+        f'PRAGMA wal_checkpoint({mode})').fetchone()
+    return {'busy': bool(busy), 'wal_pages': log_pages,
+            'checkpointed_pages': done}
+
+
+def integrity_check(database=sm.db, quick=False, max_errors=100):
+    '''
+    Runs integrity_check (or the faster quick_check, which skips index
+    consistency) and foreign_key_check. Returns the problems found.
+    '''
+    check = 'quick_check' if quick else 'integrity_check'
+    problems = [row[0] for row in database.execute_sql(
+        f'PRAGMA {check}({max_errors})') if row[0] != 'ok']
+    foreign_keys = [{'table': table, 'rowid': rowid, 'parent': parent}
+                    for table, rowid, parent, _ in
+                    database.execute_sql('PRAGMA foreign_key_check')]
+    return {'ok': not problems and not foreign_keys, 'problems': problems,
+            'foreign_key_violations': foreign_keys}
+
+
+def run(tasks=TASKS, time_budget=None, database=sm.db, full_analyze=False,
+        quick_check=False, pages_per_slice=256):
+    '''
+    Runs the maintenance tasks in order and returns a report with each
+    task's result and seconds plus the file size before and after.
+    With time_budget (seconds), tasks not started in time are listed
+    as skipped.
+    '''
+    start = time.monotonic()
+    deadline = None if time_budget is None else start + time_budget
+    report = {'size_before': database_size(database), 'tasks': {},
+              'skipped': []}
+    steps = {'vacuum': lambda: incremental_vacuum(database, pages_per_slice,
+                                                  deadline),
+             'analyze': lambda: analyze(database, full_analyze),
+             'checkpoint': lambda: checkpoint(database),
+             'integrity': lambda: integrity_check(database, quick_check)}
+    for task in tasks:
+        if deadline is not None and time.monotonic() >= deadline:
+            report['skipped'].append(task)
+            continue
+        task_start = time.perf_counter()
+        result = steps[task]()
+        result['seconds'] = time.perf_counter() - task_start
+        report['tasks'][task] = result
+        logger.info('Maintenance {}: {}', task, result)
+    report['size_after'] = database_size(database)
+    report['seconds'] = time.monotonic() - start
+    return report
+
+
+def cli(argv=None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--db', help='database file (default: SOCIALNETWORK_DB'
+                        ' or socialnetwork.db)')
+    parser.add_argument('--tasks', default=','.join(TASKS),
+                        help=f'comma-separated subset of {",".join(TASKS)}')
+    parser.add_argument('--budget', type=float,
+                        help='stop starting work after this many seconds')
+    parser.add_argument('--full-analyze', action='store_true',
+                        help='ANALYZE everything instead of PRAGMA optimize')
+    parser.add_argument('--quick-check', action='store_true',
+                        help='quick_check instead of integrity_check')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='one-off full VACUUM into incremental mode')
+    args = parser.parse_args(argv)
+    tasks = [task for task in args.tasks.split(',') if task]
+    unknown = set(tasks) - set(TASKS)
+    if unknown:
+        parser.error(f'unknown tasks: {", ".join(sorted(unknown))}')
+
+    if args.db:
+        sm.use_database(args.db)
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum()
+    report = run(tasks, args.budget, full_analyze=args.full_analyze,
+                 quick_check=args.quick_check)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    result = cli()
+    sys.exit(0 if result['tasks'].get('integrity', {'ok': True})['ok']
+             else 1)
@@ -1,17 +1,60 @@
 '''
 Provides a basic frontend
+
+Run with --fast-start (or SOCIALNETWORK_FAST_START=1) to show the menu
+before importing peewee/loguru, setting up the log sinks and creating
+the tables; that work then happens on the first menu choice.
+
+Set SOCIALNETWORK_TEXT_INDEX to a file name to answer status searches
+from an inverted index, loaded from that file at start and saved back
+to it on quit.
 '''
+import os
 import sys
 from datetime import date
-from loguru import logger
-import main
-import socialnetwork_model as sm
 
 
-#pylint: disable=C0103
+#pylint: disable=C0103, W0603, C0415
+
+FAST_START = ('--fast-start' in sys.argv or
+              os.environ.get('SOCIALNETWORK_FAST_START') == '1')
 
-logger.remove()
-logger.add('log_' + str(date.today()) + '.log')
+logger = None
+main = None
+sm = None
+user_collection = None
+status_collection = None
+
+def import_backend():
+    '''
+    Imports the backend modules and sets up the log sink
+    '''
+    global logger, main, sm
+    if main is not None:
+        return
+    from loguru import logger as loguru_logger
+    import main as main_module
+    import socialnetwork_model as sm_module
+    logger, main, sm = loguru_logger, main_module, sm_module
+    logger.remove()
+    logger.add('log_' + str(date.today()) + '.log')
+
+def start_backend():
+    '''
+    Creates the tables and the user and status collections
+    '''
+    global user_collection, status_collection
+    if user_collection is not None:
+        return
+    import_backend()
+    sm.main()
+    user_collection = main.init_user_collection()
+    status_collection = main.init_status_collection(
+        os.environ.get('SOCIALNETWORK_READ_REPLICA') == '1',
+        text_index=os.environ.get('SOCIALNETWORK_TEXT_INDEX'))
+
+if not FAST_START:
+    import_backend()
 
 def load_users():
     '''
@@ -133,14 +176,15 @@ def search_all_status_updates():
     Searches for all the statuses associated with a specific user_id
     '''
     user_id = input('User ID: ')
-    query = main.search_all_status_updates(user_id, status_collection)
+    # counted by SQLite and streamed in chunks rather than read whole
+    total = main.count_status_updates(user_id, status_collection)
     #logger.info(query[0])
 
-    if not query:
+    if not total:
         print('An error occured while trying to search all status updates.')
     else:
-        print('A total of ', len(query), f'status updates are found for {user_id}')
-        iter_query = iter(query)
+        print('A total of ', total, f'status updates are found for {user_id}')
+        iter_query = main.stream_status_updates(user_id, status_collection)
         while True:
             next_choice = input('Would you like to see the next update? (Y/N)? ')
             if next_choice.upper() == 'Y':
@@ -163,7 +207,9 @@ def filter_status_by_string():
     searches database for all status updates that contain a word or phrase inputted by the user
     '''
     search_string = input('Enter a word or phrase to search by: ')
-    query = main.filter_status_by_string(search_string, status_collection)
+    # streamed in chunks so no cursor stays open while waiting for input;
+    # answered by the text index when SOCIALNETWORK_TEXT_INDEX is set
+    query = main.stream_status_by_string(search_string, status_collection)
 
     if not query:
         logger.error('An error occured while trying to search or there were no results.')
@@ -189,10 +235,15 @@ def filter_status_by_string():
 
 def flagged_status_updates():
     '''
-    Searches status updates based on a user inputted string and returns a tuple of results
+    Searches status updates based on a user inputted string and returns a tuple of results.
+    A comma separated list flags updates containing any of the words.
     '''
-    search_string = input('Enter a word or phrase to search by: ')
-    query = main.filter_status_by_string(search_string, status_collection)
+    search_string = input('Enter a word or phrase (or comma separated words) to search by: ')
+    words = [word.strip() for word in search_string.split(',') if word.strip()]
+    if len(words) > 1:
+        query = main.search_status_terms((), words, (), status_collection)
+    else:
+        query = main.filter_status_by_string(search_string, status_collection)
     if not query:
         logger.error('An error occured while trying to search or there were no results.')
         print('There are no results with that search or there was an error.')
@@ -217,10 +268,10 @@ def flagged_status_updates():
                 # print(query_tpl)
 
         #Attempt #2 at a list comprehension
-        query_list = []
-        for status in (item for item in query):
-            query_list.append((status.status_id, status.status_text))
-        print(query_list)
+        statuses, truncated = main.collect_statuses(query)
+        print([(status.status_id, status.status_text) for status in statuses])
+        if truncated:
+            print(f'Only the first {len(statuses)} results are shown.')
 
 #My start at a generator function. These are still confusing to me.
 # def status_generator(query, user_id):
@@ -236,12 +287,15 @@ def quit_program():
     '''
     Quits program
     '''
+    if status_collection is not None and \
+            status_collection.text_index is not None:
+        main.save_text_index(status_collection,
+                             os.environ['SOCIALNETWORK_TEXT_INDEX'])
     sys.exit()
 
 if __name__ == '__main__':
-    sm.main()
-    user_collection = main.init_user_collection()
-    status_collection = main.init_status_collection()
+    if not FAST_START:
+        start_backend()
     menu_options = {
         'A': load_users,
         'B': load_status_updates,
@@ -277,6 +331,8 @@ if __name__ == '__main__':
 
                             Please enter your choice: """)
         if user_selection.upper() in menu_options:
+            if user_selection.upper() != 'Q':
+                start_backend()
             menu_options[user_selection.upper()]()
         else:
             print("Invalid option")
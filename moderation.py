@@ -0,0 +1,245 @@
+'''
+Incremental moderation of status updates against a blocklist
+'''
+# pylint: disable=R0903, E0401
+import hashlib
+import time
+from loguru import logger
+import peewee as pw
+from playhouse.sqlite_ext import AutoIncrementField
+import socialnetwork_model as sm
+
+
+class ModerationQueue(sm.BaseModel):
+    '''
+    Status ids inserted or re-texted since the queue was installed,
+    filled by triggers on the status table. AUTOINCREMENT keeps seq
+    from being reused after the queue is pruned.
+    '''
+    seq = AutoIncrementField()
+    status_id = pw.CharField(max_length=50)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'moderation_queue'
+
+
+class ModerationCheckpoint(sm.BaseModel):
+    '''
+    Progress of one blocklist version: the rowid reached by its first
+    full scan, then the last moderation_queue seq it processed, and
+    when it last ran (epoch seconds)
+    '''
+    blocklist_version = pw.CharField(primary_key=True, max_length=40)
+    backlog_rowid = pw.IntegerField(default=0)
+    backlog_done = pw.BooleanField(default=False)
+    queue_seq = pw.IntegerField(default=0)
+    last_run = pw.IntegerField(default=0)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'moderation_checkpoint'
+
+
+class FlaggedStatus(sm.BaseModel):
+    '''
+    Statuses matching a blocklist version
+    '''
+    status = pw.ForeignKeyField(sm.Status, column_name='status_id',
+                                on_delete='CASCADE')
+    blocklist_version = pw.CharField(max_length=40)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'flagged_status'
+        primary_key = pw.CompositeKey('status', 'blocklist_version')
+
+
+# blocklist versions not run for this many seconds are retired
+RETIRE_AFTER = 30 * 24 * 3600
+
+QUEUE_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS status_moderation_insert
+       AFTER INSERT ON status BEGIN
+       INSERT INTO moderation_queue (status_id) VALUES (NEW.status_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS status_moderation_update
+       AFTER UPDATE OF status_text ON status BEGIN
+       INSERT INTO moderation_queue (status_id) VALUES (NEW.status_id);
+       END''')
+
+
+def install(database=sm.db):
+    '''
+    Creates the moderation tables and the status triggers feeding the
+    queue. Safe to call repeatedly.
+    '''
+    database.create_tables([ModerationQueue, ModerationCheckpoint,
+                            FlaggedStatus])
+    for trigger in QUEUE_TRIGGERS:
+        database.execute_sql(trigger)
+    return True
+
+
+def uninstall(database=sm.db):
+    '''
+    Drops the status triggers and the moderation tables
+    '''
+    for name in ('status_moderation_insert', 'status_moderation_update'):
+        database.execute_sql(f'DROP TRIGGER IF EXISTS {name}')
+    database.drop_tables([FlaggedStatus, ModerationCheckpoint,
+                          ModerationQueue])
+    return True
+
+
+def blocklist_version(blocklist):
+    '''
+    Stable id for a blocklist, independent of word order
+    '''
+    spec = sm.terms_spec(any_terms=blocklist)
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()[:16]
+
+
+class ModerationScanner:
+    '''
+    Flags statuses containing any blocklist word. The first run for a
+    blocklist scans the whole status table; later runs only look at
+    statuses queued since, so the cost follows new content. Progress is
+    committed with each chunk, so an interrupted run resumes where it
+    stopped.
+    '''
+
+    def __init__(self, blocklist, chunk_size=1000):
+        self.version = blocklist_version(blocklist)
+        self.matcher = sm.compile_terms(sm.terms_spec(any_terms=blocklist))
+        self.chunk_size = chunk_size
+        install()
+
+    def _checkpoint(self):
+        checkpoint = ModerationCheckpoint.get_or_none(
+            ModerationCheckpoint.blocklist_version == self.version)
+        if checkpoint is None:
+            # rows queued from here on are covered by the full scan
+            start = ModerationQueue.select(
+                pw.fn.COALESCE(pw.fn.MAX(ModerationQueue.seq), 0)).scalar()
+            checkpoint = ModerationCheckpoint.create(
+                blocklist_version=self.version, queue_seq=start)
+        return checkpoint
+
+    def _flag(self, status_id):
+        # 0 when the status was already flagged
+        return (FlaggedStatus.insert(status=status_id,
+                                     blocklist_version=self.version)
+                .on_conflict_ignore().as_rowcount().execute())
+
+    def _scan_backlog(self, checkpoint, stats):
+        rowid = pw.SQL('rowid')
+        rows = (sm.Status.select(rowid, sm.Status.status_id,
+                                 sm.Status.status_text)
+                .where(rowid > checkpoint.backlog_rowid)
+                .order_by(rowid).limit(self.chunk_size).tuples())
+        rows = list(rows)
+        for row_number, status_id, text in rows:
+            stats['scanned'] += 1
+            if self.matcher(sm.status_text_decompress(text)):
+                stats['flagged'] += self._flag(status_id)
+            checkpoint.backlog_rowid = row_number
+        checkpoint.backlog_done = len(rows) < self.chunk_size
+
+    def _scan_queue(self, checkpoint, stats):
+        rows = list(ModerationQueue
+                    .select(ModerationQueue.seq, ModerationQueue.status_id,
+                            sm.Status.status_text)
+                    .join(sm.Status, pw.JOIN.LEFT_OUTER,
+                          on=(ModerationQueue.status_id ==
+                              sm.Status.status_id))
+                    .where(ModerationQueue.seq > checkpoint.queue_seq)
+                    .order_by(ModerationQueue.seq)
+                    .limit(self.chunk_size).tuples())
+        for seq, status_id, text in rows:
+            checkpoint.queue_seq = seq
+            if text is None:
+                continue  # deleted since it was queued
+            stats['scanned'] += 1
+            if self.matcher(sm.status_text_decompress(text)):
+                stats['flagged'] += self._flag(status_id)
+            else:
+                stats['cleared'] += (FlaggedStatus.delete().where(
+                    (FlaggedStatus.status == status_id) &
+                    (FlaggedStatus.blocklist_version == self.version))
+                                     .execute())
+        return len(rows) < self.chunk_size
+
+    def run(self, max_chunks=None, max_age=None):
+        '''
+        Scans until caught up, or for at most max_chunks chunks.
+        Returns counts of rows scanned, newly flagged and cleared.
+        max_age is passed on to prune_queue.
+        '''
+        stats = {'version': self.version, 'scanned': 0, 'flagged': 0,
+                 'cleared': 0, 'caught_up': False}
+        chunks = 0
+        while max_chunks is None or chunks < max_chunks:
+            with sm.db.atomic():
+                checkpoint = self._checkpoint()
+                checkpoint.last_run = int(time.time())
+                if checkpoint.backlog_done:
+                    stats['caught_up'] = self._scan_queue(checkpoint, stats)
+                else:
+                    self._scan_backlog(checkpoint, stats)
+                checkpoint.save()
+            chunks += 1
+            if stats['caught_up']:
+                break
+        prune_queue(max_age)
+        logger.info('Moderation run: {}', stats)
+        return stats
+
+    def flagged(self):
+        '''
+        Returns a query of the statuses flagged for this blocklist
+        '''
+        return (sm.Status.select().join(
+            FlaggedStatus, on=(FlaggedStatus.status == sm.Status.status_id))
+                .where(FlaggedStatus.blocklist_version == self.version))
+
+
+def retire_checkpoints(max_age=RETIRE_AFTER):
+    '''
+    Forgets blocklist versions that haven't run for max_age seconds,
+    with their flags, so an abandoned blocklist doesn't keep queue
+    entries alive. A retired blocklist starts over with a full scan if
+    it is run again. Returns the versions retired.
+    '''
+    cutoff = int(time.time()) - max_age
+    versions = [row[0] for row in ModerationCheckpoint
+                .select(ModerationCheckpoint.blocklist_version)
+                .where(ModerationCheckpoint.last_run < cutoff).tuples()]
+    if versions:
+        with sm.db.atomic():
+            FlaggedStatus.delete().where(
+                FlaggedStatus.blocklist_version.in_(versions)).execute()
+            ModerationCheckpoint.delete().where(
+                ModerationCheckpoint.blocklist_version.in_(versions)).execute()
+        logger.info('Retired blocklist versions {}', versions)
+    return versions
+
+
+def prune_queue(max_age=None):
+    '''
+    Drops queue entries every blocklist version has processed, after
+    retiring versions idle for max_age seconds (default RETIRE_AFTER)
+    '''
+    retire_checkpoints(RETIRE_AFTER if max_age is None else max_age)
+    oldest = ModerationCheckpoint.select(
+        pw.fn.MIN(ModerationCheckpoint.queue_seq)).scalar()
+    if oldest is None:
+        return 0
+    return ModerationQueue.delete().where(
+        ModerationQueue.seq <= oldest).execute()
@@ -2,21 +2,200 @@
 Creates DB tables for the social network model
 '''
 
+import json
 import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
 import peewee as pw
+from playhouse.sqlite_ext import AutoIncrementField
 from loguru import logger
 
 #pylint: disable=R0903, C0103
 
-logger.remove()
-logger.add("user_log.log", rotation="00:00", level='WARNING')
+# Set SOCIALNETWORK_COMPRESS_STATUS=1 to store status_text compressed.
+# The choice is baked into the schema, so it only applies to a fresh DB.
+COMPRESS_STATUS = os.environ.get('SOCIALNETWORK_COMPRESS_STATUS', '0') == '1'
+
+# inserted_ids entries kept behind the newest, so a collection lagging
+# by fewer catches its id filter up instead of rebuilding it
+INSERT_LOG_KEEP = 100000
+
+# Shared preset dictionary for status compression. zlib favours matches
+# near the end of the dictionary, so the most common words go last.
+# Changing this makes existing compressed rows unreadable.
+STATUS_ZDICT = ' '.join([
+    'spade', 'blade', 'cough', 'aback', 'hug', 'remind', 'carve', 'weep',
+    'icky', 'wee', 'rustic', 'stormy', 'thinkable', 'troubled', 'crowded',
+    'obtainable', 'parsimonious', 'conceptualize', 'entertaining', 'foolish',
+    'wilderness', 'basketball', 'naughty', 'afraid', 'rich', 'sky', 'rest',
+    'step', 'deal', 'leave', 'hurt', 'eye', 'beautiful', 'existence',
+    'compiling', 'finally', 'morning', 'Seattle', 'Sunny', 'weekend',
+    'tonight', 'tomorrow', 'yesterday', 'friends', 'family', 'coffee',
+    'dinner', 'lunch', 'work', 'game', 'team', 'love', 'great', 'today',
+    'with', 'this', 'that', 'have', 'just', 'for', 'and', 'the', 'in ',
+    'is ', 'my ', 'a ', 'to ', 'of ', 'I ']).encode('utf-8')
+
+def database_path(path=None, worker=None):
+    '''
+    Where this process keeps its database: path, else the
+    SOCIALNETWORK_DB environment variable, else socialnetwork.db.
+    Besides a file name this can be ':memory:' or an SQLite URI, e.g.
+    file:socialnetwork?mode=memory&cache=shared for an in-memory
+    database shared by all connections of the process (which the
+    write-behind buffer and read replica need). Under a multi-process
+    test runner each worker (PYTEST_XDIST_WORKER, e.g. gw0) gets its
+    own database with the worker name appended.
+    '''
+    path = path or os.environ.get('SOCIALNETWORK_DB', 'socialnetwork.db')
+    if worker is None:
+        worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker and path != ':memory:':
+        name, separator, query = path.partition('?')
+        root, extension = os.path.splitext(name)
+        path = f'{root}_{worker}{extension}{separator}{query}'
+    return path
+
+def is_file_path(path):
+    '''
+    True for a plain file name, False for ':memory:' and URIs
+    '''
+    return path != ':memory:' and not path.startswith('file:')
+
+DB_PATH = database_path()
+# incremental auto_vacuum lets maintenance.py shrink the file in small
+# steps; it only takes effect on a database with no tables yet
+PRAGMAS = {'foreign_keys': 1, 'ignore_check_constraints': 0,
+           'auto_vacuum': 'incremental'}
+
+# each run starts from an empty database file, unless
+# SOCIALNETWORK_KEEP_DB=1 (tools that work on an existing database)
+if (is_file_path(DB_PATH) and os.path.exists(DB_PATH) and
+        os.environ.get('SOCIALNETWORK_KEEP_DB') != '1'):
+    os.remove(DB_PATH)
+
+db = pw.SqliteDatabase(DB_PATH, pragmas=PRAGMAS,
+                       uri=DB_PATH.startswith('file:'))
+
+def use_database(path):
+    '''
+    Points the models at another database (see database_path for the
+    forms path can take), closing this thread's current connection
+    '''
+    db.init(path, pragmas=PRAGMAS, uri=path.startswith('file:'))
+    return db
+
+def compress_text(text, zdict=STATUS_ZDICT):
+    '''
+    Compresses text with raw deflate and a preset dictionary
+    '''
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zdict=zdict)
+    return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+def decompress_text(data, zdict=STATUS_ZDICT):
+    '''
+    Reverses compress_text
+    '''
+    decompressor = zlib.decompressobj(-15, zdict=zdict)
+    return (decompressor.decompress(bytes(data)) +
+            decompressor.flush()).decode('utf-8')
+
+def train_status_dictionary(texts, size=4096):
+    '''
+    Builds a preset dictionary from sample status texts, most common
+    words last. Useful for checking whether STATUS_ZDICT still fits
+    the data; it can only be swapped in on a fresh DB.
+    '''
+    counts = Counter(word for text in texts for word in text.split())
+    words = [word for word, _ in counts.most_common()]
+    zdict = b''
+    for word in words:
+        entry = word.encode('utf-8') + b' '
+        if len(zdict) + len(entry) > size:
+            break
+        zdict = entry + zdict
+    return zdict
+
+def status_text_decompress(value):
+    '''
+    SQL function so LIKE searches work on the compressed column
+    '''
+    if value is None or isinstance(value, str):
+        return value
+    return decompress_text(value)
+
+def terms_spec(all_terms=(), any_terms=(), none_terms=()):
+    '''
+    Encodes a term search for status_terms_match
+    '''
+    return json.dumps([sorted(set(all_terms)), sorted(set(any_terms)),
+                       sorted(set(none_terms))])
+
+@lru_cache(maxsize=32)
+def compile_terms(spec):
+    '''
+    Compiles a terms_spec into a text -> bool matcher. OR and NOT terms
+    become one case-insensitive alternation each, so a long blocklist is
+    a single regex scan per row; matching is case-insensitive like LIKE.
+    '''
+    all_terms, any_terms, none_terms = json.loads(spec)
 
-if os.path.exists('socialnetwork.db'):
-    os.remove('socialnetwork.db')
+    def alternation(terms):
+        if not terms:
+            return None
+        return re.compile('|'.join(re.escape(term) for term in
+                                   sorted(terms, key=len, reverse=True)),
+                          re.IGNORECASE)
 
-db = pw.SqliteDatabase('socialnetwork.db',
-                       pragmas={'foreign_keys': 1,
-                                'ignore_check_constraints': 0})
+    required = [term.lower() for term in all_terms]
+    any_match = alternation(any_terms)
+    none_match = alternation(none_terms)
+
+    def matcher(text):
+        lowered = text.lower()
+        return (all(term in lowered for term in required) and
+                (any_match is None or any_match.search(text) is not None) and
+                (none_match is None or none_match.search(text) is None))
+    return matcher
+
+def status_terms_match(value, spec):
+    '''
+    SQL function evaluating a terms_spec against one status_text
+    '''
+    if value is None:
+        return 0
+    return int(compile_terms(spec)(status_text_decompress(value)))
+
+def register_functions(database):
+    '''
+    Registers the status SQL functions on a database
+    '''
+    database.register_function(status_text_decompress,
+                               'status_text_decompress', 1)
+    database.register_function(status_terms_match, 'status_terms_match', 2)
+
+register_functions(db)
+
+class CompressedTextField(pw.BlobField):
+    '''
+    Text field stored as a compressed blob, transparent to callers
+    '''
+    def db_value(self, value):
+        if value is None:
+            return None
+        return compress_text(value)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return decompress_text(value)
+
+logger.remove()
+logger.add("user_log.log", rotation="00:00", level='WARNING')
 
 class BaseModel(pw.Model):
     '''
@@ -52,8 +231,8 @@ class Status(BaseModel):
     status_id = pw.CharField(primary_key=True, max_length=50)
     user_id = pw.ForeignKeyField(model=Users, backref='status',
                                  on_update='RESTRICT',
-                                 on_delete='CASCADE')
-    status_text = pw.CharField()
+                                 on_delete='CASCADE', index=False)
+    status_text = CompressedTextField() if COMPRESS_STATUS else pw.CharField()
 
     class Meta:
         '''
@@ -61,6 +240,323 @@ class Status(BaseModel):
         '''
         database = db
         table_name = 'status'
+        # serves user_id lookups and keeps a user's statuses in
+        # status_id order, so streaming them needs no sort per chunk
+        indexes = ((('user_id', 'status_id'), False),)
+
+    @classmethod
+    def searchable_text(cls):
+        '''
+        Returns an expression of the plain status text for searching
+        '''
+        if COMPRESS_STATUS:
+            return pw.fn.status_text_decompress(cls.status_text)
+        return cls.status_text
+
+class KeyedUsers(BaseModel):
+    '''
+    Users with an integer surrogate key: user_key is an alias of the
+    rowid, so rows are clustered on it, and the public user_id has a
+    unique index. Used by storage.keyed_stores.
+    '''
+    user_key = pw.AutoField()
+    user_id = pw.CharField(unique=True, max_length=30)
+    user_name = pw.CharField(max_length=30)
+    user_last_name = pw.CharField(max_length=100)
+    user_email = pw.CharField(max_length=100)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'users_keyed'
+
+class KeyedStatus(BaseModel):
+    '''
+    Status with an integer surrogate key. Each row stores its user's
+    integer key instead of the user_id string; user_id is still the
+    relation to the user, so status.user_id.user_id works as for Status.
+    '''
+    status_key = pw.AutoField()
+    status_id = pw.CharField(unique=True, max_length=50)
+    user_id = pw.ForeignKeyField(model=KeyedUsers, backref='status',
+                                 column_name='user_key',
+                                 object_id_name='user_key',
+                                 on_delete='CASCADE', index=False)
+    status_text = CompressedTextField() if COMPRESS_STATUS else pw.CharField()
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'status_keyed'
+        indexes = ((('user_id', 'status_id'), False),)
+
+    @classmethod
+    def searchable_text(cls):
+        '''
+        Returns an expression of the plain status text for searching
+        '''
+        if COMPRESS_STATUS:
+            return pw.fn.status_text_decompress(cls.status_text)
+        return cls.status_text
+
+class IngestCheckpoint(BaseModel):
+    '''
+    Progress of a resumable CSV load: the file's size/mtime fingerprint
+    and the byte offset just past the last committed row
+    '''
+    file_path = pw.CharField(primary_key=True)
+    file_size = pw.IntegerField()
+    file_mtime = pw.IntegerField()
+    byte_offset = pw.IntegerField(default=0)
+    done = pw.BooleanField(default=False)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'ingest_checkpoint'
+
+class DatabaseEpoch(BaseModel):
+    '''
+    Random value redrawn when the database is replaced, e.g. by a
+    restore, so state kept outside it (id filters, a saved text index)
+    can tell it is looking at another database
+    '''
+    epoch = pw.BlobField()
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'database_epoch'
+
+class InsertedId(BaseModel):
+    '''
+    Ids of the rows inserted into the tracked tables, logged by triggers
+    whichever connection or process inserts them (see track_inserts).
+    The collections add the ids logged since they last looked to their
+    id filters. token is random, so the entry a collection last read
+    can't be mistaken for one reusing its seq after a rollback. Entries
+    more than INSERT_LOG_KEEP behind the newest are pruned by a trigger.
+    '''
+    seq = AutoIncrementField()
+    tracked_table = pw.CharField()
+    row_id = pw.CharField()
+    token = pw.BlobField()
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'inserted_ids'
+
+def database_epoch(database=db):
+    '''
+    Returns the epoch of the database, drawing one the first time
+    '''
+    query = 'SELECT epoch FROM database_epoch'
+    try:
+        row = database.execute_sql(query).fetchone()
+    except pw.OperationalError:
+        row = None  # database_epoch not created yet
+    if row is None:
+        database.create_tables([DatabaseEpoch])
+        database.execute_sql(
+            'INSERT INTO database_epoch (epoch) SELECT randomblob(8) '
+            'WHERE NOT EXISTS (SELECT 1 FROM database_epoch)')
+        row = database.execute_sql(query).fetchone()
+    return bytes(row[0])
+
+def new_database_epoch(database=db):
+    '''
+    Redraws the epoch of a replaced database
+    '''
+    database_epoch(database)
+    database.execute_sql('UPDATE database_epoch SET epoch = randomblob(8)')
+    return True
+
+def track_inserts(model, field, database=db):
+    '''
+    Starts logging the field value of each row inserted into model's
+    table in inserted_ids; safe to call repeatedly
+    '''
+    table = model._meta.table_name
+    database_epoch(database)
+    database.create_tables([InsertedId])
+    database.execute_sql(
+        f'''CREATE TRIGGER IF NOT EXISTS inserted_ids_prune
+           AFTER INSERT ON inserted_ids WHEN NEW.seq % 1000 = 0 BEGIN
+           DELETE FROM inserted_ids WHERE seq <= NEW.seq - {INSERT_LOG_KEEP};
+           END''')
+    database.execute_sql(
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_log_insert
+           AFTER INSERT ON {table} BEGIN
+           INSERT INTO inserted_ids (tracked_table, row_id, token)
+           VALUES ('{table}', NEW."{field.column_name}", randomblob(8));
+           END''')
+    return True
+
+def inserted_since(model, mark, database=db):
+    '''
+    Returns (mark, ids): the ids inserted into model's table since the
+    given mark, and the mark to pass next time. ids is None when they
+    can't all be told: mark is None, the entries after it were pruned
+    or rolled back, the database was replaced, or the table's inserts
+    aren't logged (then mark is None too, see track_inserts).
+    '''
+    table = model._meta.table_name
+    if mark is None:
+        entries, after = ('(SELECT * FROM inserted_ids '
+                          'ORDER BY seq DESC LIMIT 1)'), ()
+    else:
+        entries, after = 'inserted_ids', (mark[1],)
+    try:
+        rows = database.execute_sql(
+            'SELECT e.epoch, (SELECT count(*) FROM sqlite_master '
+            "WHERE type = 'trigger' AND name = ?), "
+            'q.seq, q.token, q.tracked_table, q.row_id '
+            f'FROM database_epoch AS e LEFT JOIN {entries} AS q '
+            f'ON {"q.seq >= ?" if after else "1"} ORDER BY q.seq',
+            (f'{table}_log_insert',) + after).fetchall()
+    except pw.OperationalError:
+        return None, None  # inserted_ids not created yet
+    if not rows or not rows[0][1]:
+        return None, None
+    epoch, _, seq, token, _, _ = rows[-1]
+    position = (bytes(epoch), seq or 0, token)
+    if mark is None or position[0] != mark[0]:
+        return position, None
+    first = rows[0][2]
+    if mark[1]:
+        intact = first == mark[1] and rows[0][3] == mark[2]
+    else:
+        intact = first in (None, 1)
+    if not intact:
+        return position, None
+    return position, [row[5] for row in rows
+                      if row[4] == table and row[2] > mark[1]]
+
+def replica_path(path):
+    '''
+    Default read replica file for the database at path: its name with
+    _replica added, e.g. socialnetwork_replica.db. Databases that
+    aren't plain files get socialnetwork_replica.db.
+    '''
+    if not is_file_path(path):
+        return 'socialnetwork_replica.db'
+    root, extension = os.path.splitext(path)
+    return f'{root}_replica{extension}'
+
+class ReadReplica:
+    '''
+    Read-only snapshot of the main DB for search workloads.
+    The snapshot is copied with the SQLite backup API and opened with
+    mode=ro and a large mmap_size. A background thread copies a new one
+    every refresh_interval seconds and moves it over the old file, so
+    searches never wait for a copy and reads lag writes by about that
+    much; each thread's connection moves to the newest snapshot on its
+    next bind. path defaults to replica_path of the source database.
+    The background copy uses its own connection, so the source must be
+    a file or a shared in-memory database.
+    '''
+
+    def __init__(self, path=None, refresh_interval=30.0,
+                 mmap_size=256 * 1024 * 1024, source=None):
+        self.source = source or db
+        self.path = path or replica_path(self.source.database)
+        self.refresh_interval = refresh_interval
+        self.database = pw.SqliteDatabase(f'file:{self.path}?mode=ro',
+                                          uri=True,
+                                          pragmas={'mmap_size': mmap_size,
+                                                   'query_only': 1})
+        register_functions(self.database)
+        self.refreshed_at = None
+        self._generation = 0
+        self._bound = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='read-replica-refresh')
+        self._thread.start()
+
+    def refresh(self):
+        '''
+        Re-snapshots the primary into a new replica file
+        '''
+        with self._refresh_lock:
+            temporary = f'{self.path}.tmp'
+            target = sqlite3.connect(temporary)
+            try:
+                self.source.connect(reuse_if_open=True)
+                self.source.connection().backup(target, pages=1024)
+            finally:
+                target.close()
+            os.replace(temporary, self.path)
+            self._generation += 1
+            self.refreshed_at = time.monotonic()
+        logger.info('Read replica {} refreshed', self.path)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.refresh_interval)
+            if self._closed:
+                break
+            try:
+                self.refresh()
+            except Exception as e:  # pylint: disable=W0703
+                # a failed copy leaves the previous snapshot in place
+                logger.error('Read replica refresh failed: {}', e)
+        self.source.close()
+
+    def bind(self, query):
+        '''
+        Points a query at the replica, reopening this thread's
+        connection if a newer snapshot has replaced its file
+        '''
+        generation = self._generation
+        if getattr(self._bound, 'generation', None) != generation:
+            self.database.close()
+            self._bound.generation = generation
+        return query.bind(self.database)
+
+    def close(self):
+        '''
+        Stops the background refreshes and closes this thread's replica
+        connection
+        '''
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            self._thread.join()
+        self.database.close()
+
+@lru_cache(maxsize=None)
+def max_variable_number():
+    '''
+    Returns SQLITE_MAX_VARIABLE_NUMBER of the linked SQLite library,
+    falling back to its documented default when not compiled in
+    '''
+    connection = sqlite3.connect(':memory:')
+    try:
+        for (option,) in connection.execute('PRAGMA compile_options'):
+            if option.startswith('MAX_VARIABLE_NUMBER='):
+                return int(option.split('=')[1])
+    finally:
+        connection.close()
+    return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+def max_rows_per_insert(columns, cap=1000):
+    '''
+    Rows per multi-row INSERT for a table with that many columns: as
+    many as SQLite's variable limit allows, up to cap. Beyond about a
+    thousand rows statements cost more to build than they save
+    (see benchmarks.py batch_sweep).
+    '''
+    return max(1, min(cap, max_variable_number() // columns))
 
 def create_tables(database, tables):
     '''
@@ -75,6 +571,8 @@ def main():
     '''
     db.connect(reuse_if_open=True)
     create_tables(db, (Users, Status))
+    track_inserts(Users, Users.user_id)
+    track_inserts(Status, Status.status_id)
     return True
 
 if __name__ == '__main__':
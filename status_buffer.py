@@ -0,0 +1,120 @@
+'''
+Write-behind buffer for status updates
+'''
+# pylint: disable=R0903, E0401
+import atexit
+import threading
+from concurrent.futures import Future
+from loguru import logger
+import socialnetwork_model as sm
+
+
+class BufferedStatusWriter:
+    '''
+    Collects add_status/modify_status calls for a UserStatusCollection
+    and applies them in one transaction every max_delay_ms or max_ops
+    calls, whichever comes first. Each call returns a Future resolving
+    to what the collection method returned (True, or False/None when
+    the write was refused, e.g. on an IntegrityError) once the batch
+    has committed. Pending calls are flushed by flush(), close() and
+    at interpreter exit.
+
+    Flushes run on a background thread with its own connection, so the
+    database must be a file, not :memory:.
+    '''
+
+    def __init__(self, status_collection, max_ops=500, max_delay_ms=50):
+        self.collection = status_collection
+        self.max_ops = max_ops
+        self.max_delay = max_delay_ms / 1000
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='status-write-behind')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_status(self, status_id, user_id, status_text):
+        '''
+        Queues UserStatusCollection.add_status, returns a Future
+        '''
+        return self._submit('add_status', (status_id, user_id, status_text))
+
+    def modify_status(self, status_id, user_id, status_text):
+        '''
+        Queues UserStatusCollection.modify_status, returns a Future
+        '''
+        return self._submit('modify_status',
+                            (status_id, user_id, status_text))
+
+    def _submit(self, method, args):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Status writer is closed')
+            self._pending.append((method, args, future))
+            full = len(self._pending) >= self.max_ops
+        if full:
+            self._wakeup.set()
+        return future
+
+    def flush(self):
+        '''
+        Applies every queued call in one transaction. Each call runs in
+        its own savepoint so one failure doesn't undo the others.
+        Returns the number of calls applied.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                operations, self._pending = self._pending, []
+            if not operations:
+                return 0
+            results = []
+            try:
+                with sm.db.atomic():
+                    for method, args, future in operations:
+                        try:
+                            with sm.db.atomic():
+                                result = getattr(self.collection,
+                                                 method)(*args)
+                        except Exception as e:  # pylint: disable=W0703
+                            # any error belongs to this call alone; the
+                            # writer thread must keep running
+                            future.set_exception(e)
+                            continue
+                        results.append((future, result))
+            except Exception as e:  # pylint: disable=W0703
+                logger.error('Status write-behind flush failed: {}', e)
+                for future, _ in results:
+                    future.set_exception(e)
+                return 0
+            for future, result in results:
+                future.set_result(result)
+            logger.info('Flushed {} buffered status writes', len(operations))
+            return len(operations)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.max_delay)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:  # pylint: disable=W0703
+                logger.error('Status write-behind flush failed: {}', e)
+        sm.db.close()
+
+    def close(self):
+        '''
+        Stops the background thread and flushes what is left
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        atexit.unregister(self.close)
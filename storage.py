@@ -0,0 +1,765 @@
+'''
+Storage backends behind UserCollection and UserStatusCollection.
+
+The SQLite stores run the peewee queries against socialnetwork.db.
+The keyed SQLite stores use tables with integer surrogate keys instead:
+rows are clustered on an integer rowid, the string ids get unique
+indexes, and each status stores its user's integer key rather than the
+user_id string. Callers still pass and get the string ids. The
+analytics, change log, moderation and text index features only cover
+the standard tables.
+
+The memory stores keep everything in dicts, with an index of statuses
+per user and an inverted word index for text searches; they suit unit
+tests and cache-like workloads that don't need durability. All raise
+pw.IntegrityError for duplicate ids and unknown user_ids, like SQLite.
+
+    user_store, status_store = storage.memory_stores()
+    users = UserCollection(user_store)
+    statuses = UserStatusCollection(store=status_store)
+'''
+# pylint: disable=R0903, E0401
+import contextlib
+import re
+from collections import defaultdict
+import peewee as pw
+import socialnetwork_model as sm
+
+WORD = re.compile(r'\w+')
+
+
+class SqliteStore:
+    '''
+    What the SQLite user and status stores share: model is their table
+    and id_name the column of the ids callers pass
+    '''
+    model = None
+    id_name = None
+
+    @property
+    def id_field(self):
+        '''
+        The model field of the ids callers pass
+        '''
+        return getattr(self.model, self.id_name)
+
+    @staticmethod
+    def key(user_id):
+        '''
+        What the status table stores to refer to user_id
+        '''
+        return user_id
+
+    def atomic(self):
+        '''
+        Transaction context for a group of writes
+        '''
+        return sm.db.atomic()
+
+    def count(self):
+        '''
+        Number of stored rows
+        '''
+        return self.model.select().count()
+
+    def ids(self):
+        '''
+        Iterates over every stored id
+        '''
+        # raw cursor: this runs over every id, skip model row handling
+        return (row[0] for row in sm.db.execute_sql(
+            *self.model.select(self.id_field).sql()))
+
+    def track_inserts(self):
+        '''
+        Has SQLite log the ids inserted into the table
+        '''
+        return sm.track_inserts(self.model, self.id_field)
+
+    def inserted_since(self, mark):
+        '''
+        (mark, ids inserted since the given mark), see sm.inserted_since
+        '''
+        return sm.inserted_since(self.model, mark)
+
+    def existing(self, ids):
+        '''
+        Returns the subset of ids that are stored
+        '''
+        found = set()
+        step = sm.max_variable_number()
+        for start in range(0, len(ids), step):
+            chunk = ids[start:start + step]
+            found.update(row[0] for row in
+                         self.model.select(self.id_field)
+                         .where(self.id_field.in_(chunk)).tuples())
+        return found
+
+    def insert_tuples(self, fields, rows):
+        '''
+        Inserts row tuples with one prepared INSERT through executemany,
+        skipping peewee's per-value SQL building. Only fields that change
+        the stored value (e.g. compressed text) are run through db_value.
+        '''
+        columns = ', '.join(f'"{field.column_name}"' for field in fields)
+        marks = ', '.join(self.placeholder(field) for field in fields)
+        sql = (f'INSERT INTO "{self.model._meta.table_name}" ({columns}) '
+               f'VALUES ({marks})')
+        converters = [None if isinstance(field, (pw.CharField, pw.TextField,
+                                                 pw.ForeignKeyField))
+                      else field.db_value for field in fields]
+        if any(converters):
+            rows = [tuple(value if convert is None else convert(value)
+                          for convert, value in zip(converters, row))
+                    for row in rows]
+        sm.db.cursor().executemany(sql, rows)
+
+    @staticmethod
+    def placeholder(field):
+        '''
+        SQL for the value of field in insert_tuples' INSERT
+        '''
+        return '?'
+
+    def bulk_create(self, records, batch_size):
+        '''
+        Inserts unsaved model instances batch_size rows per INSERT
+        '''
+        self.model.bulk_create(records, batch_size=batch_size)
+
+
+class SqliteUserStore(SqliteStore):
+    '''
+    Users kept in the SQLite users table
+    '''
+    model = sm.Users
+    id_name = 'user_id'
+    status_model = sm.Status
+
+    def insert(self, user_id, email, user_name, user_last_name):
+        '''
+        Stores a new user
+        '''
+        self.model.create(user_id=user_id, user_email=email,
+                          user_name=user_name, user_last_name=user_last_name)
+
+    def update(self, user_id, email, user_name, user_last_name):
+        '''
+        Changes a stored user; False if it doesn't exist
+        '''
+        return bool(self.model.update(
+            {self.model.user_email: email,
+             self.model.user_name: user_name,
+             self.model.user_last_name: user_last_name})
+                    .where(self.model.user_id == user_id).execute())
+
+    def delete(self, user_id):
+        '''
+        Deletes a user (its statuses cascade); False if it doesn't exist
+        '''
+        return bool(self.model.delete()
+                    .where(self.model.user_id == user_id).execute())
+
+    def delete_with_statuses(self, user_id, batch_size):
+        '''
+        Deletes a user's statuses in transactions of at most batch_size
+        rows, then the user. Returns the number of statuses deleted, or
+        None if the user doesn't exist.
+        '''
+        status_table = self.status_model
+        deleted = 0
+        while True:
+            with sm.db.atomic():
+                batch = (status_table.select(status_table.status_id)
+                         .where(status_table.user_id == self.key(user_id))
+                         .limit(batch_size))
+                count = (status_table.delete()
+                         .where(status_table.status_id.in_(batch))
+                         .execute())
+            deleted += count
+            if count < batch_size:
+                break
+        with sm.db.atomic():
+            removed = self.delete(user_id)
+        return deleted if removed else None
+
+    def get(self, user_id):
+        '''
+        Returns the stored user or None
+        '''
+        try:
+            return self.model.get_by_id(user_id)
+        except pw.DoesNotExist:
+            return None
+
+    def get_many(self, user_ids):
+        '''
+        Returns {user_id: user} for the stored ones of user_ids, one
+        IN query per chunk of SQLite's variable limit
+        '''
+        found = {}
+        step = sm.max_variable_number()
+        for start in range(0, len(user_ids), step):
+            chunk = user_ids[start:start + step]
+            found.update((user.user_id, user) for user in
+                         self.model.select()
+                         .where(self.model.user_id.in_(chunk)))
+        return found
+
+
+class SqliteStatusStore(SqliteStore):
+    '''
+    Statuses kept in the SQLite status table. With a read_replica,
+    searches are served from its snapshot.
+    '''
+    model = sm.Status
+    id_name = 'status_id'
+
+    def __init__(self, read_replica=None):
+        self.read_replica = read_replica
+
+    def reads(self, query):
+        '''
+        Routes a search query to the read replica when one is configured
+        '''
+        if self.read_replica is None:
+            return query
+        return self.read_replica.bind(query)
+
+    def select(self):
+        '''
+        Returns a query of every status
+        '''
+        return self.model.select()
+
+    def insert(self, status_id, user_id, status_text):
+        '''
+        Stores a new status
+        '''
+        self.model.insert(status_id=status_id, user_id=self.key(user_id),
+                          status_text=status_text).execute()
+
+    def update(self, status_id, user_id, status_text):
+        '''
+        Changes a stored status; False if it doesn't exist
+        '''
+        return bool(self.model.update(
+            {self.model.user_id: self.key(user_id),
+             self.model.status_text: status_text})
+                    .where(self.model.status_id == status_id).execute())
+
+    def delete(self, status_id):
+        '''
+        Deletes a status; False if it doesn't exist
+        '''
+        return bool(self.model.delete()
+                    .where(self.model.status_id == status_id).execute())
+
+    def get(self, status_id):
+        '''
+        Returns the stored status or None
+        '''
+        return self.reads(self.model.select().where(
+            self.model.status_id == status_id)).get_or_none()
+
+    def get_many(self, status_ids):
+        '''
+        Returns {status_id: status} for the stored ones of status_ids,
+        one IN query per chunk of SQLite's variable limit
+        '''
+        found = {}
+        step = sm.max_variable_number()
+        for start in range(0, len(status_ids), step):
+            chunk = status_ids[start:start + step]
+            found.update((status.status_id, status) for status in
+                         self.reads(self.select().where(
+                             self.model.status_id.in_(chunk))))
+        return found
+
+    def by_user(self, user_id):
+        '''
+        Returns a query of a user's statuses
+        '''
+        return self.reads(self.select().where(
+            self.model.user_id == self.key(user_id)))
+
+    def count_by_user(self, user_id):
+        '''
+        Number of a user's statuses, counted by SQLite
+        '''
+        return self.reads(self.model.select().where(
+            self.model.user_id == self.key(user_id))).count()
+
+    def containing(self, search_string):
+        '''
+        Iterates over statuses containing search_string (any case)
+        '''
+        return self.reads(self.select().where(
+            self.model.searchable_text().contains(search_string))).iterator()
+
+    def matching_terms(self, spec):
+        '''
+        Iterates over statuses matching an sm.terms_spec in one pass
+        '''
+        return self.reads(self.select().where(
+            pw.fn.status_terms_match(self.model.status_text, spec) == 1)
+                         ).iterator()
+
+    def stream(self, search_string=None, user_id=None, chunk_size=100):
+        '''
+        Yields matching statuses in status_id order, chunk_size rows per
+        query, resuming after the last status_id seen
+        '''
+        conditions = []
+        if search_string is not None:
+            conditions.append(
+                self.model.searchable_text().contains(search_string))
+        if user_id is not None:
+            conditions.append(self.model.user_id == self.key(user_id))
+        last_id = None
+        while True:
+            where = list(conditions)
+            if last_id is not None:
+                where.append(self.model.status_id > last_id)
+            query = self.select()
+            if where:
+                query = query.where(*where)
+            chunk = list(self.reads(query.order_by(self.model.status_id)
+                                    .limit(chunk_size)))
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1].status_id
+
+
+class KeyedStore:
+    '''
+    Translation of the user_id strings callers pass to the integer keys
+    the keyed status table stores
+    '''
+
+    @staticmethod
+    def key(user_id):
+        '''
+        Subquery of the integer key of user_id (NULL if not stored)
+        '''
+        return (sm.KeyedUsers.select(sm.KeyedUsers.user_key)
+                .where(sm.KeyedUsers.user_id == user_id))
+
+
+class KeyedUserStore(KeyedStore, SqliteUserStore):
+    '''
+    Users kept in the users_keyed table, whose integer user_key is what
+    statuses refer to. The user_id strings callers pass are translated
+    to keys inside the SQL, one unique index lookup each.
+    '''
+    model = sm.KeyedUsers
+    status_model = sm.KeyedStatus
+
+    def get(self, user_id):
+        '''
+        Returns the stored user or None
+        '''
+        return self.model.get_or_none(self.model.user_id == user_id)
+
+
+class KeyedStatusStore(KeyedStore, SqliteStatusStore):
+    '''
+    Statuses kept in the status_keyed table, referring to their user by
+    integer key. Searches returning many statuses read them joined to
+    their user, so status.user_id.user_id needs no query per row.
+    '''
+    model = sm.KeyedStatus
+
+    def select(self):
+        '''
+        Returns a query of every status with its user
+        '''
+        return (self.model.select(self.model, sm.KeyedUsers)
+                .join(sm.KeyedUsers))
+
+    @staticmethod
+    def placeholder(field):
+        '''
+        SQL for the value of field in insert_tuples' INSERT: rows hold
+        user_id strings, so the user column looks the key up
+        '''
+        if field is sm.KeyedStatus.user_id:
+            return ('(SELECT "user_key" FROM "users_keyed" '
+                    'WHERE "user_id" = ?)')
+        return '?'
+
+    def bulk_create(self, records, batch_size):
+        '''
+        Inserts unsaved model instances, whose user_id holds the user_id
+        string rather than a key
+        '''
+        model = self.model
+        self.insert_tuples(
+            [model.status_id, model.user_id, model.status_text],
+            [(record.status_id, record.user_key, record.status_text)
+             for record in records])
+
+
+class MemoryDatabase:
+    '''
+    Dict-backed tables shared by a MemoryUserStore and a
+    MemoryStatusStore: rows by id, status_ids per user_id, and status_ids
+    per lower-cased word of their text
+    '''
+
+    def __init__(self):
+        self.users = {}
+        self.statuses = {}
+        self.statuses_by_user = defaultdict(set)
+        self.word_index = defaultdict(set)
+        # ids in insertion order per table, see inserted_since
+        self.inserted_ids = defaultdict(list)
+
+    def index_text(self, status_id, status_text):
+        '''
+        Adds a status to the word index
+        '''
+        for word in set(WORD.findall(status_text.lower())):
+            self.word_index[word].add(status_id)
+
+    def unindex_text(self, status_id, status_text):
+        '''
+        Removes a status from the word index
+        '''
+        for word in set(WORD.findall(status_text.lower())):
+            postings = self.word_index[word]
+            postings.discard(status_id)
+            if not postings:
+                del self.word_index[word]
+
+    def text_candidates(self, search_string):
+        '''
+        Returns status_ids that may contain search_string, or None when
+        the index can't narrow it down. Every word of a substring match
+        lies inside some word of the text, so only postings of indexed
+        words containing each query word can match.
+        '''
+        words = set(WORD.findall(search_string.lower()))
+        if not words:
+            return None
+        candidates = None
+        for word in sorted(words, key=len, reverse=True):
+            ids = set()
+            for indexed, postings in self.word_index.items():
+                if word in indexed:
+                    ids |= postings
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                break
+        return candidates
+
+
+class MemoryStore:
+    '''
+    What the memory user and status stores share: model is the table
+    they stand in for and table the MemoryDatabase dict of their rows
+    '''
+    model = None
+    table = None
+
+    def __init__(self, database=None):
+        self.memory = database if database is not None else MemoryDatabase()
+
+    @property
+    def rows(self):
+        '''
+        The stored rows by id
+        '''
+        return getattr(self.memory, self.table)
+
+    def atomic(self):
+        '''
+        No-op transaction context; memory writes apply immediately and
+        are not rolled back
+        '''
+        return contextlib.nullcontext()
+
+    def count(self):
+        '''
+        Number of stored rows
+        '''
+        return len(self.rows)
+
+    def ids(self):
+        '''
+        Iterates over every stored id
+        '''
+        return iter(list(self.rows))
+
+    def track_inserts(self):
+        '''
+        Memory inserts are always logged
+        '''
+        return True
+
+    def inserted_since(self, mark):
+        '''
+        (mark, ids inserted since the given mark), as for the SQLite
+        stores; ids is None when mark is
+        '''
+        log = self.memory.inserted_ids[self.table]
+        position = len(log)
+        return position, None if mark is None else log[mark:position]
+
+    def existing(self, ids):
+        '''
+        Returns the subset of ids that are stored
+        '''
+        rows = self.rows
+        return {row_id for row_id in ids if row_id in rows}
+
+    def insert_tuples(self, fields, rows):
+        '''
+        Stores row tuples in the order of fields
+        '''
+        names = [field.name for field in fields]
+        for row in rows:
+            self.insert_row(dict(zip(names, row)))
+
+    def bulk_create(self, records, batch_size):
+        '''
+        Stores unsaved model instances
+        '''
+        for record in records:
+            self.insert_row(record.__data__)
+
+
+class MemoryUserStore(MemoryStore):
+    '''
+    Users kept in a MemoryDatabase
+    '''
+    model = sm.Users
+    table = 'users'
+
+    def insert(self, user_id, email, user_name, user_last_name):
+        '''
+        Stores a new user
+        '''
+        self.insert_row({'user_id': user_id, 'user_email': email,
+                         'user_name': user_name,
+                         'user_last_name': user_last_name})
+
+    def insert_row(self, row):
+        '''
+        Stores a dict of field name -> value as a new user
+        '''
+        if row['user_id'] in self.memory.users:
+            raise pw.IntegrityError(
+                f'UNIQUE constraint failed: users.user_id {row["user_id"]}')
+        self.memory.users[row['user_id']] = dict(row)
+        self.memory.inserted_ids['users'].append(row['user_id'])
+
+    def update(self, user_id, email, user_name, user_last_name):
+        '''
+        Changes a stored user; False if it doesn't exist
+        '''
+        if user_id not in self.memory.users:
+            return False
+        self.memory.users[user_id].update(
+            user_email=email, user_name=user_name,
+            user_last_name=user_last_name)
+        return True
+
+    def delete(self, user_id):
+        '''
+        Deletes a user and its statuses; False if it doesn't exist
+        '''
+        return self.delete_with_statuses(user_id) is not None
+
+    def delete_with_statuses(self, user_id, batch_size=None):
+        '''
+        Deletes a user and its statuses. Returns the number of statuses
+        deleted, or None if the user doesn't exist.
+        '''
+        memory = self.memory
+        if memory.users.pop(user_id, None) is None:
+            return None
+        status_ids = memory.statuses_by_user.pop(user_id, set())
+        for status_id in status_ids:
+            memory.unindex_text(status_id,
+                                memory.statuses.pop(status_id)['status_text'])
+        return len(status_ids)
+
+    def get(self, user_id):
+        '''
+        Returns the stored user or None
+        '''
+        row = self.memory.users.get(user_id)
+        return None if row is None else self.model(**row)
+
+    def get_many(self, user_ids):
+        '''
+        Returns {user_id: user} for the stored ones of user_ids
+        '''
+        users = self.memory.users
+        return {user_id: self.model(**users[user_id])
+                for user_id in user_ids if user_id in users}
+
+
+class MemoryStatusStore(MemoryStore):
+    '''
+    Statuses kept in a MemoryDatabase. user_ids must exist in the
+    users of the same MemoryDatabase.
+    '''
+    model = sm.Status
+    table = 'statuses'
+
+    def _check_user(self, user_id):
+        if user_id not in self.memory.users:
+            raise pw.IntegrityError('FOREIGN KEY constraint failed')
+
+    def insert(self, status_id, user_id, status_text):
+        '''
+        Stores a new status
+        '''
+        self.insert_row({'status_id': status_id, 'user_id': user_id,
+                         'status_text': status_text})
+
+    def insert_row(self, row):
+        '''
+        Stores a dict of field name -> value as a new status
+        '''
+        memory = self.memory
+        status_id = row['status_id']
+        if status_id in memory.statuses:
+            raise pw.IntegrityError(
+                f'UNIQUE constraint failed: status.status_id {status_id}')
+        self._check_user(row['user_id'])
+        memory.statuses[status_id] = dict(row)
+        memory.statuses_by_user[row['user_id']].add(status_id)
+        memory.index_text(status_id, row['status_text'])
+        memory.inserted_ids['statuses'].append(status_id)
+
+    def update(self, status_id, user_id, status_text):
+        '''
+        Changes a stored status; False if it doesn't exist
+        '''
+        memory = self.memory
+        row = memory.statuses.get(status_id)
+        if row is None:
+            return False
+        self._check_user(user_id)
+        memory.statuses_by_user[row['user_id']].discard(status_id)
+        memory.statuses_by_user[user_id].add(status_id)
+        memory.unindex_text(status_id, row['status_text'])
+        memory.index_text(status_id, status_text)
+        row.update(user_id=user_id, status_text=status_text)
+        return True
+
+    def delete(self, status_id):
+        '''
+        Deletes a status; False if it doesn't exist
+        '''
+        memory = self.memory
+        row = memory.statuses.pop(status_id, None)
+        if row is None:
+            return False
+        memory.statuses_by_user[row['user_id']].discard(status_id)
+        memory.unindex_text(status_id, row['status_text'])
+        return True
+
+    def _instance(self, row):
+        status = self.model(status_id=row['status_id'],
+                            status_text=row['status_text'])
+        # hand the user over too, so status.user_id never queries SQLite
+        status.user_id = sm.Users(**self.memory.users[row['user_id']])
+        return status
+
+    def get(self, status_id):
+        '''
+        Returns the stored status or None
+        '''
+        row = self.memory.statuses.get(status_id)
+        return None if row is None else self._instance(row)
+
+    def get_many(self, status_ids):
+        '''
+        Returns {status_id: status} for the stored ones of status_ids
+        '''
+        statuses = self.memory.statuses
+        return {status_id: self._instance(statuses[status_id])
+                for status_id in status_ids if status_id in statuses}
+
+    def count_by_user(self, user_id):
+        '''
+        Number of a user's statuses
+        '''
+        return len(self.memory.statuses_by_user.get(user_id, ()))
+
+    def by_user(self, user_id):
+        '''
+        Returns a list of a user's statuses
+        '''
+        return [self._instance(self.memory.statuses[status_id])
+                for status_id in
+                sorted(self.memory.statuses_by_user.get(user_id, ()))]
+
+    def _search(self, search_string, status_ids=None):
+        needle = search_string.lower()
+        candidates = self.memory.text_candidates(search_string)
+        if status_ids is None:
+            status_ids = (self.memory.statuses if candidates is None
+                          else candidates)
+        elif candidates is not None:
+            status_ids = status_ids & candidates
+        statuses = self.memory.statuses
+        return sorted(status_id for status_id in status_ids
+                      if needle in statuses[status_id]['status_text'].lower())
+
+    def containing(self, search_string):
+        '''
+        Iterates over statuses containing search_string (any case)
+        '''
+        return (self._instance(self.memory.statuses[status_id])
+                for status_id in self._search(search_string))
+
+    def matching_terms(self, spec):
+        '''
+        Iterates over statuses matching an sm.terms_spec
+        '''
+        matcher = sm.compile_terms(spec)
+        return (self._instance(row)
+                for _, row in sorted(self.memory.statuses.items())
+                if matcher(row['status_text']))
+
+    def stream(self, search_string=None, user_id=None, chunk_size=100):
+        '''
+        Yields matching statuses in status_id order. The matching ids are
+        taken when iteration starts; chunk_size is accepted for
+        interface parity.
+        '''
+        status_ids = None
+        if user_id is not None:
+            status_ids = set(self.memory.statuses_by_user.get(user_id, ()))
+        if search_string is not None:
+            status_ids = self._search(search_string, status_ids)
+        elif status_ids is None:
+            status_ids = self.memory.statuses
+        for status_id in sorted(status_ids):
+            row = self.memory.statuses.get(status_id)
+            if row is not None:
+                yield self._instance(row)
+
+
+def memory_stores():
+    '''
+    Returns a (user store, status store) pair over one new
+    MemoryDatabase
+    '''
+    database = MemoryDatabase()
+    return MemoryUserStore(database), MemoryStatusStore(database)
+
+
+def keyed_stores():
+    '''
+    Returns a (user store, status store) pair over the integer keyed
+    tables, creating them if needed
+    '''
+    sm.db.create_tables([sm.KeyedUsers, sm.KeyedStatus])
+    return KeyedUserStore(), KeyedStatusStore()
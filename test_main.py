@@ -1,7 +1,14 @@
 '''
 The suite of unit tests for main.py, user_status.py, and users.py
 '''
+import json
 import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from unittest import TestCase
 import mock
 import peewee as pw
@@ -9,6 +16,17 @@ import socialnetwork_model as sm
 from users import UserCollection
 from user_status import UserStatusCollection
 import main as M
+import bloom
+import ingest
+import batch
+import moderation
+import analytics
+import storage
+import text_index
+import maintenance
+import changelog
+import backup
+import loadgen
 
 #pylint: disable=C0103
 test_data = {'Bob': ['bob123', 'Bob', 'Belcher', 'bob123@gmail.com'],
@@ -164,6 +182,25 @@ class UsersTests(TestCase):
         with self.assertRaises(pw.DoesNotExist):
             self.users.database.get_by_id('bob123')
 
+    def test_delete_users(self):
+        '''
+        Tests that several users and their statuses are deleted in batches
+        '''
+        for name in ('Gene', 'Tina'):
+            self.users.add_user(test_data[name][0], test_data[name][1],
+                                test_data[name][2], test_data[name][3])
+        statuses = UserStatusCollection()
+        for i in range(5):
+            statuses.add_status(f'gene234_{i}', 'gene234', 'Burger of the day')
+        result = self.users.delete_users(['gene234', 'tina345', 'nobody',
+                                          'gene234'], batch_size=2)
+        self.assertEqual(result, {'gene234': 5, 'tina345': 0, 'nobody': None})
+        self.assertEqual(list(result), ['gene234', 'tina345', 'nobody'])
+        self.assertIsNone(self.users.search_user('gene234'))
+        self.assertIsNone(self.users.search_user('tina345'))
+        self.assertEqual(sm.Status.select().where(
+            sm.Status.user_id == 'gene234').count(), 0)
+
     def test_search_user(self):
         '''
         Tests that user search returns the right person
@@ -460,6 +497,15 @@ class MainTests(TestCase):
         self.assertTrue(test)
         self.users.delete_user.assert_called_with(test_data['Bob'][0])
 
+    def test_delete_users(self):
+        '''
+        Tests that delete_users calls the usercollection.delete_users correctly
+        '''
+        self.users.delete_users = mock.Mock(return_value={'bob123': 0})
+        test = M.delete_users(['bob123'], self.users, batch_size=10)
+        self.assertEqual(test, {'bob123': 0})
+        self.users.delete_users.assert_called_with(['bob123'], 10)
+
     def test_search_user(self):
         '''
         Test that search user calls the user.search_user method correctly
@@ -537,3 +583,1742 @@ class MainTests(TestCase):
         self.assertEqual(unsuccessful_search, None)
         with self.assertRaises(AttributeError):
             M.search_status(status_data[1][0], 'not a collection')
+
+class CompressedStatusTests(TestCase):
+    '''
+    Tests for the compressed status_text storage
+    '''
+
+    def test_compress_round_trip(self):
+        '''
+        Tests that compressed text decompresses to the original
+        '''
+        text = status_data[3][2]
+        packed = sm.compress_text(text)
+        self.assertIsInstance(packed, bytes)
+        self.assertEqual(sm.decompress_text(packed), text)
+        field = sm.CompressedTextField()
+        self.assertEqual(field.python_value(field.db_value(text)), text)
+
+    def test_searchable_text(self):
+        '''
+        Tests that the SQL search function handles both column types
+        '''
+        self.assertEqual(sm.status_text_decompress('plain'), 'plain')
+        self.assertEqual(
+            sm.status_text_decompress(sm.compress_text('hello world')),
+            'hello world')
+        self.assertIsNone(sm.status_text_decompress(None))
+
+    def test_train_status_dictionary(self):
+        '''
+        Tests that a trained dictionary puts the most common word last
+        '''
+        zdict = sm.train_status_dictionary(['sunny day', 'sunny night'])
+        self.assertTrue(zdict.endswith(b'sunny '))
+        self.assertLessEqual(len(sm.train_status_dictionary(
+            ['word'] * 10, size=3)), 3)
+
+    def test_compressed_collections(self):
+        '''
+        Tests adds, lookups, LIKE scans and the text index on a
+        database storing compressed text, in a process started with
+        SOCIALNETWORK_COMPRESS_STATUS=1
+        '''
+        script = '''
+import json
+import main as M
+import socialnetwork_model as sm
+sm.main()
+M.add_user('bob123', 'bob123@gmail.com', 'Bob', 'Belcher',
+           M.init_user_collection())
+statuses = M.init_status_collection()
+indexed = M.init_status_collection(text_index=True)
+texts = ['I love burgers!', 'Jimmy Pesto sux!', 'Burgers of the day']
+texts += [f'filler {n}' for n in range(9)]
+for n, text in enumerate(texts):
+    M.add_status(f'bob123__{n:05d}', 'bob123', text, indexed)
+
+def ids(rows):
+    return [row.status_id for row in rows]
+
+print(json.dumps({
+    'compressed': sm.COMPRESS_STATUS,
+    'types': [kind for kind, in sm.db.execute_sql(
+        'SELECT DISTINCT typeof(status_text) FROM status')],
+    'text': M.search_status('bob123__00001', indexed).status_text,
+    'like': ids(M.filter_status_by_string('BURGER', statuses)),
+    'index': ids(indexed.text_index.search('burger')),
+    'fallback': indexed.text_index.search('filler'),
+    'scan': len(ids(M.filter_status_by_string('filler', indexed))),
+}))
+'''
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, SOCIALNETWORK_COMPRESS_STATUS='1',
+                       SOCIALNETWORK_DB=os.path.join(tmp, 'net.db'),
+                       PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            result = subprocess.run([sys.executable, '-c', script],
+                                    capture_output=True, text=True,
+                                    timeout=60, cwd=tmp, env=env, check=True)
+        found = json.loads(result.stdout)
+        self.assertEqual(found, {
+            'compressed': True, 'types': ['blob'],
+            'text': 'Jimmy Pesto sux!',
+            'like': ['bob123__00000', 'bob123__00002'],
+            'index': ['bob123__00000', 'bob123__00002'],
+            'fallback': None, 'scan': 9})
+
+class BloomFilterTests(TestCase):
+    '''
+    Tests for the id Bloom filter and its use in the collections
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+
+    def test_bloom_filter(self):
+        '''
+        Tests that added keys are always found and stats are reported
+        '''
+        id_filter = bloom.BloomFilter(capacity=100, error_rate=0.01)
+        for i in range(100):
+            id_filter.add(f'user{i}')
+        self.assertTrue(all(f'user{i}' in id_filter for i in range(100)))
+        misses = sum(f'other{i}' in id_filter for i in range(1000))
+        self.assertLess(misses, 100)
+        self.assertFalse(id_filter.is_full())
+        stats = id_filter.stats()
+        self.assertEqual(stats['keys'], 100)
+        self.assertLess(stats['expected_fp_rate'], 0.05)
+
+    def test_search_miss_skips_database(self):
+        '''
+        Tests that a definite miss never looks the row up
+        '''
+        with mock.patch.object(self.users.store, 'get') as get:
+            self.assertIsNone(self.users.search_user('not_a_user'))
+            get.assert_not_called()
+
+    def test_existing_ids(self):
+        '''
+        Tests that existing_ids only returns stored ids
+        '''
+        self.users.add_user(test_data['Linda'][0], test_data['Linda'][1],
+                            test_data['Linda'][2], test_data['Linda'][3])
+        self.assertEqual(self.users.existing_ids(['linda123', 'nobody']),
+                         {'linda123'})
+        self.assertIn('linda123', UserCollection().id_filter)
+        self.users.delete_user('linda123')
+
+    def test_inserts_elsewhere_are_seen(self):
+        '''
+        Tests that ids stored by another collection, raw SQL or another
+        connection are found without rebuilding the filter
+        '''
+        self.users.check_interval = 0
+        other = UserCollection()
+
+        def add_elsewhere():
+            sm.Users.insert(user_id='gene234', user_email='gene@gmail.com',
+                            user_name='Gene',
+                            user_last_name='Belcher').execute()
+            sm.db.close()
+
+        with mock.patch.object(self.users, 'rebuild_id_filter') as rebuild:
+            other.add_user('bob123', 'bob123@gmail.com', 'Bob', 'Belcher')
+            self.assertIsNotNone(self.users.search_user('bob123'))
+            sm.Users.insert(user_id='linda123', user_email='linda@gmail.com',
+                            user_name='Linda',
+                            user_last_name='Belcher').execute()
+            self.assertEqual(self.users.existing_ids(['linda123']),
+                             {'linda123'})
+            thread = threading.Thread(target=add_elsewhere)
+            thread.start()
+            thread.join()
+            self.assertEqual(set(self.users.search_users(['gene234', 'nobody'])
+                                 .values()) - {None}, {sm.Users['gene234']})
+            self.users.add_user('tina345', 'tina@gmail.com', 'Tina',
+                                'Belcher')
+            self.assertIsNotNone(self.users.search_user('tina345'))
+            rebuild.assert_not_called()
+        sm.db.execute_sql('DROP TRIGGER users_log_insert')
+        self.assertEqual(self.users.store.inserted_since(None), (None, None))
+        self.assertIsNone(self.users.search_user('nobody'))
+        self.assertIsNotNone(self.users.store.inserted_since(None)[0])
+
+    def test_checks_are_rate_limited(self):
+        '''
+        Tests that searches look for inserts elsewhere at most every
+        check_interval seconds, while existing_ids always looks
+        '''
+        self.users.check_interval = 3600
+        UserCollection().add_user('bob123', 'bob123@gmail.com', 'Bob',
+                                  'Belcher')
+        with mock.patch.object(self.users.store, 'inserted_since',
+                               wraps=self.users.store.inserted_since) as since:
+            self.assertIsNone(self.users.search_user('bob123'))
+            self.assertEqual(self.users.search_users(['bob123']),
+                             {'bob123': None})
+            since.assert_not_called()
+            self.assertEqual(self.users.existing_ids(['bob123']), {'bob123'})
+            since.assert_called_once()
+        self.assertIsNotNone(self.users.search_user('bob123'))
+
+    def test_log_rolled_back_or_pruned(self):
+        '''
+        Tests that a filter whose place in the insert log was rolled
+        back or pruned is rebuilt rather than missing ids
+        '''
+        self.users.check_interval = 0
+        other = UserCollection()
+        with sm.db.atomic() as transaction:
+            other.add_user('bob123', 'bob123@gmail.com', 'Bob', 'Belcher')
+            self.assertIsNotNone(self.users.search_user('bob123'))
+            transaction.rollback()
+        other.add_user('gene234', 'gene@gmail.com', 'Gene', 'Belcher')
+        self.assertIsNotNone(self.users.search_user('gene234'))
+        sm.InsertedId.delete().execute()
+        other.add_user('linda123', 'linda@gmail.com', 'Linda', 'Belcher')
+        with mock.patch.object(self.users, 'rebuild_id_filter',
+                               wraps=self.users.rebuild_id_filter) as rebuild:
+            self.assertIsNotNone(self.users.search_user('linda123'))
+            rebuild.assert_called_once()
+
+    def test_memory_store_inserts(self):
+        '''
+        Tests that collections sharing a memory store see each other's ids
+        '''
+        user_store, status_store = storage.memory_stores()
+        users, other_users = UserCollection(user_store), UserCollection(
+            user_store)
+        statuses = UserStatusCollection(store=status_store)
+        other_statuses = UserStatusCollection(store=status_store)
+        other_users.check_interval = other_statuses.check_interval = 0
+        users.add_user('bob123', 'bob123@gmail.com', 'Bob', 'Belcher')
+        statuses.add_status('bob123__00001', 'bob123', 'I love burgers!')
+        self.assertIsNotNone(other_users.search_user('bob123'))
+        self.assertIsNotNone(other_statuses.search_status('bob123__00001'))
+
+    def test_concurrent_adds(self):
+        '''
+        Tests that keys added from several threads at once are all kept
+        '''
+        id_filter = bloom.BloomFilter(capacity=40000)
+        keys = [[f'user{n}_{i}' for i in range(5000)] for n in range(8)]
+        threads = [threading.Thread(target=id_filter.add_many, args=(chunk,))
+                   for chunk in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(key in id_filter for chunk in keys
+                            for key in chunk))
+        self.assertEqual(id_filter.count, 40000)
+
+class ReadReplicaTests(TestCase):
+    '''
+    Tests for the read-only replica used by status searches
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.replica = sm.ReadReplica(os.path.join(self.tmp.name, 'ro.db'),
+                                      refresh_interval=3600)
+        self.users = UserCollection()
+        self.users.add_user(test_data['Tina'][0], test_data['Tina'][1],
+                            test_data['Tina'][2], test_data['Tina'][3])
+        self.statuses = UserStatusCollection(self.replica)
+        self.statuses.add_status('tina345_1', 'tina345', 'Horse night')
+
+    def tearDown(self):
+        self.replica.close()
+        self.tmp.cleanup()
+        self.users.delete_user('tina345')
+
+    def test_searches_read_snapshot(self):
+        '''
+        Tests that searches see the snapshot until it is refreshed
+        '''
+        self.assertIsNone(self.statuses.search_status('tina345_1'))
+        self.replica.refresh()
+        self.assertEqual(self.statuses.search_status('tina345_1').status_text,
+                         'Horse night')
+        self.assertEqual(len(list(
+            self.statuses.search_all_status_updates('tina345'))), 1)
+        self.assertEqual(len(list(
+            self.statuses.filter_status_by_string('Horse'))), 1)
+
+    def test_background_refresh(self):
+        '''
+        Tests that a new snapshot is taken off the query path, and that
+        the default file is named after the database
+        '''
+        self.assertEqual(sm.replica_path(os.path.join('data', 'net.db')),
+                         os.path.join('data', 'net_replica.db'))
+        self.assertEqual(sm.replica_path(':memory:'),
+                         'socialnetwork_replica.db')
+        replica = sm.ReadReplica(os.path.join(self.tmp.name, 'bg.db'),
+                                 refresh_interval=0.05)
+        try:
+            statuses = UserStatusCollection(replica)
+            statuses.check_interval = 0
+            self.statuses.add_status('tina345_2', 'tina345', 'Butts')
+            deadline = time.monotonic() + 10
+            while (statuses.search_status('tina345_2') is None and
+                   time.monotonic() < deadline):
+                time.sleep(0.02)
+            self.assertEqual(statuses.search_status('tina345_2').status_text,
+                             'Butts')
+        finally:
+            replica.close()
+        self.assertFalse(replica._thread.is_alive())
+
+    def test_replica_is_read_only(self):
+        '''
+        Tests that the replica connection rejects writes
+        '''
+        with self.assertRaises(pw.OperationalError):
+            self.replica.database.execute_sql('DELETE FROM status')
+
+class IngestTests(TestCase):
+    '''
+    Tests for the fast CSV parsers used by the loaders
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.tmp.name, 'statuses.csv')
+        with open(self.file_name, 'w') as f:
+            f.write('\n'.join(['status_id,user_id,status_text',
+                               ','.join(status_data[1]),
+                               'bob123__00003,bob123,"Burgers, fries"',
+                               ','.join(status_data[2])]) + '\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parsers_agree(self):
+        '''
+        Tests that every parser returns the same rows
+        '''
+        expected = [tuple(status_data[1]),
+                    ('bob123__00003', 'bob123', 'Burgers, fries'),
+                    tuple(status_data[2])]
+        parsers = ['csv', 'block']
+        if ingest.pa_csv is not None:
+            parsers.append('arrow')
+        for parser in parsers:
+            rows = [row for batch in ingest.read_csv_batches(
+                self.file_name, 2, parser) for row in batch]
+            self.assertEqual(rows, expected)
+        with self.assertRaises(ValueError):
+            list(ingest.read_csv_batches(self.file_name, 2, 'nope'))
+
+    def test_ids_stay_strings(self):
+        '''
+        Tests that numeric looking ids keep their leading zeros
+        '''
+        with open(self.file_name, 'w') as f:
+            f.write('status_id,user_id,status_text\n'
+                    '007,0042,1.50\n0010,0042,2e3\n')
+        parsers = ['csv', 'block']
+        if ingest.pa_csv is not None:
+            parsers.append('arrow')
+        for parser in parsers:
+            rows = [row for batch in ingest.read_csv_batches(
+                self.file_name, 10, parser) for row in batch]
+            self.assertEqual(rows, [('007', '0042', '1.50'),
+                                    ('0010', '0042', '2e3')])
+
+    def test_line_breaks(self):
+        '''
+        Tests that rows only end at \\n or \\r\\n, so form feeds and
+        other Unicode line breaks stay in the text, and that quoted
+        values may span lines
+        '''
+        with open(self.file_name, 'w', newline='') as f:
+            f.write('status_id,user_id,status_text\r\n'
+                    'a1,bob123,page\x0cbreak \u2028 and \x85\r\n'
+                    'a2,bob123,plain\n')
+        multiline = os.path.join(self.tmp.name, 'multiline.csv')
+        with open(multiline, 'w', newline='') as f:
+            f.write('status_id,user_id,status_text\n'
+                    'a3,bob123,"two\nlines"\na4,bob123,one\n')
+        parsers = ['csv', 'block', 'auto']
+        if ingest.pa_csv is not None:
+            parsers.append('arrow')
+        for parser in parsers:
+            for name, expected in (
+                    (self.file_name,
+                     [('a1', 'bob123', 'page\x0cbreak \u2028 and \x85'),
+                      ('a2', 'bob123', 'plain')]),
+                    (multiline, [('a3', 'bob123', 'two\nlines'),
+                                 ('a4', 'bob123', 'one')])):
+                rows = [row for batch in ingest.read_csv_batches(
+                    name, 10, parser) for row in batch]
+                self.assertEqual(rows, expected, (parser, name))
+
+    def test_block_offsets(self):
+        '''
+        Tests that small blocks keep quoted fields whole and report
+        the offset of the end of the data
+        '''
+        blocks = list(ingest.iter_csv_blocks(self.file_name, block_size=16))
+        rows = [row for batch, _ in blocks for row in batch]
+        self.assertIn(('bob123__00003', 'bob123', 'Burgers, fries'), rows)
+        self.assertEqual(blocks[-1][1], os.path.getsize(self.file_name))
+
+    def test_fast_load_status_updates(self):
+        '''
+        Tests that the fast loader path inserts rows and rejects
+        malformed files
+        '''
+        sm.main()
+        users = UserCollection()
+        users.add_user(test_data['Bob'][0], test_data['Bob'][1],
+                       test_data['Bob'][2], test_data['Bob'][3])
+        statuses = UserStatusCollection()
+        with mock.patch('builtins.print'):
+            self.assertTrue(M.load_status_updates(self.file_name, statuses,
+                                                  parser='block'))
+            self.assertEqual(statuses.search_status('bob123__00003')
+                             .status_text, 'Burgers, fries')
+            bad_file = os.path.join(self.tmp.name, 'bad.csv')
+            with open(bad_file, 'w') as f:
+                f.write('header\nonly,two columns\n')
+            self.assertFalse(M.load_status_updates(bad_file, statuses,
+                                                   parser='block'))
+        users.delete_user('bob123')
+
+class BatchRunnerTests(TestCase):
+    '''
+    Tests for the non-interactive batch runner
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.statuses = UserStatusCollection()
+
+    def test_run_batch(self):
+        '''
+        Tests that operations run in order and report per-op results
+        '''
+        operations = [
+            {'op': 'add_user', 'user_id': 'louise456', 'email': 'l@gmail.com',
+             'user_name': 'Louise', 'user_last_name': 'Belcher'},
+            {'op': 'add_status', 'status_id': 'louise456_1',
+             'user_id': 'louise456', 'status_text': 'Kuchi Kopi'},
+            {'op': 'search_all_status_updates', 'user_id': 'louise456'},
+            {'op': 'search_user', 'user_id': 'louise456'},
+            {'op': 'add_status', 'status_id': 'louise456_2'},
+            {'op': 'launch_rocket'},
+            {'op': 'delete_user', 'user_id': 'louise456'}]
+        records = []
+        summary = batch.run_batch(operations, self.users, self.statuses,
+                                  batch_size=2, on_result=records.append)
+        self.assertEqual(summary['ops'], 7)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual(records[2]['result'], ['louise456_1'])
+        self.assertEqual(records[3]['result']['user_name'], 'Louise')
+        self.assertIn('missing field', records[4]['error'])
+        self.assertEqual(records[5]['error'], 'unknown op')
+        self.assertIsNone(self.users.search_user('louise456'))
+
+    def test_failed_op_is_undone(self):
+        '''
+        Tests that an op raising any error is rolled back on its own and
+        reported, while the rest of its batch commits
+        '''
+        def half_done(user_id, user_collection):
+            M.add_user(user_id, 'x@gmail.com', 'X', 'Y', user_collection)
+            raise RuntimeError('boom')
+
+        operations = [
+            {'op': 'add_user', 'user_id': 'louise456', 'email': 'l@gmail.com',
+             'user_name': 'Louise', 'user_last_name': 'Belcher'},
+            {'op': 'half_done', 'user_id': 'teddy567'}]
+        records = []
+        with mock.patch.dict(batch.OPERATIONS, {
+                'half_done': (half_done, ('user_id',), 'user')}):
+            summary = batch.run_batch(operations, self.users, self.statuses,
+                                      on_result=records.append)
+        self.assertEqual((summary['ops'], summary['failed']), (2, 1))
+        self.assertEqual(records[1]['error'], 'boom')
+        self.assertEqual([u.user_id for u in sm.Users.select()],
+                         ['louise456'])
+
+    def test_malformed_line(self):
+        '''
+        Tests that a bad JSON line is reported and the ops read before
+        it still run
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            jsonl = os.path.join(tmp, 'ops.jsonl')
+            with open(jsonl, 'w') as f:
+                f.write('{"op": "add_user", "user_id": "louise456", '
+                        '"email": "l@gmail.com", "user_name": "Louise", '
+                        '"user_last_name": "Belcher"}\n{"op": \n')
+            records = []
+            summary = batch.run_batch(batch.read_operations(jsonl),
+                                      self.users, self.statuses,
+                                      on_result=records.append)
+        self.assertEqual((summary['ops'], summary['failed']), (2, 1))
+        self.assertIn('line 2: invalid JSON', records[1]['error'])
+        self.assertIsNotNone(self.users.search_user('louise456'))
+
+    def test_read_operations(self):
+        '''
+        Tests that JSONL and CSV operation files are both read
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            jsonl = os.path.join(tmp, 'ops.jsonl')
+            with open(jsonl, 'w') as f:
+                f.write('{"op": "search_user", "user_id": "bob123"}\n\n')
+            table = os.path.join(tmp, 'ops.csv')
+            with open(table, 'w') as f:
+                f.write('op,user_id,status_id\nsearch_user,bob123,\n')
+            expected = [{'op': 'search_user', 'user_id': 'bob123'}]
+            self.assertEqual(list(batch.read_operations(jsonl)), expected)
+            self.assertEqual(list(batch.read_operations(table)), expected)
+
+    def test_command_line_keeps_database(self):
+        '''
+        Tests that the command line neither empties socialnetwork.db
+        nor touches it when --db points elsewhere
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            jsonl = os.path.join(tmp, 'ops.jsonl')
+            with open(jsonl, 'w') as f:
+                f.write('{"op": "add_user", "user_id": "bob123", '
+                        '"email": "bob@gmail.com", "user_name": "Bob", '
+                        '"user_last_name": "Belcher"}\n')
+            default = os.path.join(tmp, 'socialnetwork.db')
+            with open(default, 'wb') as f:
+                f.write(b'kept')
+            env = dict(os.environ)
+            env.pop('SOCIALNETWORK_DB', None)
+            env.pop('SOCIALNETWORK_KEEP_DB', None)
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'batch.py')
+            result = subprocess.run(
+                [sys.executable, script, jsonl, '--db', 'other.db'],
+                capture_output=True, text=True, timeout=60, cwd=tmp, env=env,
+                check=True)
+            self.assertEqual(json.loads(result.stdout)['failed'], 0)
+            with open(default, 'rb') as f:
+                self.assertEqual(f.read(), b'kept')
+            with sqlite3.connect(os.path.join(tmp, 'other.db')) as other:
+                self.assertEqual(other.execute(
+                    'SELECT user_id FROM users').fetchall(), [('bob123',)])
+            other.close()
+
+class BufferedStatusWriterTests(TestCase):
+    '''
+    Tests for the write-behind status buffer
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.users.add_user(test_data['Linda'][0], test_data['Linda'][1],
+                            test_data['Linda'][2], test_data['Linda'][3])
+        self.statuses = UserStatusCollection()
+        self.writer = M.init_status_writer(self.statuses, max_ops=100,
+                                           max_delay_ms=10000)
+
+    def tearDown(self):
+        self.writer.close()
+        self.users.delete_user('linda123')
+
+    def test_flush_resolves_futures(self):
+        '''
+        Tests that queued writes land on flush and failures are reported
+        '''
+        first = M.add_status(status_data[3][0], status_data[3][1],
+                             status_data[3][2], self.writer)
+        duplicate = self.writer.add_status(status_data[3][0],
+                                           status_data[3][1], 'again')
+        changed = M.update_status(status_data[3][0], status_data[3][1],
+                                  'Alright!', self.writer)
+        self.assertFalse(first.done())
+        self.assertEqual(self.writer.flush(), 3)
+        self.assertTrue(first.result())
+        self.assertFalse(duplicate.result())
+        self.assertTrue(changed.result())
+        self.assertEqual(self.statuses.search_status(status_data[3][0])
+                         .status_text, 'Alright!')
+
+    def test_non_database_error(self):
+        '''
+        Tests that any error fails only its own future and the writer
+        thread keeps going
+        '''
+        with mock.patch.object(self.statuses, 'add_status',
+                               side_effect=TypeError('bad text')):
+            bad = self.writer.add_status('linda123_2', 'linda123', None)
+            self.writer._wakeup.set()
+            with self.assertRaises(TypeError):
+                bad.result(timeout=5)
+        self.assertTrue(self.writer._thread.is_alive())
+        good = self.writer.add_status('linda123_3', 'linda123', 'Wine')
+        self.writer._wakeup.set()
+        self.assertTrue(good.result(timeout=5))
+
+    def test_close_flushes(self):
+        '''
+        Tests that closing flushes pending writes and rejects new ones
+        '''
+        future = self.writer.add_status('linda123_2', 'linda123', 'Wine')
+        self.writer.close()
+        self.assertTrue(future.result(timeout=1))
+        with self.assertRaises(RuntimeError):
+            self.writer.add_status('linda123_3', 'linda123', 'More wine')
+
+class TermSearchTests(TestCase):
+    '''
+    Tests for multi-word boolean status search
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.users.add_user(test_data['Gene'][0], test_data['Gene'][1],
+                            test_data['Gene'][2], test_data['Gene'][3])
+        self.statuses = UserStatusCollection()
+        for i, text in enumerate(['Farts are funny', 'Keyboard solo',
+                                  'funny keyboard noises']):
+            self.statuses.add_status(f'gene234_{i}', 'gene234', text)
+
+    def tearDown(self):
+        self.users.delete_user('gene234')
+
+    def search(self, all_terms=(), any_terms=(), none_terms=()):
+        '''
+        Returns the sorted status ids matching a term search
+        '''
+        return sorted(status.status_id for status in M.search_status_terms(
+            all_terms, any_terms, none_terms, self.statuses))
+
+    def test_boolean_terms(self):
+        '''
+        Tests AND, OR and NOT term semantics
+        '''
+        self.assertEqual(self.search(all_terms=['funny', 'KEYBOARD']),
+                         ['gene234_2'])
+        self.assertEqual(self.search(any_terms=['fart', 'solo']),
+                         ['gene234_0', 'gene234_1'])
+        self.assertEqual(self.search(any_terms=['keyboard'],
+                                     none_terms=['noises']), ['gene234_1'])
+        with self.assertRaises(ValueError):
+            self.statuses.search_status_terms()
+
+    def test_compile_terms(self):
+        '''
+        Tests that the compiled matcher escapes regex characters
+        '''
+        matcher = sm.compile_terms(sm.terms_spec(any_terms=['a.b', '(x']))
+        self.assertTrue(matcher('say a.b'))
+        self.assertFalse(matcher('say axb'))
+        self.assertTrue(matcher('(x marks'))
+
+class ModerationTests(TestCase):
+    '''
+    Tests for the incremental moderation scanner
+    '''
+
+    def setUp(self):
+        sm.main()
+        moderation.install()
+        self.users = UserCollection()
+        self.users.add_user(test_data['Tina'][0], test_data['Tina'][1],
+                            test_data['Tina'][2], test_data['Tina'][3])
+        self.statuses = UserStatusCollection()
+        for i, text in enumerate(['I love horses', 'Jimmy Jr is dreamy',
+                                  'Zombies and butts']):
+            self.statuses.add_status(f'tina345_{i}', 'tina345', text)
+
+    def tearDown(self):
+        self.users.delete_user('tina345')
+        moderation.uninstall()
+
+    def flagged_ids(self, blocklist):
+        '''
+        Returns the sorted ids flagged for a blocklist
+        '''
+        return sorted(s.status_id for s in M.flagged_statuses(blocklist))
+
+    def test_incremental_runs(self):
+        '''
+        Tests that later runs only scan new and changed statuses
+        '''
+        blocklist = ['butts', 'dreamy']
+        stats = M.moderate_statuses(blocklist)
+        self.assertEqual((stats['scanned'], stats['flagged']), (3, 2))
+        self.assertEqual(self.flagged_ids(blocklist),
+                         ['tina345_1', 'tina345_2'])
+        self.assertEqual(M.moderate_statuses(blocklist)['scanned'], 0)
+        self.statuses.add_status('tina345_3', 'tina345', 'More butts')
+        self.statuses.modify_status('tina345_1', 'tina345', 'Jimmy Jr')
+        stats = M.moderate_statuses(blocklist)
+        self.assertEqual((stats['scanned'], stats['flagged'],
+                          stats['cleared']), (2, 1, 1))
+        self.assertEqual(self.flagged_ids(blocklist),
+                         ['tina345_2', 'tina345_3'])
+        # a different blocklist keeps its own progress
+        self.assertEqual(M.moderate_statuses(['horses'])['flagged'], 1)
+
+    def test_flagged_counts_new_flags_only(self):
+        '''
+        Tests that re-queued statuses already flagged aren't counted again
+        '''
+        blocklist = ['butts']
+        self.assertEqual(M.moderate_statuses(blocklist)['flagged'], 1)
+        self.statuses.modify_status('tina345_2', 'tina345', 'Zombie butts')
+        stats = M.moderate_statuses(blocklist)
+        self.assertEqual((stats['scanned'], stats['flagged']), (1, 0))
+
+    def test_abandoned_blocklist_is_retired(self):
+        '''
+        Tests that an idle blocklist version stops pinning the queue
+        '''
+        M.moderate_statuses(['horses'])
+        M.moderate_statuses(['butts'])
+        self.statuses.add_status('tina345_3', 'tina345', 'More butts')
+        M.moderate_statuses(['butts'])
+        self.assertEqual(moderation.ModerationQueue.select().count(), 1)
+        moderation.ModerationCheckpoint.update(last_run=0).where(
+            moderation.ModerationCheckpoint.blocklist_version ==
+            moderation.blocklist_version(['horses'])).execute()
+        M.moderate_statuses(['butts'])
+        self.assertEqual(moderation.ModerationQueue.select().count(), 0)
+        self.assertEqual(self.flagged_ids(['butts']),
+                         ['tina345_2', 'tina345_3'])
+        # run again, a retired blocklist rescans from scratch
+        self.assertEqual(M.moderate_statuses(['horses'])['scanned'], 4)
+
+    def test_resume(self):
+        '''
+        Tests that an interrupted scan resumes from its checkpoint
+        '''
+        scanner = moderation.ModerationScanner(['horses', 'zombies'],
+                                               chunk_size=1)
+        self.assertEqual(scanner.run(max_chunks=2)['scanned'], 2)
+        stats = scanner.run()
+        self.assertEqual(stats['scanned'], 1)
+        self.assertTrue(stats['caught_up'])
+        self.assertEqual(len(list(scanner.flagged())), 2)
+
+class StreamingTests(TestCase):
+    '''
+    Tests for chunked keyset streaming of statuses
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.users.add_user(test_data['Gene'][0], test_data['Gene'][1],
+                            test_data['Gene'][2], test_data['Gene'][3])
+        self.statuses = UserStatusCollection()
+        for i in range(5):
+            self.statuses.add_status(f'gene234_{i}', 'gene234',
+                                     'Keyboard' if i % 2 else 'Fart')
+
+    def tearDown(self):
+        self.users.delete_user('gene234')
+
+    def test_stream_in_chunks(self):
+        '''
+        Tests that streaming returns every row in order, one query per
+        chunk
+        '''
+        with mock.patch.object(sm.db, 'execute_sql',
+                               wraps=sm.db.execute_sql) as execute:
+            rows = list(M.stream_status_updates('gene234', self.statuses,
+                                                chunk_size=2))
+        self.assertEqual([row.status_id for row in rows],
+                         [f'gene234_{i}' for i in range(5)])
+        self.assertEqual(execute.call_count, 3)
+        self.assertEqual([row.status_id for row in M.stream_status_by_string(
+            'keyboard', self.statuses, chunk_size=1)],
+                         ['gene234_1', 'gene234_3'])
+
+class AnalyticsTests(TestCase):
+    '''
+    Tests for the SQL-side analytics queries
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        for name in ('Gene', 'Tina', 'Linda'):
+            self.users.add_user(test_data[name][0], test_data[name][3],
+                                test_data[name][1], test_data[name][2])
+        self.statuses = UserStatusCollection()
+        for i in range(3):
+            self.statuses.add_status(f'gene234_{i}', 'gene234', 'Fart')
+        self.statuses.add_status('tina345_0', 'tina345', 'Horses')
+
+    def tearDown(self):
+        analytics.uninstall_summary()
+        self.users.delete_users(['gene234', 'tina345', 'linda123'])
+
+    def test_top_posters(self):
+        '''
+        Tests top posters with and without the summary table
+        '''
+        expected = [('gene234', 3), ('tina345', 1)]
+        self.assertEqual(list(analytics.top_posters(2)), expected)
+        analytics.install_summary()
+        self.assertEqual(list(analytics.top_posters(2, use_summary=True)),
+                         expected)
+        # triggers keep the summary current
+        self.statuses.delete_status('gene234_0')
+        self.statuses.modify_status('tina345_0', 'linda123', 'Horses')
+        self.statuses.add_status('linda123_0', 'linda123', 'Alright')
+        self.assertEqual(list(analytics.top_posters(2, use_summary=True)),
+                         [('gene234', 2), ('linda123', 2)])
+
+    def test_domains_and_silent_users(self):
+        '''
+        Tests per-domain counts and users without statuses
+        '''
+        self.assertIn(('gmail.com', 3, 4),
+                      list(analytics.statuses_per_email_domain()))
+        self.assertIn(('linda123',), list(analytics.users_without_statuses()))
+        columns = analytics.as_arrays(analytics.top_posters(2),
+                                      ['user_id', 'count'])
+        self.assertEqual(list(columns['count']), [3, 1])
+        self.assertEqual(list(analytics.as_arrays([], ['a'])['a']), [])
+
+class BatchSizeTests(TestCase):
+    '''
+    Tests for derived batch sizes and chunked commits in the loaders
+    '''
+
+    def test_max_rows_per_insert(self):
+        '''
+        Tests that batches respect the variable limit and the cap
+        '''
+        limit = sm.max_variable_number()
+        self.assertGreaterEqual(limit, 999)
+        self.assertEqual(sm.max_rows_per_insert(3, cap=limit), limit // 3)
+        self.assertEqual(sm.max_rows_per_insert(3, cap=10), 10)
+        self.assertEqual(sm.max_rows_per_insert(limit * 2), 1)
+
+    def test_commit_every(self):
+        '''
+        Tests that the loaders commit in chunks of commit_every rows
+        '''
+        sm.main()
+        users = UserCollection()
+        with tempfile.TemporaryDirectory() as tmp:
+            file_name = os.path.join(tmp, 'accounts.csv')
+            with open(file_name, 'w') as f:
+                f.write('USER_ID,NAME,LASTNAME,EMAIL\n')
+                for i in range(5):
+                    f.write(f'teddy{i},Teddy,T,teddy{i}@gmail.com\n')
+            for parser in (None, 'block'):
+                with mock.patch.object(sm.db, 'atomic',
+                                       wraps=sm.db.atomic) as atomic, \
+                        mock.patch('builtins.print'):
+                    self.assertTrue(M.load_users(file_name, users, parser,
+                                                 batch_size=2,
+                                                 commit_every=2))
+                self.assertEqual(atomic.call_count, 3)
+                self.assertEqual(users.delete_users(
+                    [f'teddy{i}' for i in range(5)]),
+                                 {f'teddy{i}': 0 for i in range(5)})
+
+class ResumableLoadTests(TestCase):
+    '''
+    Tests for checkpointed, resumable CSV loads
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.tmp.name, 'accounts.csv')
+        with open(self.file_name, 'w') as f:
+            f.write('USER_ID,NAME,LASTNAME,EMAIL\n')
+            for i in range(6):
+                f.write(f'louise{i},Louise,B,louise{i}@gmail.com\n')
+
+    def tearDown(self):
+        self.users.delete_users([f'louise{i}' for i in range(6)])
+        sm.db.drop_tables([sm.IngestCheckpoint])
+        self.tmp.cleanup()
+
+    def test_resume_after_failure(self):
+        '''
+        Tests that a failed load continues from its last commit
+        '''
+        real_insert = storage.SqliteUserStore.insert_tuples
+        calls = []
+
+        def failing_insert(*args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise pw.OperationalError('disk I/O error')
+            real_insert(*args)
+
+        with mock.patch.object(ingest, 'BLOCK_SIZE', 64), \
+                mock.patch('builtins.print'):
+            with mock.patch.object(storage.SqliteUserStore, 'insert_tuples',
+                                   failing_insert):
+                with self.assertRaises(pw.OperationalError):
+                    M.load_users(self.file_name, self.users, resumable=True)
+            checkpoint = sm.IngestCheckpoint.get()
+            self.assertFalse(checkpoint.done)
+            with open(self.file_name, 'rb') as f:
+                committed = f.read(checkpoint.byte_offset).count(b'\n') - 1
+            self.assertGreater(committed, 0)
+            self.assertLess(committed, 6)
+            self.assertEqual(sm.Users.select().where(
+                sm.Users.user_id.startswith('louise')).count(), committed)
+            with mock.patch.object(ingest, 'iter_csv_blocks',
+                                   wraps=ingest.iter_csv_blocks) as blocks:
+                self.assertTrue(M.load_users(self.file_name, self.users,
+                                             resumable=True))
+            self.assertEqual(blocks.call_args[0][1], checkpoint.byte_offset)
+        self.assertTrue(sm.IngestCheckpoint.get().done)
+        self.assertEqual(sm.Users.select().where(
+            sm.Users.user_id.startswith('louise')).count(), 6)
+        with mock.patch.object(ingest, 'iter_csv_blocks') as blocks, \
+                mock.patch('builtins.print'):
+            self.assertTrue(M.load_users(self.file_name, self.users,
+                                         resumable=True))
+        blocks.assert_not_called()
+
+    def test_changed_file_starts_over(self):
+        '''
+        Tests that a checkpoint is discarded once the file changes
+        '''
+        with mock.patch('builtins.print'):
+            self.assertTrue(M.load_users(self.file_name, self.users,
+                                         resumable=True))
+            with open(self.file_name, 'a') as f:
+                f.write('louise5,Louise,B\n')
+            self.assertFalse(M.load_users(self.file_name, self.users,
+                                          resumable=True))
+        checkpoint = sm.IngestCheckpoint.get()
+        self.assertFalse(checkpoint.done)
+        self.assertEqual(checkpoint.byte_offset, 0)
+
+class MemoryStoreTests(TestCase):
+    '''
+    Tests for the in-memory storage backend
+    '''
+
+    def setUp(self):
+        self.users, self.statuses = M.init_memory_collections()
+        for name in ('Bob', 'Linda'):
+            user_id, user_name, last_name, email = test_data[name]
+            M.add_user(user_id, email, user_name, last_name, self.users)
+        for status_id, user_id, text in status_data.values():
+            M.add_status(status_id, user_id, text, self.statuses)
+
+    def test_crud(self):
+        '''
+        Tests that the memory store enforces keys like SQLite
+        '''
+        self.assertEqual(self.users.database, sm.Users)
+        self.assertFalse(M.add_user('bob123', 'b@gmail.com', 'B', 'B',
+                                    self.users))
+        self.assertIsNone(M.add_status('tina__1', 'tina345', 'hi',
+                                       self.statuses))
+        self.assertFalse(M.update_status('bob123__00001', 'tina345', 'hi',
+                                         self.statuses))
+        self.assertTrue(M.update_user('bob123', 'bobby@gmail.com', 'Bob',
+                                      'Belcher', self.users))
+        self.assertEqual(M.search_user('bob123', self.users).user_email,
+                         'bobby@gmail.com')
+        status = M.search_status('bob123__00002', self.statuses)
+        self.assertEqual(status.user_id.user_email, 'bobby@gmail.com')
+        self.assertEqual(M.delete_users(['bob123', 'nobody'], self.users),
+                         {'bob123': 2, 'nobody': None})
+        self.assertIsNone(M.search_status('bob123__00001', self.statuses))
+        self.assertEqual(self.statuses.store.count(), 1)
+
+    def test_text_search(self):
+        '''
+        Tests substring searches through the word index
+        '''
+        self.assertTrue(M.update_status('bob123__00001', 'bob123',
+                                        'I love hot dogs!', self.statuses))
+        self.assertEqual([s.status_id for s in
+                          M.filter_status_by_string('URGER', self.statuses)],
+                         [])
+        self.assertEqual([s.status_id for s in
+                          M.filter_status_by_string('o suX', self.statuses)],
+                         ['bob123__00002'])
+        self.assertEqual([s.status_id for s in
+                          M.search_status_terms(['love'], [], [],
+                                                self.statuses)],
+                         ['bob123__00001'])
+        self.assertEqual([s.status_id for s in M.stream_status_updates(
+            'bob123', self.statuses)], ['bob123__00001', 'bob123__00002'])
+        self.assertEqual([s.status_id for s in M.stream_status_by_string(
+            '!', self.statuses)], ['bob123__00001', 'bob123__00002'])
+
+    def test_load_users(self):
+        '''
+        Tests that the loaders fill a memory store
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            file_name = os.path.join(tmp, 'accounts.csv')
+            with open(file_name, 'w') as f:
+                f.write('USER_ID,NAME,LASTNAME,EMAIL\n')
+                f.write('bob123,Bob,Belcher,bob123@gmail.com\n')
+                f.write('gene234,Gene,Belcher,gene@gmail.com\n')
+            for parser in (None, 'block'):
+                with mock.patch('builtins.print'):
+                    self.assertTrue(M.load_users(file_name, self.users,
+                                                 parser))
+                self.assertEqual(self.users.store.count(), 3)
+                self.assertTrue(M.delete_user('gene234', self.users))
+
+class TextIndexTests(TestCase):
+    '''
+    Tests for the inverted status text index
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.users.add_user(test_data['Bob'][0], test_data['Bob'][3],
+                            test_data['Bob'][1], test_data['Bob'][2])
+        self.statuses = M.init_status_collection(text_index=True)
+        for status_id, user_id, text in status_data.values():
+            if user_id == 'bob123':
+                M.add_status(status_id, user_id, text, self.statuses)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.users.delete_user('bob123')
+        self.tmp.cleanup()
+
+    def search(self, search_string, statuses=None):
+        '''
+        Returns the status_ids filter_status_by_string finds
+        '''
+        return [row.status_id for row in M.filter_status_by_string(
+            search_string, statuses or self.statuses)]
+
+    def test_search_matches_like_scan(self):
+        '''
+        Tests that indexed searches return what the LIKE scan does
+        '''
+        index = self.statuses.text_index
+        for query in ('burger', 'LOVE burgers', 'o sux', 'pesto love',
+                      'ove bu', 'sux!'):
+            self.assertEqual([row.status_id for row in index.verify(
+                index.candidates(query), query)], self.search(query))
+        self.assertEqual(len(index.candidates('ove bu')), 1)
+        self.assertIsNone(index.candidates('!'))
+        self.assertEqual(self.search('ove bu'), ['bob123__00001'])
+
+    def test_incremental_updates(self):
+        '''
+        Tests that writes through the collection update the index
+        '''
+        M.update_status('bob123__00001', 'bob123', 'Hot dogs', self.statuses)
+        M.delete_status('bob123__00002', self.statuses)
+        M.add_status('bob123__00003', 'bob123', 'burgers again',
+                     self.statuses)
+        self.assertFalse(M.update_status('bob123__00003', 'nobody', 'x',
+                                         self.statuses))
+        self.assertEqual(self.search('burger'), ['bob123__00003'])
+        self.assertEqual(self.search('dogs'), ['bob123__00001'])
+        self.assertEqual(self.statuses.text_index.candidates('pesto'), [])
+        self.assertEqual(self.statuses.text_index.docs, 2)
+        postings = self.statuses.text_index.postings['burgers']
+        M.add_status('bob123__00004', 'bob123', 'more burgers', self.statuses)
+        M.delete_status('bob123__00003', self.statuses)
+        self.statuses.text_index.catch_up()
+        self.assertIs(self.statuses.text_index.postings['burgers'], postings)
+        self.assertEqual(len(postings), 1)
+
+    def test_stream_uses_index(self):
+        '''
+        Tests that streamed string searches are answered by the index,
+        a chunk at a time
+        '''
+        for number in range(3, 10):
+            M.add_status(f'bob123__{number:05d}', 'bob123', f'meal {number}',
+                         self.statuses)
+        with mock.patch.object(self.statuses.store, 'stream') as stream, \
+                mock.patch.object(self.statuses.text_index, 'verify',
+                                  wraps=self.statuses.text_index.verify) \
+                as verify:
+            found = M.stream_status_by_string('burgers', self.statuses,
+                                              chunk_size=1)
+            self.assertEqual([row.status_id for row in found],
+                             ['bob123__00001'])
+            stream.assert_not_called()
+            verify.assert_called_once()
+        self.assertEqual(len(list(M.stream_status_by_string(
+            'meal', self.statuses, chunk_size=2))), 7)
+
+    def test_save_and_reload(self):
+        '''
+        Tests that a saved index is mapped back and caught up
+        '''
+        file_name = os.path.join(self.tmp.name, 'status.idx')
+        M.save_text_index(self.statuses, file_name)
+        self.statuses.add_status('bob123__00003', 'bob123', 'Burger of the day')
+        loaded = M.init_status_collection(text_index=file_name)
+        self.assertTrue(loaded.text_index.stats()['mapped'])
+        self.assertEqual(self.search('burger', loaded),
+                         ['bob123__00001', 'bob123__00003'])
+        M.delete_status('bob123__00001', loaded)
+        self.assertEqual(self.search('burger', loaded), ['bob123__00003'])
+        loaded.text_index.close()
+        with open(file_name, 'wb') as f:
+            f.write(b'junk')
+        rebuilt = text_index.TextIndex.open(file_name)
+        self.assertEqual(rebuilt.docs, 2)
+        self.assertFalse(rebuilt.stats()['mapped'])
+
+    def test_reused_rowid(self):
+        '''
+        Tests that a new status taking a deleted status's rowid is
+        indexed under its own text only
+        '''
+        sm.Status.delete().where(
+            sm.Status.status_id == 'bob123__00002').execute()
+        sm.Status.insert(status_id='bob123__00003', user_id='bob123',
+                         status_text='Burger of the day').execute()
+        self.assertEqual(self.search('pesto'), [])
+        self.assertEqual(self.statuses.text_index.candidates('pesto'), [])
+        self.assertEqual(self.search('day'), ['bob123__00003'])
+        self.assertEqual(self.statuses.text_index.docs, 2)
+        file_name = os.path.join(self.tmp.name, 'status.idx')
+        M.save_text_index(self.statuses, file_name)
+        sm.Status.delete().where(
+            sm.Status.status_id == 'bob123__00003').execute()
+        M.add_status('bob123__00004', 'bob123', 'Hot dogs', self.statuses)
+        loaded = text_index.TextIndex.open(file_name)
+        self.assertEqual(loaded.candidates('day'), [])
+        self.assertEqual(len(loaded.candidates('dogs')), 1)
+        loaded.close()
+
+    def test_cascaded_delete(self):
+        '''
+        Tests that statuses deleted with their user leave the index
+        '''
+        self.users.add_user('linda123', 'linda@gmail.com', 'Linda', 'Belcher')
+        M.add_status('linda123__00001', 'linda123', 'burgers and wine',
+                     self.statuses)
+        sm.Users.delete().where(sm.Users.user_id == 'bob123').execute()
+        self.assertEqual(self.search('burger'), ['linda123__00001'])
+        self.assertEqual(self.statuses.text_index.docs, 1)
+        self.assertEqual(self.statuses.text_index.candidates('pesto'), [])
+
+    def test_rebuild_when_behind(self):
+        '''
+        Tests that an index whose queue entries were pruned, or whose
+        database was replaced, is rebuilt
+        '''
+        index = self.statuses.text_index
+        sm.Status.update(status_text='Hot dogs').where(
+            sm.Status.status_id == 'bob123__00001').execute()
+        text_index.TextIndexQueue.delete().execute()
+        with mock.patch.object(index, 'rebuild',
+                               wraps=index.rebuild) as rebuild:
+            self.assertEqual(self.search('dogs'), ['bob123__00001'])
+            rebuild.assert_called_once()
+            sm.new_database_epoch()
+            self.assertEqual(self.search('burger'), [])
+            self.assertEqual(rebuild.call_count, 2)
+            self.assertEqual(self.search('hot'), ['bob123__00001'])
+            self.assertEqual(rebuild.call_count, 2)
+        # the queue is pruned by its own trigger, with no index looking
+        sm.db.execute_sql(
+            "UPDATE sqlite_sequence SET seq = ? "
+            "WHERE name = 'text_index_queue'",
+            (2 * text_index.QUEUE_KEEP - 3,))
+        for number in range(3, 8):
+            sm.Status.create(status_id=f'bob123__{number:05d}',
+                             user_id='bob123', status_text='fries')
+        self.assertGreater(text_index.TextIndexQueue.select(
+            pw.fn.MIN(text_index.TextIndexQueue.seq)).scalar(),
+                           text_index.QUEUE_KEEP)
+        with mock.patch.object(index, 'rebuild',
+                               wraps=index.rebuild) as rebuild:
+            self.assertEqual(len(self.search('fries')), 5)
+            rebuild.assert_called_once()
+        self.assertEqual(index.docs, 7)
+        with sm.db.atomic() as transaction:
+            M.add_status('bob123__00008', 'bob123', 'onion rings',
+                         self.statuses)
+            transaction.rollback()
+        M.add_status('bob123__00009', 'bob123', 'chili fries', self.statuses)
+        self.assertEqual(self.search('onion'), [])
+        self.assertEqual(self.search('chili'), ['bob123__00009'])
+
+class DatabasePathTests(TestCase):
+    '''
+    Tests for choosing the database per process
+    '''
+
+    def test_database_path(self):
+        '''
+        Tests the environment override and per-worker names
+        '''
+        with mock.patch.dict(os.environ, {'SOCIALNETWORK_DB': 'other.db'}):
+            self.assertEqual(sm.database_path(worker=''), 'other.db')
+            self.assertEqual(sm.database_path(worker='gw1'), 'other_gw1.db')
+        self.assertEqual(sm.database_path(':memory:', 'gw1'), ':memory:')
+        self.assertEqual(
+            sm.database_path('file:net?mode=memory&cache=shared', 'gw1'),
+            'file:net_gw1?mode=memory&cache=shared')
+        self.assertTrue(sm.is_file_path('net.db'))
+        self.assertFalse(sm.is_file_path('file:net?mode=memory'))
+
+    def test_fresh_database(self):
+        '''
+        Tests that each test starts from the empty template
+        '''
+        self.assertEqual(sm.Users.select().count(), 0)
+        self.assertTrue(sm.db.table_exists('status'))
+
+class MaintenanceTests(TestCase):
+    '''
+    Tests for the database maintenance tasks
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.users.add_user(test_data['Tina'][0], test_data['Tina'][3],
+                            test_data['Tina'][1], test_data['Tina'][2])
+        rows = [(f'tina345_{i}', 'tina345', f'Butts {i} ' * 20)
+                for i in range(2000)]
+        with sm.db.atomic():
+            for chunk in pw.chunked(rows, 100):
+                sm.Status.insert_many(chunk).execute()
+
+    def test_vacuum_after_delete(self):
+        '''
+        Tests that freed pages are returned in slices and the checks pass
+        '''
+        self.assertEqual(maintenance.pragma('auto_vacuum'), 2)
+        self.users.delete_users(['tina345'])
+        before = maintenance.database_size()
+        self.assertGreater(before['free_bytes'], 0)
+        report = maintenance.run(pages_per_slice=64)
+        vacuum = report['tasks']['vacuum']
+        self.assertGreater(vacuum['pages_freed'], 0)
+        self.assertEqual(vacuum['pages_left'], 0)
+        self.assertLess(report['size_after']['bytes'], before['bytes'])
+        self.assertEqual(report['size_after']['free_bytes'], 0)
+        self.assertEqual(report['tasks']['checkpoint'],
+                         {'skipped': 'not in WAL mode',
+                          'seconds': report['tasks']['checkpoint']['seconds']})
+        self.assertTrue(report['tasks']['integrity']['ok'])
+        self.assertEqual(report['skipped'], [])
+
+    def test_time_budget(self):
+        '''
+        Tests that work past the time budget is skipped
+        '''
+        self.users.delete_users(['tina345'])
+        report = maintenance.run(time_budget=0)
+        self.assertEqual(report['tasks'], {})
+        self.assertEqual(report['skipped'], list(maintenance.TASKS))
+        vacuum = maintenance.incremental_vacuum(
+            pages_per_slice=1, deadline=time.monotonic() + 0.02, pause=0.01)
+        self.assertGreater(vacuum['pages_left'], 0)
+
+    def test_vacuum_in_transaction(self):
+        '''
+        Tests that the vacuum refuses to commit the caller's transaction
+        '''
+        self.users.delete_users(['tina345'])
+        with self.assertRaises(RuntimeError):
+            with sm.db.atomic():
+                self.users.add_user('bob123', 'bob123@gmail.com', 'Bob',
+                                    'Belcher')
+                maintenance.incremental_vacuum()
+        self.assertIsNone(self.users.search_user('bob123'))
+        self.assertEqual(maintenance.incremental_vacuum()['pages_left'], 0)
+
+class ChangeLogTests(TestCase):
+    '''
+    Tests for the change-data-capture feed
+    '''
+
+    def setUp(self):
+        sm.main()
+        changelog.install()
+        self.users = UserCollection()
+        self.statuses = UserStatusCollection()
+
+    def tearDown(self):
+        self.users.delete_users(['bob123', 'gene234'])
+        changelog.uninstall()
+
+    def test_changes_are_logged(self):
+        '''
+        Tests that collection writes and FK cascades are captured
+        '''
+        M.add_user('bob123', 'bob123@gmail.com', 'Bob', 'Belcher', self.users)
+        M.add_status('bob123__00001', 'bob123', 'I love burgers!',
+                     self.statuses)
+        M.update_status('bob123__00001', 'bob123', 'I love fries!',
+                        self.statuses)
+        M.delete_user('bob123', self.users)
+        changes = [change for batch in M.stream_changes(batch_size=2)
+                   for change in batch]
+        self.assertEqual([(c['table'], c['operation'], c['row_id'])
+                          for c in changes],
+                         [('users', 'insert', 'bob123'),
+                          ('status', 'insert', 'bob123__00001'),
+                          ('status', 'update', 'bob123__00001'),
+                          ('status', 'delete', 'bob123__00001'),
+                          ('users', 'delete', 'bob123')])
+        self.assertEqual(changes[2]['data'],
+                         {'status_id': 'bob123__00001', 'user_id': 'bob123',
+                          'status_text': 'I love fries!'})
+        self.assertIsNone(changes[-1]['data'])
+        self.assertEqual(changelog.changes_since(changes[3]['seq']),
+                         changes[4:])
+
+    def test_consumer_resumes(self):
+        '''
+        Tests that a named consumer continues after its last batch
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            file_name = os.path.join(tmp, 'accounts.csv')
+            with open(file_name, 'w') as f:
+                f.write('USER_ID,NAME,LASTNAME,EMAIL\n')
+                f.write('bob123,Bob,Belcher,bob123@gmail.com\n')
+                f.write('gene234,Gene,Belcher,gene@gmail.com\n')
+            with mock.patch('builtins.print'):
+                self.assertTrue(M.load_users(file_name, self.users, 'block'))
+        batches = M.consume_changes('cache', batch_size=1)
+        self.assertEqual(next(batches)[0]['row_id'], 'bob123')
+        batches.close()
+        self.assertEqual(changelog.Consumer('cache').seq, 0)
+        self.assertEqual([batch[0]['row_id'] for batch in
+                          M.consume_changes('cache', batch_size=1)],
+                         ['bob123', 'gene234'])
+        self.assertEqual(list(M.consume_changes('cache')), [])
+        self.assertEqual(changelog.prune(), 2)
+
+class BackupTests(TestCase):
+    '''
+    Tests for online backup and restore
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = UserCollection()
+        self.users.add_user(test_data['Linda'][0], test_data['Linda'][3],
+                            test_data['Linda'][1], test_data['Linda'][2])
+        self.statuses = UserStatusCollection()
+        self.statuses.add_status(status_data[3][0], status_data[3][1],
+                                 status_data[3][2])
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.users.delete_users(['linda123'])
+        self.tmp.cleanup()
+
+    def test_backup_and_restore(self):
+        '''
+        Tests plain and gzip backups round trip in several steps
+        '''
+        indexed = M.init_status_collection(text_index=True)
+        for name in ('copy.db', 'copy.db.gz'):
+            path = os.path.join(self.tmp.name, name)
+            report = backup.backup(path, pages=1, sleep=0)
+            self.assertGreater(report['steps'], 1)
+            self.assertEqual(name.endswith('.gz'),
+                             report['file_bytes'] < report['database_bytes'])
+            self.users.delete_users(['linda123'])
+            self.assertIsNone(M.search_status(status_data[3][0],
+                                              self.statuses))
+            indexed.text_index.catch_up()
+            self.assertEqual(indexed.text_index.candidates('sing'), [])
+            backup.restore(path)
+            self.assertEqual(M.search_status(status_data[3][0],
+                                             self.statuses).status_text,
+                             status_data[3][2])
+            indexed.text_index.catch_up()
+            self.assertEqual(len(indexed.text_index.candidates('sing')), 1)
+
+    def test_backup_sleeps_and_replaces(self):
+        '''
+        Tests that a backup sleeps between its steps, and that a failed
+        compressed backup leaves the previous file in place
+        '''
+        path = os.path.join(self.tmp.name, 'copy.db.gz')
+        with mock.patch.object(backup.time, 'sleep') as sleep:
+            report = backup.backup(path, pages=1, sleep=0.25)
+        self.assertEqual(sleep.call_count, report['steps'] - 1)
+        sleep.assert_called_with(0.25)
+        with open(path, 'rb') as f:
+            previous = f.read()
+        with mock.patch.object(backup.shutil, 'copyfileobj',
+                               side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                backup.backup(path, sleep=0)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), previous)
+        self.assertEqual(os.listdir(self.tmp.name), ['copy.db.gz'])
+
+    def test_restore_invalidates_filters(self):
+        '''
+        Tests that id filters are rebuilt after a restore, even when
+        the restored table logged as many inserts as the live one
+        '''
+        self.users.check_interval = 0
+        path = os.path.join(self.tmp.name, 'copy.db')
+        backup.backup(path)
+        with sqlite3.connect(path) as copy:
+            copy.execute("INSERT INTO users (user_id, user_name, "
+                         "user_last_name, user_email) VALUES ('bob123', "
+                         "'Bob', 'Belcher', 'bob123@gmail.com')")
+        copy.close()
+        self.users.add_user('gene234', 'gene@gmail.com', 'Gene', 'Belcher')
+        self.assertIsNone(self.users.search_user('bob123'))
+        backup.restore(path)
+        self.assertIsNotNone(self.users.search_user('bob123'))
+        self.assertIsNone(self.users.search_user('gene234'))
+        self.users.delete_users(['bob123'])
+
+    def test_restore_rejects_damaged_backup(self):
+        '''
+        Tests that a corrupt backup is refused before anything changes
+        '''
+        path = os.path.join(self.tmp.name, 'bad.db')
+        with open(path, 'wb') as f:
+            f.write(b'not a database' * 100)
+        with self.assertRaises(sqlite3.DatabaseError):
+            backup.restore(path)
+        self.assertEqual(sm.Users.select().count(), 1)
+
+
+class LoadGenTests(TestCase):
+    '''
+    Tests for the log replay load generator
+    '''
+
+    LOG = [
+        '2021-02-06 16:09:01.586 | WARNING  | users:search_user:72 - '
+        'User not found\n',
+        '2021-02-06 16:09:02.000 | INFO     | main:load_users:40 - '
+        'Created user list from file\n',
+        '2021-02-06 16:09:03.586 | INFO     | users:add_user:27 - '
+        'User successfully added\n',
+        '2021-02-06 16:09:04.086 | WARNING  | user_status:add_status:31 - '
+        'Status not added, either a duplicate status ID or missing '
+        'required foreign key user_id.\n',
+        '2021-02-06 16:09:14.086 | INFO     | user_status:'
+        'search_all_status_updates:88 - User_id tutu46 found.\n']
+
+    def setUp(self):
+        sm.main()
+
+    def test_parse_log(self):
+        '''
+        Tests that collection log lines become trace entries
+        '''
+        trace = loadgen.parse_log(self.LOG)
+        self.assertEqual([(entry['op'], entry['ok']) for entry in trace],
+                         [('search_user', False), ('add_user', True),
+                          ('add_status', False),
+                          ('search_all_status_updates', True)])
+        self.assertEqual([entry['at'] for entry in trace],
+                         [0.0, 2.0, 2.5, 12.5])
+        self.assertEqual(loadgen.schedule(trace, speed=2, max_gap=1),
+                         [0.0, 0.5, 0.75, 1.25])
+        self.assertEqual(loadgen.schedule(trace, speed=0), [0.0] * 4)
+        trace = loadgen.parse_log([
+            '2021-02-06 16:09:01.586 | DEBUG    | user_status:search_status:'
+            '94 - Status not found\n'])
+        self.assertEqual(trace[0]['ok'], False)
+
+    def test_replay_reproduces_outcomes(self):
+        '''
+        Tests a concurrent replay matches every logged outcome
+        '''
+        users = M.init_user_collection()
+        statuses = M.init_status_collection()
+        replayer = loadgen.Replayer()
+        replayer.seed(users, statuses, users=5)
+        trace = loadgen.parse_log(self.LOG) * 10
+        report = loadgen.replay(trace, users, statuses, workers=3, speed=0,
+                                replayer=replayer)
+        self.assertEqual(report['overall']['count'], 40)
+        self.assertEqual(report['overall']['errors'], 0)
+        self.assertEqual(report['overall']['mismatches'], 0)
+        self.assertEqual(report['by_op']['add_user']['count'], 10)
+        self.assertEqual(sm.Users.select().count(), 15)
+        self.assertIsNotNone(report['overall']['p99_ms'])
+
+    def test_command_line_db(self):
+        '''
+        Tests that with --db the command line leaves socialnetwork.db
+        alone
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'replay.log')
+            with open(log, 'w') as f:
+                f.writelines(self.LOG)
+            default = os.path.join(tmp, 'socialnetwork.db')
+            with open(default, 'wb') as f:
+                f.write(b'kept')
+            env = dict(os.environ)
+            env.pop('SOCIALNETWORK_DB', None)
+            env.pop('SOCIALNETWORK_KEEP_DB', None)
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'loadgen.py')
+            result = subprocess.run(
+                [sys.executable, script, log, '--speed', '0',
+                 '--seed-users', '2', '--db', 'other.db'],
+                capture_output=True, text=True, timeout=60, cwd=tmp, env=env,
+                check=True)
+            self.assertEqual(json.loads(result.stdout)['overall']['count'], 4)
+            with open(default, 'rb') as f:
+                self.assertEqual(f.read(), b'kept')
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'other.db')))
+
+
+class KeyedStoreTests(TestCase):
+    '''
+    Tests for the integer surrogate key storage backend
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users, self.statuses = M.init_keyed_collections()
+        for name in ('Bob', 'Linda'):
+            user_id, user_name, last_name, email = test_data[name]
+            M.add_user(user_id, email, user_name, last_name, self.users)
+        for status_id, user_id, text in status_data.values():
+            M.add_status(status_id, user_id, text, self.statuses)
+
+    def test_crud(self):
+        '''
+        Tests that callers see string ids while statuses store keys
+        '''
+        self.assertEqual(self.users.database, sm.KeyedUsers)
+        self.assertEqual(sm.db.execute_sql(
+            'SELECT DISTINCT typeof(user_key) FROM status_keyed').fetchall(),
+                         [('integer',)])
+        self.assertFalse(M.add_user('bob123', 'b@gmail.com', 'B', 'B',
+                                    self.users))
+        self.assertIsNone(M.add_status('bob123__00001', 'bob123', 'hi',
+                                       self.statuses))
+        self.assertIsNone(M.add_status('tina__1', 'tina345', 'hi',
+                                       self.statuses))
+        self.assertFalse(M.update_status('bob123__00001', 'tina345', 'hi',
+                                         self.statuses))
+        self.assertTrue(M.update_status('bob123__00001', 'linda123',
+                                        'I love burgers!', self.statuses))
+        self.assertTrue(M.update_user('bob123', 'bobby@gmail.com', 'Bob',
+                                      'Belcher', self.users))
+        status = M.search_status('bob123__00002', self.statuses)
+        self.assertEqual(status.user_id.user_email, 'bobby@gmail.com')
+        self.assertEqual([(s.status_id, s.user_id.user_id) for s in
+                          M.search_all_status_updates('linda123',
+                                                      self.statuses)],
+                         [('bob123__00001', 'linda123'),
+                          ('linda123__00001', 'linda123')])
+        self.assertEqual([s.status_id for s in
+                          M.filter_status_by_string('sux', self.statuses)],
+                         ['bob123__00002'])
+        self.assertEqual(M.delete_users(['linda123', 'nobody'], self.users),
+                         {'linda123': 2, 'nobody': None})
+        self.assertEqual(sm.KeyedStatus.select().count(), 1)
+        self.assertEqual(sm.Status.select().count(), 0)
+
+    def test_load_status_updates(self):
+        '''
+        Tests that both loader paths translate user_ids to keys
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            file_name = os.path.join(tmp, 'status.csv')
+            with open(file_name, 'w') as f:
+                f.write('STATUS_ID,USER_ID,STATUS_TEXT\n')
+                f.write('bob123__00003,bob123,Burger of the day\n')
+                f.write('linda123__00002,linda123,Alriiight\n')
+            for parser in (None, 'block'):
+                with mock.patch('builtins.print'):
+                    self.assertTrue(M.load_status_updates(
+                        file_name, self.statuses, parser))
+                self.assertEqual(
+                    M.search_status('linda123__00002',
+                                    self.statuses).user_id.user_id,
+                    'linda123')
+                self.assertEqual(self.statuses.store.count(), 5)
+                self.assertTrue(M.delete_status('bob123__00003',
+                                                self.statuses))
+                self.assertTrue(M.delete_status('linda123__00002',
+                                                self.statuses))
+
+
+class MultiGetTests(TestCase):
+    '''
+    Tests for search_users and search_statuses
+    '''
+
+    def setUp(self):
+        sm.main()
+
+    def check_collections(self, users, statuses):
+        '''
+        Fills a collection pair and checks batched searches on it
+        '''
+        for name in ('Bob', 'Linda'):
+            user_id, user_name, last_name, email = test_data[name]
+            M.add_user(user_id, email, user_name, last_name, users)
+        for status_id, user_id, text in status_data.values():
+            M.add_status(status_id, user_id, text, statuses)
+        found = M.search_users(['linda123', 'tina345', 'bob123', 'linda123'],
+                               users)
+        self.assertEqual(list(found), ['linda123', 'tina345', 'bob123'])
+        self.assertEqual(found['linda123'].user_email, 'linda@gmail.com')
+        self.assertIsNone(found['tina345'])
+        found = M.search_statuses(['bob123__00002', 'nope', 'linda123__00001'],
+                                  statuses)
+        self.assertEqual(found['bob123__00002'].status_text,
+                         status_data[2][2])
+        self.assertEqual(found['linda123__00001'].user_id.user_id,
+                         'linda123')
+        self.assertIsNone(found['nope'])
+        self.assertEqual(M.search_users([], users), {})
+
+    def test_sqlite(self):
+        '''
+        Tests batched searches over several IN chunks
+        '''
+        with mock.patch.object(sm, 'max_variable_number', return_value=1):
+            self.check_collections(M.init_user_collection(),
+                                   M.init_status_collection())
+
+    def test_other_stores(self):
+        '''
+        Tests batched searches on the memory and keyed stores
+        '''
+        self.check_collections(*M.init_memory_collections())
+        self.check_collections(*M.init_keyed_collections())
+
+
+class ResultGuardTests(TestCase):
+    '''
+    Tests for counting and capping large search results
+    '''
+
+    def setUp(self):
+        sm.main()
+        self.users = M.init_user_collection()
+        self.statuses = M.init_status_collection()
+        user_id, user_name, last_name, email = test_data['Bob']
+        M.add_user(user_id, email, user_name, last_name, self.users)
+        for number in range(1, 6):
+            M.add_status(f'bob123__{number:05d}', 'bob123', 'Burger ' * number,
+                         self.statuses)
+
+    def test_count_status_updates(self):
+        '''
+        Tests counting without reading the statuses
+        '''
+        self.assertEqual(M.count_status_updates('bob123', self.statuses), 5)
+        self.assertEqual(M.count_status_updates('tina345', self.statuses), 0)
+        users, statuses = M.init_memory_collections()
+        M.add_user('bob123', 'bob@gmail.com', 'Bob', 'Belcher', users)
+        M.add_status('bob123__00001', 'bob123', 'hi', statuses)
+        self.assertEqual(M.count_status_updates('bob123', statuses), 1)
+
+    def test_caps(self):
+        '''
+        Tests the row and byte caps truncate with a warning
+        '''
+        query = M.search_all_status_updates('bob123', self.statuses)
+        with mock.patch('user_status.logger') as log:
+            found, truncated = M.collect_statuses(query, max_rows=3)
+        self.assertEqual([s.status_id for s in found],
+                         ['bob123__00001', 'bob123__00002', 'bob123__00003'])
+        self.assertTrue(truncated)
+        log.warning.assert_called_once()
+        # 13 + 7 bytes for the first status, 13 + 14 for the second
+        found, truncated = M.collect_statuses(
+            M.stream_status_updates('bob123', self.statuses, chunk_size=2),
+            max_rows=0, max_bytes=46)
+        self.assertEqual(len(found), 1)
+        self.assertTrue(truncated)
+        found, truncated = M.collect_statuses(
+            M.filter_status_by_string('burger', self.statuses), 0, 0)
+        self.assertEqual((len(found), truncated), (5, False))
+        guard = M.limit_results(
+            M.search_all_status_updates('bob123', self.statuses), 5)
+        self.assertEqual(sum(1 for _ in guard), 5)
+        self.assertFalse(guard.truncated)
+
+class MenuFastStartTests(TestCase):
+    '''
+    Tests for starting the menu before the backend is set up
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = dict(os.environ,
+                        SOCIALNETWORK_DB=os.path.join(self.tmp.name, 'net.db'))
+        self.env.pop('SOCIALNETWORK_FAST_START', None)
+        self.menu = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'menu.py')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_python(self, args, choices=''):
+        '''
+        Runs python in the temporary directory and returns its output
+        '''
+        result = subprocess.run([sys.executable] + args, input=choices,
+                                 capture_output=True, text=True, timeout=60,
+                                 cwd=self.tmp.name, env=self.env, check=True)
+        return result.stdout
+
+    def test_lazy_import(self):
+        '''
+        Tests that a fast start imports nothing until the backend starts
+        '''
+        self.env['SOCIALNETWORK_FAST_START'] = '1'
+        self.env['PYTHONPATH'] = os.path.dirname(self.menu)
+        output = self.run_python(['-c', '''
+import sys
+import menu
+print('peewee' in sys.modules, 'loguru' in sys.modules, menu.main)
+menu.start_backend()
+collection = menu.user_collection
+menu.start_backend()
+print(menu.main is not None, menu.user_collection is collection,
+      menu.sm.db.table_exists('users'))
+'''])
+        self.assertEqual(output.splitlines(),
+                         ['False False None', 'True True True'])
+
+    def test_backend_on_first_choice(self):
+        '''
+        Tests that the menu sets up logs and tables on the first choice
+        '''
+        def created():
+            return sorted(name.split('_')[0]
+                          for name in os.listdir(self.tmp.name))
+
+        output = self.run_python([self.menu, '--fast-start'], 'Z\nQ\n')
+        self.assertIn('Invalid option', output)
+        self.assertEqual(created(), [])
+        output = self.run_python([self.menu, '--fast-start'],
+                                 'E\nnobody\nQ\n')
+        self.assertIn('ERROR: User does not exist', output)
+        self.assertIn('log', created())
+        self.assertIn('net.db', created())
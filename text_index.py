@@ -0,0 +1,393 @@
+'''
+Inverted index over status text, for word and phrase searches without
+a LIKE scan of the whole status table
+'''
+# pylint: disable=R0903, E0401
+import json
+import mmap
+import os
+import struct
+from array import array
+from loguru import logger
+import peewee as pw
+from playhouse.sqlite_ext import AutoIncrementField
+import socialnetwork_model as sm
+import storage
+
+MAGIC = b'SNTI'
+# magic, format version, indexed statuses, last text_index_queue seq
+# applied, database epoch, length of the JSON token table that
+# follows
+HEADER = struct.Struct('<4sIqq8sI')
+VERSION = 2
+# queue entries kept behind the newest, so an index lagging by fewer
+# catches up instead of rebuilding. A trigger prunes the rest whether or
+# not any index is running.
+QUEUE_KEEP = 10000
+
+
+class TextIndexQueue(sm.BaseModel):
+    '''
+    Status rows changed since the queue was installed, filled by
+    triggers on the status table: the rowid, the operation and, for
+    updates and deletes, the text before the change. AUTOINCREMENT
+    keeps seq from being reused after the queue is pruned.
+    '''
+    seq = AutoIncrementField()
+    row_id = pw.IntegerField()
+    operation = pw.CharField(max_length=6)
+    old_text = pw.BlobField(null=True)
+
+    class Meta:
+        '''
+        Meta class statement
+        '''
+        table_name = 'text_index_queue'
+
+
+QUEUE_TRIGGERS = {
+    'status_text_index_insert':
+        '''CREATE TRIGGER IF NOT EXISTS status_text_index_insert
+           AFTER INSERT ON status BEGIN
+           INSERT INTO text_index_queue (row_id, operation)
+           VALUES (NEW.rowid, 'insert');
+           END''',
+    'status_text_index_update':
+        '''CREATE TRIGGER IF NOT EXISTS status_text_index_update
+           AFTER UPDATE OF status_text ON status BEGIN
+           INSERT INTO text_index_queue (row_id, operation, old_text)
+           VALUES (NEW.rowid, 'update', OLD.status_text);
+           END''',
+    'status_text_index_delete':
+        '''CREATE TRIGGER IF NOT EXISTS status_text_index_delete
+           AFTER DELETE ON status BEGIN
+           INSERT INTO text_index_queue (row_id, operation, old_text)
+           VALUES (OLD.rowid, 'delete', OLD.status_text);
+           END''',
+    'text_index_queue_prune':
+        f'''CREATE TRIGGER IF NOT EXISTS text_index_queue_prune
+           AFTER INSERT ON text_index_queue WHEN NEW.seq % 1000 = 0 BEGIN
+           DELETE FROM text_index_queue WHERE seq <= NEW.seq - {QUEUE_KEEP};
+           END'''}
+
+
+def install(database=sm.db):
+    '''
+    Creates the queue and the status triggers feeding it. Safe to call
+    repeatedly; TextIndex.build and open call it.
+    '''
+    database.create_tables([TextIndexQueue])
+    for trigger in QUEUE_TRIGGERS.values():
+        database.execute_sql(trigger)
+    sm.database_epoch(database)
+    return True
+
+
+def uninstall(database=sm.db):
+    '''
+    Drops the status triggers and the queue
+    '''
+    for name in QUEUE_TRIGGERS:
+        database.execute_sql(f'DROP TRIGGER IF EXISTS {name}')
+    database.drop_tables([TextIndexQueue])
+    return True
+
+
+class TextIndex:
+    '''
+    Maps each lower-cased word of the status text to an array of status
+    rowids. A search looks up the statuses holding every word of the
+    search string, then lets SQLite confirm the exact substring on just
+    those rows, so results match filter_status_by_string's LIKE scan.
+
+    Every change to the status table, whoever makes it, is queued by
+    triggers in text_index_queue, and catch_up() applies those queued
+    since the index last looked; search() does so first. The index is
+    rebuilt when it can't catch up: the entries it needs were pruned,
+    or the database was replaced (the database epoch changed).
+    '''
+
+    def __init__(self):
+        self.postings = {}
+        self.docs = 0
+        self.seq = 0
+        self.epoch = bytes(8)
+        self._mmap = None
+
+    @classmethod
+    def build(cls):
+        '''
+        Returns a new index over the whole status table
+        '''
+        index = cls()
+        index.rebuild()
+        return index
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Loads an index saved with save(), memory-mapping its postings,
+        and applies the status changes queued since. Builds a new one
+        instead when the file is missing, unreadable or no longer
+        matches the table.
+        '''
+        try:
+            index = cls.load(path)
+        except (OSError, ValueError) as e:
+            logger.info('Rebuilding text index, cannot load {}: {}', path, e)
+            return cls.build()
+        index.catch_up()
+        if index.docs != sm.Status.select().count():
+            logger.info('Text index {} is stale, rebuilding', path)
+            index.close()
+            return cls.build()
+        return index
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Maps a saved index without checking it against the table
+        '''
+        with open(path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, docs, seq, epoch, table_size = \
+                HEADER.unpack_from(mapped)
+            if (magic, version) != (MAGIC, VERSION):
+                raise ValueError('not a text index file')
+            start = HEADER.size
+            tokens = json.loads(mapped[start:start + table_size])
+            base = start + table_size
+            base += -base % 8
+            rowids = memoryview(mapped)[base:].cast('q')
+        except (struct.error, ValueError):
+            mapped.close()
+            raise ValueError(f'{path} is not a text index file')
+        index = cls()
+        # postings stay views into the file until a write copies them
+        index.postings = {token: rowids[offset:offset + count]
+                          for token, (offset, count) in tokens.items()}
+        index.docs, index.seq, index.epoch = docs, seq, epoch
+        index._mmap = mapped
+        return index
+
+    def save(self, path):
+        '''
+        Writes the index to path (atomically, via a temporary file)
+        '''
+        tokens = {}
+        offset = 0
+        for token, rowids in self.postings.items():
+            tokens[token] = (offset, len(rowids))
+            offset += len(rowids)
+        table = json.dumps(tokens, separators=(',', ':')).encode('utf-8')
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, self.docs, self.seq,
+                                   self.epoch, len(table)))
+            file.write(table)
+            file.write(b'\0' * (-(HEADER.size + len(table)) % 8))
+            for rowids in self.postings.values():
+                file.write(rowids if isinstance(rowids, array)
+                           else rowids.tobytes())
+        os.replace(temporary, path)
+        logger.info('Saved text index to {}: {} words, {} statuses', path,
+                    len(tokens), self.docs)
+        return path
+
+    def close(self):
+        '''
+        Releases the file mapping of a loaded index
+        '''
+        if self._mmap is not None:
+            self.postings = {token: array('q', rowids)
+                             for token, rowids in self.postings.items()}
+            self._mmap.close()
+            self._mmap = None
+
+    def _add(self, rowid, text):
+        for word in set(storage.WORD.findall(text.lower())):
+            rowids = self.postings.get(word)
+            if not isinstance(rowids, array):
+                rowids = self.postings[word] = array('q', rowids or ())
+            rowids.append(rowid)
+        self.docs += 1
+
+    def _remove(self, rowid, text):
+        for word in set(storage.WORD.findall(text.lower())):
+            rowids = self.postings.get(word)
+            if rowids is None:
+                continue
+            if not isinstance(rowids, array):
+                # a view into the mapped file, copied on the first write
+                rowids = self.postings[word] = array('q', rowids)
+            try:
+                rowids.remove(rowid)
+            except ValueError:
+                continue
+            if not rowids:
+                del self.postings[word]
+        self.docs -= 1
+
+    def _rows(self, where=None):
+        rowid = pw.SQL('rowid')
+        query = sm.Status.select(rowid, sm.Status.status_text)
+        if where is not None:
+            query = query.where(where)
+        return sm.db.execute_sql(*query.order_by(rowid).sql())
+
+    @staticmethod
+    def _position():
+        '''
+        Returns the database epoch and the last queue seq
+        '''
+        row = sm.db.execute_sql(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'text_index_queue'"
+        ).fetchone()
+        return sm.database_epoch(), (row[0] if row else 0)
+
+    def catch_up(self):
+        '''
+        Applies the status changes queued since the index last looked,
+        rebuilding it instead when it can't. Returns how many statuses
+        were indexed. Does nothing inside a transaction: its changes
+        could still roll back, and are applied once committed.
+        '''
+        if sm.db.in_transaction():
+            return 0
+        try:
+            with sm.db.atomic():
+                epoch, last = self._position()
+                changes = list(sm.db.execute_sql(
+                    'SELECT seq, row_id, operation, old_text '
+                    'FROM text_index_queue WHERE seq > ? ORDER BY seq',
+                    (self.seq,)))
+                # seqs are never skipped, so a missing next one was pruned
+                first = changes[0][0] if changes else last + 1
+                if (epoch != self.epoch or last < self.seq or
+                        (last > self.seq and first != self.seq + 1)):
+                    logger.info('Text index cannot catch up, rebuilding')
+                    return self.rebuild()
+                # rows inserted or re-texted, indexed with their text now
+                pending = set()
+                for _, rowid, operation, old_text in changes:
+                    if operation != 'insert':
+                        if rowid in pending:
+                            pending.discard(rowid)
+                        else:
+                            self._remove(rowid,
+                                         sm.status_text_decompress(old_text))
+                    if operation != 'delete':
+                        pending.add(rowid)
+                candidates = pw.SQL(
+                    'rowid IN (SELECT value FROM json_each(?))',
+                    (json.dumps(sorted(pending)),))
+                added = 0
+                for rowid, text in self._rows(candidates):
+                    self._add(rowid, sm.status_text_decompress(text))
+                    added += 1
+                if changes:
+                    self.seq = changes[-1][0]
+        except pw.OperationalError:
+            return self.rebuild()  # queue or status table missing
+        if changes:
+            logger.info('Text index: {} changes applied', len(changes))
+        return added
+
+    def rebuild(self):
+        '''
+        Re-reads the whole status table. Returns how many statuses
+        were indexed.
+        '''
+        self.close()
+        self.postings, self.docs = {}, 0
+        self.seq, self.epoch = 0, bytes(8)
+        try:
+            install()
+            with sm.db.atomic():
+                self.epoch, self.seq = self._position()
+                for rowid, text in self._rows():
+                    self._add(rowid, sm.status_text_decompress(text))
+        except pw.OperationalError:
+            pass  # status table not created yet
+        logger.info('Text index rebuilt: {} statuses', self.docs)
+        return self.docs
+
+    def candidates(self, search_string):
+        '''
+        Returns the sorted rowids of statuses holding every word of
+        search_string, or None when it has no words to look up. A word
+        of the search string may be part of a longer word in the text,
+        so each matches every indexed word containing it.
+        '''
+        words = set(storage.WORD.findall(search_string.lower()))
+        if not words:
+            return None
+        found = None
+        for word in sorted(words, key=len, reverse=True):
+            rowids = set()
+            for token, postings in self.postings.items():
+                if word in token:
+                    rowids.update(postings)
+            found = rowids if found is None else found & rowids
+            if not found:
+                break
+        return sorted(found)
+
+    def search(self, search_string):
+        '''
+        Yields statuses containing search_string (any case), in rowid
+        order. Returns None instead when the index can't narrow the
+        search enough to beat a scan: no words to look up, or candidates
+        in more than a quarter of the statuses.
+        '''
+        rowids = self._narrowed(search_string)
+        if rowids is None:
+            return None
+        return self.verify(rowids, search_string)
+
+    def stream(self, search_string, chunk_size=100):
+        '''
+        Like search, but confirms chunk_size candidates per query and
+        reads each chunk fully before handing it out, so no cursor stays
+        open while the caller waits between statuses
+        '''
+        rowids = self._narrowed(search_string)
+        if rowids is None:
+            return None
+        return self._stream(rowids, search_string, chunk_size)
+
+    def _narrowed(self, search_string):
+        self.catch_up()
+        rowids = self.candidates(search_string)
+        if rowids is None or len(rowids) * 4 > self.docs:
+            return None
+        return rowids
+
+    def _stream(self, rowids, search_string, chunk_size):
+        for start in range(0, len(rowids), chunk_size):
+            yield from list(self.verify(rowids[start:start + chunk_size],
+                                        search_string))
+
+    def verify(self, rowids, search_string):
+        '''
+        Returns an iterator over the statuses among rowids that contain
+        search_string, in rowid order
+        '''
+        # one JSON parameter instead of a variable per rowid
+        candidates = pw.SQL('rowid IN (SELECT value FROM json_each(?))',
+                            (json.dumps(rowids),))
+        return (sm.Status.select()
+                .where(candidates &
+                       sm.Status.searchable_text().contains(search_string))
+                .order_by(pw.SQL('rowid')).iterator())
+
+    def stats(self):
+        '''
+        Returns sizes for reporting
+        '''
+        return {'words': len(self.postings), 'statuses': self.docs,
+                'postings': sum(len(rowids)
+                                for rowids in self.postings.values()),
+                'seq': self.seq,
+                'mapped': self._mmap is not None}
@@ -3,28 +3,97 @@ Classes for user status information for the
 social network project
 '''
 # pylint: disable=R0903, E0401
+import os
 from loguru import logger
 import peewee as pw
 import socialnetwork_model as sm
+import bloom
+import storage
 #import more_itertools
 
+# Default caps on results read into memory by ResultGuard; 0 turns a cap
+# off. SOCIALNETWORK_MAX_RESULT_ROWS / _BYTES override them.
+MAX_RESULT_ROWS = int(os.environ.get('SOCIALNETWORK_MAX_RESULT_ROWS',
+                                     '10000'))
+MAX_RESULT_BYTES = int(os.environ.get('SOCIALNETWORK_MAX_RESULT_BYTES',
+                                      str(16 * 1024 * 1024)))
 
-class UserStatusCollection:
+
+class ResultGuard:
+    '''
+    Iterates over search results, stopping with a warning before more
+    than max_rows statuses or max_bytes of status id and text (UTF-8)
+    have been read. truncated tells whether results were left unread.
+    '''
+
+    def __init__(self, statuses, max_rows=None, max_bytes=None):
+        self.statuses = statuses
+        self.max_rows = MAX_RESULT_ROWS if max_rows is None else max_rows
+        self.max_bytes = MAX_RESULT_BYTES if max_bytes is None else max_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.truncated = False
+
+    def __iter__(self):
+        statuses = self.statuses
+        if isinstance(statuses, pw.BaseQuery):
+            statuses = statuses.iterator()  # don't cache every row read
+        statuses = iter(statuses)
+        try:
+            for status in statuses:
+                size = (len(status.status_id.encode('utf-8')) +
+                        len(status.status_text.encode('utf-8')))
+                if ((self.max_rows and self.rows >= self.max_rows) or
+                        (self.max_bytes and
+                         self.bytes + size > self.max_bytes)):
+                    self.truncated = True
+                    logger.warning('Results truncated after {} statuses '
+                                   '({} bytes)', self.rows, self.bytes)
+                    return
+                self.rows += 1
+                self.bytes += size
+                yield status
+        finally:
+            # stop a streaming search from reading its next chunk
+            if hasattr(statuses, 'close'):
+                statuses.close()
+
+
+class UserStatusCollection(bloom.IdFilterMixin):
     '''
-    Contains a collection of UserStatus objects
+    Contains a collection of UserStatus objects. store is where they
+    are kept, the SQLite status table (searched through read_replica
+    when one is given) unless a storage.MemoryStatusStore is passed.
+    A text_index.TextIndex over the SQLite table, if given, answers
+    filter_status_by_string.
     '''
+    noun, nouns = 'Status', 'statuses'
+
+    def __init__(self, read_replica=None, store=None, text_index=None):
+        if store is None:
+            store = storage.SqliteStatusStore(read_replica)
+        self.store = store
+        self.database = store.model
+        self.read_replica = read_replica
+        self.text_index = text_index
+        self.init_id_filter()
 
-    def __init__(self):
-        self.database = sm.Status
+    def remember_ids(self, ids):
+        '''
+        Adds newly stored status_ids to the filter, and brings the text
+        index up to date
+        '''
+        super().remember_ids(ids)
+        if self.text_index is not None:
+            self.text_index.catch_up()
 
     def add_status(self, status_id, user_id, status_text):
         '''
         Adds a new user to the collection
         '''
         try:
-            self.database.create(status_id=status_id,
-                                 user_id=user_id,
-                                 status_text=status_text)
+            self.store.insert(status_id, user_id, status_text)
+            self.remember_ids([status_id])
             logger.info("Status successfully added")
             return True
         except pw.IntegrityError:
@@ -37,18 +106,13 @@ class UserStatusCollection:
         Modifies an existing status
         '''
         try:
-            modify = self.database.get_by_id(status_id)
-            (modify.update({self.database.user_id: user_id,
-                            self.database.status_text: status_text}).\
-                            where(self.database.status_id == status_id).\
-                            execute())
+            if not self.store.update(status_id, user_id, status_text):
+                logger.warning("Status cannot be modified as it doesn't exist.")
+                return False
             logger.info("Status_id {} modified to have user_id {} "
                         "and status_text {}",
                         status_id, user_id, status_text)
             return True
-        except pw.DoesNotExist:
-            logger.warning("Status cannot be modified as it doesn't exist.")
-            return False
         except pw.IntegrityError:
             logger.warning(
                 "Cannot modify status to a user_id that does not exist.")
@@ -58,44 +122,79 @@ class UserStatusCollection:
         '''
         Deletes an existing user
         '''
-        try:
-            self.database.get_by_id(status_id).delete_instance()
-            logger.info("Status_id {} successfully deleted", status_id)
-            return True
-        except pw.DoesNotExist:
+        if not self.store.delete(status_id):
             logger.warning("Status cannot be deleted as it doesn't exist.")
             return False
+        logger.info("Status_id {} successfully deleted", status_id)
+        return True
 
     def search_status(self, status_id):
         '''
         Searches for user status data
         '''
-        try:
-            return_value = self.database.get_by_id(status_id)
-            logger.info("Status_id {} found.", status_id)
-            return return_value
-        except pw.DoesNotExist:
-            logger.warning("Status not found")
-            return None
+        return self.search_id(status_id)
 
+    def search_statuses(self, status_ids):
+        '''
+        Searches for many statuses at once. Returns {status_id: status}
+        with None for ids not found.
+        '''
+        return self.search_ids(status_ids)
 
     def search_all_status_updates(self, user_id):
         '''
         Searches by a user_id and returns all status updates from that user
         '''
-        try:
-            query = self.database.select().where(self.database.user_id == user_id)
-            logger.info(f'User_id {user_id} found. Returning status query.')
-            return query
-        except pw.DoesNotExist:
-            logger.warning(f'User_id {user_id} not found.')
-            return None
+        query = self.store.by_user(user_id)
+        logger.info(f'User_id {user_id} found. Returning status query.')
+        return query
+
+    def count_status_updates(self, user_id):
+        '''
+        Returns how many status updates user_id has, without reading them
+        '''
+        return self.store.count_by_user(user_id)
+
+    def search_status_terms(self, all_terms=(), any_terms=(), none_terms=()):
+        '''
+        Searches all status updates for many terms in a single table pass:
+        matches contain every one of all_terms, at least one of any_terms
+        (if given) and none of none_terms. Like filter_status_by_string,
+        matching is case-insensitive substring and an iterator is returned.
+        '''
+        if not (all_terms or any_terms or none_terms):
+            raise ValueError('At least one search term is required')
+        spec = sm.terms_spec(all_terms, any_terms, none_terms)
+        logger.info('Searching statuses for terms {}', spec)
+        return self.store.matching_terms(spec)
+
+    def stream_statuses(self, search_string=None, user_id=None,
+                        chunk_size=100):
+        '''
+        Yields statuses (optionally containing search_string and/or from
+        user_id) in status_id order, chunk_size rows per query, resuming
+        after the last status_id seen. Each chunk is fully read before
+        it is handed out, so no cursor or read transaction stays open
+        while the caller waits between rows. A search_string alone is
+        answered by the text index when there is one and it narrows the
+        search; statuses then come in rowid order.
+        '''
+        if (self.text_index is not None and search_string is not None
+                and user_id is None):
+            results = self.text_index.stream(search_string, chunk_size)
+            if results is not None:
+                return results
+        return self.store.stream(search_string, user_id, chunk_size)
 
     def filter_status_by_string(self, search_string):
         '''
         searches database for all status updates that contain a word or phrase inputted by the user
         '''
-        query = self.database.select().where(self.database.status_text.contains(search_string)).iterator()
+        if self.text_index is not None:
+            results = self.text_index.search(search_string)
+            if results is not None:
+                return results
+        query = self.store.containing(search_string)
         return query
 
         #I attempted to check to see if the query is empty
@@ -5,25 +5,30 @@ social network project
 # pylint: disable=R0903,  E0401
 from loguru import logger
 import peewee as pw
-import socialnetwork_model as sm
+import bloom
+import storage
 
 
-class UserCollection():
+class UserCollection(bloom.IdFilterMixin):
     '''
-    Contains a collection of Users objects
+    Contains a collection of Users objects. store is where they are
+    kept, the SQLite users table unless a storage.MemoryUserStore is
+    passed.
     '''
-    def __init__(self):
-        self.database = sm.Users
+    noun, nouns = 'User', 'users'
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else storage.SqliteUserStore()
+        self.database = self.store.model
+        self.init_id_filter()
 
     def add_user(self, user_id, email, user_name, user_last_name):
         '''
         Adds a new user to the collection
         '''
         try:
-            self.database.create(user_id=user_id,
-                                 user_email=email,
-                                 user_name=user_name,
-                                 user_last_name=user_last_name)
+            self.store.insert(user_id, email, user_name, user_last_name)
+            self.remember_ids([user_id])
             logger.info("User successfully added")
             return True
         except pw.IntegrityError:
@@ -34,40 +39,54 @@ class UserCollection():
         '''
         Modifies an existing user
         '''
-        try:
-            modify = self.database.get_by_id(user_id)
-            (modify.update({self.database.user_email: email,
-                            self.database.user_name: user_name,
-                            self.database.user_last_name: user_last_name}).\
-                            where(self.database.user_id == user_id).execute())
-            logger.info("User ID {} modified to have email {},"
-                        "first_name {} and last_name {}",
-                        user_id, email, user_name, user_last_name)
-            return True
-        except pw.DoesNotExist:
+        if not self.store.update(user_id, email, user_name, user_last_name):
             logger.warning("User cannot be modified as it doesn't exist.")
             return False
+        logger.info("User ID {} modified to have email {},"
+                    "first_name {} and last_name {}",
+                    user_id, email, user_name, user_last_name)
+        return True
 
     def delete_user(self, user_id):
         '''
         Deletes an existing user
         '''
-        try:
-            self.database.get_by_id(user_id).delete_instance()
-            logger.info("User_id {} successfully deleted", user_id)
-            return True
-        except pw.DoesNotExist:
+        if not self.store.delete(user_id):
             logger.warning("User cannot be deleted as it doesn't exist.")
             return False
+        logger.info("User_id {} successfully deleted", user_id)
+        return True
+
+    def delete_users(self, user_ids, batch_size=500):
+        '''
+        Deletes several users and their statuses.
+        Statuses are removed in transactions of at most batch_size rows
+        before the user row itself, so a prolific user never holds the
+        write lock for one long cascade.
+        Returns a dict of user_id -> number of statuses deleted, with None
+        for users that don't exist. Repeated ids are deleted once.
+        '''
+        results = {}
+        for user_id in dict.fromkeys(user_ids):
+            deleted = self.store.delete_with_statuses(user_id, batch_size)
+            if deleted is not None:
+                logger.info("User_id {} deleted with {} statuses",
+                            user_id, deleted)
+            else:
+                logger.warning("User {} cannot be deleted as it doesn't exist.",
+                               user_id)
+            results[user_id] = deleted
+        return results
 
     def search_user(self, user_id):
         '''
         Searches for user data
         '''
-        try:
-            return_value = self.database.get_by_id(user_id)
-            logger.info("User_ID {} found.", user_id)
-            return return_value
-        except pw.DoesNotExist:
-            logger.warning("User not found")
-            return None
+        return self.search_id(user_id)
+
+    def search_users(self, user_ids):
+        '''
+        Searches for many users at once. Returns {user_id: user} with
+        None for ids not found.
+        '''
+        return self.search_ids(user_ids)